@@ -1,7 +1,7 @@
 import bisect
 
 from mahjong import bots, patterns, scoring
-from mahjong.types import Tile
+from mahjong.types import Tile, TileGroup
 
 
 def can_win(context, player_idx=None, incoming_tile=None):
@@ -14,7 +14,11 @@ def can_win(context, player_idx=None, incoming_tile=None):
     '''
     player_idx = _get_player_index(context, player_idx)
     incoming_tile = _get_incoming_tile(context, player_idx, incoming_tile)
+    return _can_win(context, player_idx, incoming_tile, True)
 
+
+def _can_win(context, player_idx, incoming_tile, general):
+    # can_win(), but the general winning pattern is only checked if general
     player = context.players[player_idx]
     hand = player.hand
 
@@ -32,7 +36,7 @@ def can_win(context, player_idx=None, incoming_tile=None):
             return False
 
     # general winning pattern
-    if hand.can_win(incoming_tile):
+    if general and hand.can_win(incoming_tile):
         all_matched = True
         for pattern_name in context.settings.patterns_win_filter:
             all_matched = patterns.match(pattern_name, context, player_idx, incoming_tile)
@@ -64,14 +68,14 @@ def can_flower_win(context, player_idx=None, incoming_tile=None):
         return False
 
     for pattern_name in ('seven-flowers', 'eight-flowers'):
-        if pattern_name in context.settings.patterns_win:
+        if pattern_name in context.settings.patterns_win_set:
             if patterns.match(pattern_name, context, player_idx, incoming_tile):
                 return True
 
     return False
 
 
-def waiting_tiles(context, player_idx=None):
+def waiting_tiles(context, player_idx=None, trusted=False):
     '''
     Return a list of tiles that makes a player a winning hand.
 
@@ -79,6 +83,9 @@ def waiting_tiles(context, player_idx=None):
     and winning restrictions (filters) in GameSettings. This function is quite
     time-expensive. Use it with caution.
 
+    If trusted, the hand is assumed to be valid, and the general winning
+    pattern is only checked for the tiles of ``Hand.waits()``.
+
     '''
     if player_idx is None:
         player_idx = context.cur_player_idx
@@ -89,26 +96,36 @@ def waiting_tiles(context, player_idx=None):
         if waiting_tiles is not None:
             return waiting_tiles
 
-    tiles = []
-    for tile in Tile.ALL.itervalues():
-        if can_win(context, player_idx, tile):
-            bisect.insort(tiles, tile)
-    return tiles
+    return _winning_tiles(context, player_idx, trusted)
 
 
-def ready(context, player_idx=None):
+def ready(context, player_idx=None, trusted=False):
     '''
     Is a player has a ready hand?
 
     Unlike Hand.ready(), this function covers special winning patterns and
     winning restrictions (filters) in GameSettings. This function is quite
-    time-expensive. Use it with caution.
+    time-expensive. Use it with caution. See waiting_tiles() for trusted.
 
     '''
+    return bool(_winning_tiles(context, player_idx, trusted, first=True))
+
+
+def _winning_tiles(context, player_idx, trusted, first=False):
+    # the tiles that can_win() is True for, only the first one if first
+    player_idx = _get_player_index(context, player_idx)
+    if trusted:
+        # the table-derived waits of the free tiles are the only tiles that
+        # complete the general winning pattern, the others can only win by
+        # special winning patterns
+        waits = context.players[player_idx].hand.waits()
+    tiles = []
     for tile in Tile.ALL.itervalues():
-        if can_win(context, player_idx, tile):
-            return True
-    return False
+        if _can_win(context, player_idx, tile, not trusted or tile in waits):
+            if first:
+                return [tile]
+            bisect.insort(tiles, tile)
+    return tiles
 
 
 def select_melders(viable_decisions, player_decisions, base_offset=0):
@@ -178,11 +195,203 @@ def select_melders(viable_decisions, player_decisions, base_offset=0):
     return None
 
 
+def resolve_melders(viable_decisions, player_decisions, base_offset=0, multi_winners=True):
+    '''
+    Like select_melders(), but players may decide in any order. Return a
+    tuple of (melders, pending).
+
+    If the outcome is already determined, pending is empty and melders is
+    what select_melders() would select, or None if nobody melds. Otherwise,
+    melders is None and pending is a list of all the players who can still
+    decide. Decisions of pending players are ignored once the outcome is
+    determined, e.g., a 'win' of the top-priority player when multi_winners
+    is off settles it without waiting for anyone else.
+
+    '''
+    num_players = len(player_decisions)
+    order = [(base_offset + i) % num_players for i in xrange(0, num_players)]
+    pending = [player_idx for player_idx in order
+               if viable_decisions[player_idx] and
+               player_decisions[player_idx] not in viable_decisions[player_idx]]
+
+    winners = []
+    waiting = False
+    for player_idx in order:
+        player_viable = viable_decisions[player_idx]
+        if player_viable and 'win' in player_viable:
+            player_decision = player_decisions[player_idx]
+            if player_decision == 'win':
+                winners.append((player_idx, 'win'))
+                if not (multi_winners or waiting):
+                    # no one before player i can win
+                    return winners, []
+            elif player_decision not in player_viable:
+                waiting = True
+
+    if waiting:
+        return None, pending
+    if winners:
+        return winners, []
+
+    for decision in ('kong', 'pong', 'chow'):
+        for player_idx in order:
+            player_viable = viable_decisions[player_idx]
+            if player_viable and decision in player_viable:
+                player_decision = player_decisions[player_idx]
+                if player_decision not in player_viable:
+                    return None, pending
+                elif player_decision == decision:
+                    return [(player_idx, decision)], []
+
+    return None, []
+
+
 def score(context, match_results):
     return scoring.score(context.settings.scorer, match_results,
                          context.settings.patterns_score)
 
 
+def score_table(context, player_idx=None):
+    '''
+    Return the scores of every tile that a ready player is waiting for, e.g.,
+    for hints or for bots to choose between waits.
+
+    The returned value is a dictionary whose keys are the waiting tiles and
+    values are dictionaries of chucker index -> (match results, score), where
+    the match results are from patterns.match_all() and the score is from
+    algo.score(). Chucker index None means the tile is self-picked.
+
+    The table is cached on the player until the hand, the settings or anything
+    else that patterns depend on changes, and EndHandler reads the actual win
+    from it. Don't modify the returned value.
+
+    '''
+    player_idx = _get_player_index(context, player_idx)
+    player = context.players[player_idx]
+    key = _score_table_key(context, player_idx)
+    cached = player._cache.get('score_table')
+    if cached and cached[0] == key:
+        return cached[1]
+
+    table = {}
+    sandbox = context.clone()
+    sandbox.players[player_idx].hand.last_tile = None
+    for tile in waiting_tiles(context, player_idx):
+        # flower wins are not decided by the waiting tile
+        if tile.is_general_flower():
+            continue
+        table[tile] = _score_waiting_tile(sandbox, player_idx, tile)
+
+    player._cache['score_table'] = (key, table)
+    return table
+
+
+def discard_values(context, player_idx=None):
+    '''
+    Rank the tiles that a player can discard at 'discarding' state, e.g., for
+    hints or for bots.
+
+    For each candidate, the hand after discarding it is checked for waiting
+    tiles. Each waiting tile is counted in the copies the player hasn't seen
+    (in neither the player's hand, the discarded pool nor exposed groups), and
+    scored with patterns.match_all() and algo.score(). Its points are the
+    average of winning it self-picked and on a discard by each other player.
+
+    Return a list of (tile, expected value, waits) sorted from the best, where
+    waits is a dictionary of waiting tile -> (unseen copies, points), and the
+    expected value is the points won per unseen tile, i.e.,
+    sum(unseen copies x points) / number of unseen tiles. Ties are broken by
+    the number of unseen waiting tiles.
+
+    The result is cached on the player until the hand, the settings or the
+    tiles seen change. Don't modify it.
+
+    '''
+    player_idx = _get_player_index(context, player_idx)
+    player = context.players[player_idx]
+    hand = player.hand
+    key = (_score_table_key(context, player_idx), hand.last_tile,
+           tuple(context.discarded_pool),
+           tuple([len(p.hand.fixed_groups) for p in context.players]))
+    cached = player._cache.get('discard_values')
+    if cached and cached[0] == key:
+        return cached[1]
+
+    unseen = _unseen_counts(context, player_idx)
+    num_unseen = sum(unseen.itervalues())
+
+    tiles = list(hand.free_tiles)
+    if hand.last_tile:
+        bisect.insort(tiles, hand.last_tile)
+
+    # one sandbox for all the candidates
+    sandbox = context.clone()
+    sandbox_player = sandbox.players[player_idx]
+    sandbox_player._cache.pop('score_table', None)
+    sandbox_hand = sandbox_player.hand
+    sandbox_hand.last_tile = None
+
+    result = []
+    for tile in sorted(set(tiles)):
+        free_tiles = list(tiles)
+        free_tiles.remove(tile)
+        sandbox_hand.free_tiles = free_tiles
+        sandbox_player.discarded.append(tile)
+        sandbox.discarded_pool.append(tile)
+
+        waits = {}
+        total = 0.0
+        for waiting_tile in sandbox_hand.waits():
+            if not can_win(sandbox, player_idx, waiting_tile):
+                continue
+            scores = _score_waiting_tile(sandbox, player_idx, waiting_tile)
+            points = float(sum([sum(score) for __, score in scores.itervalues()])) / len(scores)
+            waits[waiting_tile] = (unseen.get(waiting_tile, 0), points)
+            total += unseen.get(waiting_tile, 0) * points
+
+        sandbox.discarded_pool.pop()
+        sandbox_player.discarded.pop()
+        result.append((tile, total / num_unseen if num_unseen else 0.0, waits))
+
+    result.sort(key=lambda item: (-item[1], -sum([n for n, __ in item[2].itervalues()]), item[0]))
+    player._cache['discard_values'] = (key, result)
+    return result
+
+
+def cached_score(context, player_idx=None):
+    '''
+    Look up the actual win of a player in the table built by score_table().
+    Return a tuple of (match results, score), or None if the table isn't
+    available or is out of date. The match results are copies, so they can
+    be modified freely.
+
+    '''
+    player_idx = _get_player_index(context, player_idx)
+    player = context.players[player_idx]
+    cached = player._cache.get('score_table')
+    if not cached:
+        return None
+
+    win_type = player.extra.get('win_type')
+    if win_type == 'self-picked':
+        tile = player.hand.last_tile
+        chucker_idx = None
+    elif win_type == 'melded':
+        tile = context.last_discarded()
+        chucker_idx = player.extra.get('chucker')
+    else:
+        return None
+
+    if not tile or cached[0] != _score_table_key(context, player_idx, chucker_idx):
+        return None
+
+    entry = cached[1].get(tile, {}).get(chucker_idx)
+    if entry is None:
+        return None
+    match_results, points = entry
+    return _copy_scores(match_results), list(points)
+
+
 def can_4_kong_win(context, player_idx, tile):
     '''
     'Four-kongs' is a special scenario because we need to display 'win'
@@ -190,7 +399,7 @@ def can_4_kong_win(context, player_idx, tile):
     this function to determine if should list 'kong' in the viable decisions.
 
     '''
-    if 'four-kongs' in context.settings.patterns_win:
+    if 'four-kongs' in context.settings.patterns_win_set:
         if patterns.match('four-kongs', context, player_idx, tile):
             return True
     return False
@@ -247,6 +456,112 @@ def _get_incoming_tile(context, player_idx, tile=None):
     return tile
 
 
+def _match_and_score(context, player_idx):
+    match_results = patterns.match_all(context, player_idx)
+    return match_results, score(context, match_results)
+
+
+def _score_waiting_tile(sandbox, player_idx, tile):
+    '''
+    Score a player winning a tile self-picked and on a discard by each of the
+    other players. Return a dictionary of chucker index (None if self-picked)
+    -> (match results, score). The sandbox context is modified during the
+    process but is restored afterwards.
+
+    '''
+    scores = {}
+    winner = sandbox.players[player_idx]
+
+    # self-picked
+    winner.hand.last_tile = tile
+    winner.extra['win_type'] = 'self-picked'
+    winner.extra.pop('chucker', None)
+    scores[None] = _match_and_score(sandbox, player_idx)
+    winner.hand.last_tile = None
+
+    # discarded by one of the other players
+    winner.extra['win_type'] = 'melded'
+    for i in xrange(1, 4):
+        chucker_idx = (player_idx + i) % 4
+        chucker = sandbox.players[chucker_idx]
+        chucker.discarded.append(tile)
+        sandbox.discarded_pool.append(tile)
+        winner.extra['chucker'] = chucker_idx
+        scores[chucker_idx] = _match_and_score(sandbox, player_idx)
+        sandbox.discarded_pool.pop()
+        chucker.discarded.pop()
+
+    winner.extra.pop('win_type', None)
+    winner.extra.pop('chucker', None)
+    return scores
+
+
+def _unseen_counts(context, player_idx):
+    '''
+    Return a dictionary of tile -> number of copies that a player can't see,
+    i.e., not in the player's hand, the discarded pool, or the groups other
+    players exposed.
+
+    '''
+    seen = list(context.discarded_pool)
+    for i, player in enumerate(context.players):
+        hand = player.hand
+        if i == player_idx:
+            seen += hand.free_tiles
+            if hand.last_tile:
+                seen.append(hand.last_tile)
+        for group in hand.fixed_groups:
+            if i == player_idx or group.group_type != TileGroup.KONG_CONCEALED:
+                seen += group.tiles
+
+    result = {}
+    for tile in Tile.ALL.itervalues():
+        if not tile.is_general_flower():
+            result[tile] = 4
+    for tile in seen:
+        if tile in result:
+            result[tile] -= 1
+    return result
+
+
+def _score_table_key(context, player_idx, chucker_idx=None):
+    '''
+    Return everything that patterns and scores depend on besides the winning
+    tile and the win type, so a cached score table can be checked against the
+    context. Settings are keyed by fingerprint, which catches changes made in
+    place, e.g., to ``settings.patterns_score``.
+    If chucker_idx is given, the last discarded tile is the winning tile, and
+    it's left out.
+
+    '''
+    player = context.players[player_idx]
+    hand = player.hand
+    num_discarded = [len(p.discarded) for p in context.players]
+    pool_size = len(context.discarded_pool)
+    if chucker_idx is not None:
+        num_discarded[chucker_idx] -= 1
+        pool_size -= 1
+
+    last_tile_in_wall = context.wall is not None and context.is_tie(
+        cur_state=False, four_waiting=False, four_kongs=False, four_winds=False)
+
+    return (tuple(hand.free_tiles),
+            tuple([(group.group_type, tuple(group.tiles)) for group in hand.fixed_groups]),
+            tuple(hand.flowers),
+            tuple([n > 0 for n in num_discarded]),
+            pool_size > 0,
+            last_tile_in_wall,
+            bool(player.extra.get('konged')),
+            bool(player.extra.get('flowered')),
+            bool(player.extra.get('declared_ready')),
+            bool(player.extra.get('immediate_ready')),
+            context.extra.get('flower_chucker'),
+            context.dealer,
+            context.dealer_defended,
+            context.round,
+            context.settings.fingerprint())
+
+
 def _copy_scores(scores):
     result = {}
     for name, match_result in scores.iteritems():
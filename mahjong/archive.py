@@ -0,0 +1,186 @@
+'''
+Archive winning hands and re-score them under other GameSettings.
+
+A win is archived as a record of everything patterns look at: hands, fixed
+groups, flowers, discards, win metadata, dealer state and the number of
+tiles left in the wall. No pattern results are stored, so the same archive
+can be re-scored after changing ``patterns_score``, ``patterns_win_filter``
+or the pattern table.
+
+Archives are files of JSON records, one per line. Results are written one
+line per win: ``<index>\t<S0> <S1> <S2> <S3>\t<pattern names>``, where Si is
+``algo.score()`` of player i and pattern names are separated by commas.
+
+'''
+import json
+import multiprocessing
+
+from collections import Counter
+
+from mahjong import algo, patterns
+from mahjong.types import FrozenSettings, GameContext, Tile, TileGroup, Wall
+
+
+# Player.extra keys that patterns look at
+_PLAYER_FLAGS = ('win_type', 'chucker', 'konged', 'flowered', 'declared_ready',
+                 'immediate_ready')
+
+
+def record_win(context, player_idx):
+    '''
+    Return the record of a win as a JSON-serializable dictionary. Call it at
+    'end' state, before the hands are cleared.
+
+    '''
+    players = []
+    for player in context.players:
+        hand = player.hand
+        extra = {}
+        for key in _PLAYER_FLAGS:
+            if player.extra.get(key) is not None:
+                extra[key] = player.extra[key]
+        players.append({
+            'free': _encode(hand.free_tiles),
+            'fixed': [[group.group_type, _encode(group.tiles)] for group in hand.fixed_groups],
+            'flowers': _encode(hand.flowers),
+            'last_tile': hand.last_tile.tile_id if hand.last_tile else None,
+            'discarded': _encode(player.discarded),
+            'extra': extra
+        })
+    return {
+        'winner': player_idx,
+        'players': players,
+        'pool': _encode(context.discarded_pool),
+        'wall': context.wall.num_tiles() if context.wall else None,
+        'round': context.round,
+        'match': context.match,
+        'dealer': context.dealer,
+        'dealer_defended': context.dealer_defended,
+        'flower_chucker': context.extra.get('flower_chucker')
+    }
+
+
+def restore(record, settings=None):
+    '''
+    Rebuild a GameContext from a record. Return a tuple of (context, winner
+    index). The context is only good for matching and scoring; the wall has
+    the right number of tiles but not the actual tiles.
+
+    '''
+    context = GameContext(settings)
+    context.state = 'end'
+    for player, data in zip(context.players, record['players']):
+        hand = player.hand
+        hand.free_tiles = _decode(data['free'])
+        hand.fixed_groups = [TileGroup(_decode(tiles), group_type)
+                             for group_type, tiles in data['fixed']]
+        hand.flowers = _decode(data['flowers'])
+        if data['last_tile'] is not None:
+            hand.last_tile = Tile.ALL[data['last_tile']]
+        player.discarded = _decode(data['discarded'])
+        player.extra.update(data['extra'])
+
+    context.discarded_pool = _decode(record['pool'])
+    if record['wall'] is not None:
+        context.wall = Wall(chars=False, circles=False, bamboos=False, honors=False, flowers=False)
+        context.wall.tiles = [None] * record['wall']
+    context.round = record['round']
+    context.match = record['match']
+    context.dealer = record['dealer']
+    context.dealer_defended = record['dealer_defended']
+    if record['flower_chucker'] is not None:
+        context.extra['flower_chucker'] = record['flower_chucker']
+
+    winner_idx = record['winner']
+    context.winners = [winner_idx]
+    return context, winner_idx
+
+
+def rescore(record, settings):
+    '''Return a tuple of (match results, score) of a record under settings.'''
+    context, winner_idx = restore(record, settings)
+    match_results = patterns.match_all(context, winner_idx)
+    return match_results, algo.score(context, match_results)
+
+
+def write_records(fileobj, records):
+    for record in records:
+        fileobj.write(json.dumps(record, separators=(',', ':')))
+        fileobj.write('\n')
+
+
+def read_records(fileobj):
+    for line in fileobj:
+        if line.strip():
+            yield json.loads(line)
+
+
+def rescore_file(archive_path, result_path, settings, processes=None, chunksize=500):
+    '''
+    Re-score every record in an archive file under settings with a process
+    pool, and stream the results to result_path in archive order. Return the
+    number of records.
+
+    Patterns added at runtime with ``patterns.register()`` are available to
+    the workers only if the platform forks (e.g., Linux).
+
+    '''
+    pool = multiprocessing.Pool(processes, _init_worker, (settings._attrs,))
+    count = 0
+    try:
+        with open(archive_path) as archive, open(result_path, 'w') as result_file:
+            lines = (line for line in archive if line.strip())
+            for line in pool.imap(_rescore_line, lines, chunksize):
+                result_file.write('%d\t%s' % (count, line))
+                count += 1
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return count
+
+
+def read_results(fileobj):
+    '''Yield tuples of (index, score, pattern names) from a result file.'''
+    for line in fileobj:
+        idx, score, names = line.rstrip('\n').split('\t')
+        yield (int(idx), [int(s) for s in score.split()],
+               names.split(',') if names else [])
+
+
+def score_distribution(results):
+    '''
+    Return a Counter of total points won -> number of wins, e.g., to compare
+    two result files before and after a rule change.
+
+    '''
+    return Counter(sum(score) for __, score, __ in results)
+
+
+def _format_result(match_results, score):
+    return '%s\t%s\n' % (' '.join([str(s) for s in score]),
+                         ','.join(sorted(match_results)))
+
+
+# FrozenSettings of a worker process, set by _init_worker()
+_worker_settings = None
+
+
+def _init_worker(attrs):
+    global _worker_settings
+    _worker_settings = FrozenSettings(attrs)
+
+
+def _rescore_line(line):
+    match_results, score = rescore(json.loads(line), _worker_settings)
+    return _format_result(match_results, score)
+
+
+def _encode(tiles):
+    return [tile.tile_id for tile in tiles]
+
+
+def _decode(tile_ids):
+    return [Tile.ALL[tile_id] for tile_id in tile_ids]
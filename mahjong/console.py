@@ -12,18 +12,17 @@ def run(seed=1):
     context = GameContext()
     context.wall = Wall()
 
-    while True:
-        if context.state == 'start':
-            context.players[0].extra['bot'] = True
-            context.players[1].extra['bot'] = True
-            context.players[2].extra['bot'] = True
-
-        result = flow.next(context)
-        if result:
-            _print_context(context)
-        elif result.reason == 'decisions-needed':
-            if result.viable_decisions and context.state != 'discarding':
-                print 'Viable decisions: %s' % result.viable_decisions[3]
+    # bot mode lasts across matches
+    context.players[0].extra['bot'] = True
+    context.players[1].extra['bot'] = True
+    context.players[2].extra['bot'] = True
+
+    for event in flow.stream(context):
+        if not isinstance(event, flow.Blocked):
+            _print_event(event)
+        elif event.reason == 'decisions-needed':
+            if event.viable_decisions and context.state != 'discarding':
+                print 'Viable decisions: %s' % event.viable_decisions[3]
             for i in xrange(0, 4):
                 print 'P%d: %s' % (i, context.players[i].hand)
             decision = raw_input('Decision: ')
@@ -38,77 +37,60 @@ def run(seed=1):
                 context.players[3].decision = decision
         else:
             print context.state
-            raise Exception(result.reason)
+            raise Exception(event.reason)
 
 
-def _print_context(context):
-    name = context.state.replace('-', '_')
-    func = globals()['_print_' + name]
-    func(context)
+def _print_event(event):
+    func = globals()['_print_' + type(event).__name__.lower()]
+    func(event)
 
 
-def _print_start(context):
+def _print_started(event):
     print '----------------------------------------------------'
     print 'Start'
-    print '  => Round: %d' % context.round
-    print '     Match: %d' % context.match
-    print '     Dealer: P%s (%d defended)' % (context.dealer, context.dealer_defended)
+    print '  => Round: %d' % event.round
+    print '     Match: %d' % event.match
+    print '     Dealer: P%s (%d defended)' % (event.dealer, event.dealer_defended)
 
 
-def _print_wall_built(context):
-    print 'Wall built'
-
-
-def _print_dealt(context):
+def _print_dealt(event):
     print 'Dealt'
+    print '  => %s left in the wall' % event.num_tiles_left
 
 
-def _print_drawing(context):
-    print '----------------------------------------------------'
-
-
-def _print_drawn(context):
-    print 'P%d has drawn a %s' % (context.cur_player_idx, context.player().hand.last_tile)
-    print '  => %s left in the wall' % context.wall.num_tiles()
+def _print_flowered(event):
+    print 'P%d got a flower %s' % (event.player, event.tile)
 
 
-def _print_discarding(context):
-    print 'P%d is discarding...' % context.cur_player_idx
+def _print_drawn(event):
+    print '----------------------------------------------------'
+    print 'P%d has drawn a %s' % (event.player, event.tile)
 
 
-def _print_discarded(context):
-    print 'P%d discarded a %s' % (context.cur_player_idx, context.last_discarded())
-    print '  => Discarded pool: %s' % context.discarded_pool
+def _print_discarded(event):
+    print 'P%d discarded a %s' % (event.player, event.tile)
 
 
-def _print_melding(context):
-    print 'Melding time! Last discarded: %s' % (context.last_discarded())
+def _print_declared(event):
+    print 'P%d declared ready, waiting for %s' % (event.player, event.waiting_tiles)
 
 
-def _print_chowing(context):
-    print 'chowing...'
+def _print_melded(event):
+    print 'P%d melded %s' % (event.player, event.group)
 
 
-def _print_self_konging(context):
-    print 'self konging...'
+def _print_won(event):
+    print 'End, winners:'
+    for i in event.players:
+        print '  => P%d (%s)' % (i, event.type)
 
 
-def _print_end(context):
-    if context.winners:
-        print 'End, winners:'
-        for i in context.winners:
-            winner = context.players[i]
-            print '  => P%d (%s)' % (i, winner.extra.get('win_type'))
-    else:
-        print 'End: tie (%s)' % context.extra.get('tie_type')
+def _print_tied(event):
+    print 'End: tie (%s)' % event.type
 
 
-def _print_scored(context):
+def _print_scored(event):
     print 'Scored'
-    if context.winners:
-        for i in context.winners:
-            winner = context.players[i]
-            scoring_table = winner.extra.get('scoring')
-            print 'P%d' % i
-            for pattern_name, match_result in scoring_table.iteritems():
-                print '  %s: %s' % (pattern_name, match_result)
+    if event.points:
+        for i, points in enumerate(event.points):
+            print '  P%d: %+d' % (i, points)
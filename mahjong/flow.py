@@ -1,21 +1,319 @@
 '''
-The flow module has only one public function: ``flow.next()``. You should
-**NOT** have to use other classes or functions in this module because those
-are meant to be private.
+The flow module's main public function is ``flow.next()``. You should
+**NOT** have to use other classes or functions in this module besides
+``flow.run_until()`` and its stop conditions, ``flow.stream()`` and its
+events, ``flow.precompute_reactions()``, and the observer API
+(``flow.add_observer()``, ``flow.Observer``, ``flow.TimingCollector``).
+The rest is private.
 
 ``flow.next()`` is the implementation of the game logic. It transits a
-GameContext from a state to another.
+GameContext from a state to another. ``flow.run_until()`` calls it until
+input is needed or a stop condition is met, and ``flow.stream()`` does the
+same but yields an event (e.g., ``Drawn``, ``Discarded``, ``Melded``) for
+everything that happens along the way.
 
 '''
+import bisect
+import json
+import random
+import timeit
+
+from collections import namedtuple
+
 from mahjong import algo, patterns
 from mahjong.types import Tile, TileGroup
 
 
-def next(context):
+def next(context, trusted=None):
+    '''
+    Take a GameContext to the next state. Return a FlowResult.
+
+    If ``trusted`` is True (default: ``GameSettings.trusted``), the context is
+    assumed to be valid, e.g., it only has been driven by this module, so the
+    integrity checks (``Handler.check()``) are skipped. Players' decisions are
+    still gathered and checked. A ``GameSettings.validate_sample_rate``
+    fraction of matches are fully checked anyway.
+
+    '''
     handler = _STATE_ROUTES.get(context.state)
     if not handler:
         raise ValueError('Illegal game state: `%s`' % context.state)
-    return handler.handle(context)
+    if trusted is None:
+        trusted = context.settings.trusted
+    if trusted and context.extra.get('full_validation'):
+        trusted = False
+    return handler.handle(context, trusted)
+
+
+def run_until(context, stop=None, results=None, max_steps=None, trusted=None, freeze=False):
+    '''
+    Call ``next()`` repeatedly until one of these happens:
+    * A transition fails, e.g., players need to make decisions.
+    * ``stop`` is met after a transition. It can be a state name, a
+      collection of state names, or a function that takes the context and
+      returns True to stop. See also ``after_matches()`` and
+      ``at_round()``.
+    * ``max_steps`` transitions have been made.
+
+    Without ``stop`` and ``max_steps``, a table of bots would never need
+    input, so it also stops when a match is about to start and all players
+    are bots (``player.extra['bot']``).
+
+    Return the last FlowResult. If ``results`` is a list, every FlowResult is
+    appended to it. ``trusted`` is passed to ``next()``. If it's None, only
+    the first transition is left to ``GameSettings.trusted``; the context is
+    valid by construction after that, so the others are trusted.
+
+    If ``freeze`` is True, ``context.settings`` is replaced with a
+    FrozenSettings first (see ``GameSettings.freeze()``), which is faster to
+    read. Later changes to the old GameSettings don't reach the context.
+
+    '''
+    if freeze:
+        context.settings = context.settings.freeze()
+    should_stop = _stop_condition(stop)
+    if should_stop is None and max_steps is None:
+        should_stop = _all_bots_at_start
+    steps = 0
+    while True:
+        result = next(context, trusted)
+        steps += 1
+        if results is not None:
+            results.append(result)
+        if not result:
+            return result
+        if trusted is None:
+            trusted = True
+        if should_stop and should_stop(context):
+            return result
+        if max_steps is not None and steps >= max_steps:
+            return result
+
+
+def stream(context, stop=None, max_steps=None, trusted=None, freeze=False):
+    '''
+    A generator that takes the context through transitions like
+    ``run_until()`` does, and yields the events of each transition as they
+    happen, so consumers don't have to diff contexts to find out what
+    happened.
+
+    When a transition fails, it yields a ``Blocked`` event. On
+    'decisions-needed', set the players' decisions and keep iterating to
+    retry; on other reasons the stream ends. The stream also ends when
+    ``stop`` is met or after ``max_steps`` transitions. Without them, a
+    stream of a table of bots goes on until the consumer stops iterating.
+    ``freeze`` is the same as in ``run_until()``.
+
+    Example::
+
+        for event in flow.stream(context, flow.after_matches(1)):
+            if isinstance(event, flow.Blocked):
+                context.players[3].decision = ask(event.viable_decisions[3])
+            else:
+                print event
+
+    '''
+    if freeze:
+        context.settings = context.settings.freeze()
+    should_stop = _stop_condition(stop)
+    sink = add_observer(context, _EventSink())
+    try:
+        steps = 0
+        while True:
+            result = next(context, trusted)
+            steps += 1
+            for event in sink.drain():
+                yield event
+            if not result:
+                yield Blocked(result.reason, result.viable_decisions)
+                if result.reason != 'decisions-needed':
+                    return
+            elif should_stop and should_stop(context):
+                return
+            if max_steps is not None and steps >= max_steps:
+                return
+    finally:
+        remove_observer(context, sink)
+
+
+def _stop_condition(stop):
+    if stop is None:
+        return None
+    if isinstance(stop, _AfterMatches):
+        # counts from the start of each run
+        return stop.new_count()
+    if isinstance(stop, basestring):
+        return lambda context: context.state == stop
+    if callable(stop):
+        return stop
+    states = frozenset(stop)
+    return lambda context: context.state in states
+
+
+def _all_bots_at_start(context):
+    if context.state != 'start':
+        return False
+    for player in context.players:
+        if not player.extra.get('bot'):
+            return False
+    return True
+
+
+def after_matches(num_matches=1):
+    '''
+    Return a ``run_until()`` / ``stream()`` stop condition that is met when
+    num_matches matches have been scored since the run started, i.e., a
+    match is about to start for the num_matches-th time. Each run counts
+    from zero, so the condition can be reused across runs and contexts.
+
+    '''
+    return _AfterMatches(num_matches)
+
+
+class _AfterMatches(object):
+
+    def __init__(self, num_matches):
+        self.num_matches = num_matches
+
+    def new_count(self):
+        # a condition that counts the matches from now on, 'start' is only
+        # reached from 'scored'
+        num_matches = self.num_matches
+        count = [0]
+
+        def should_stop(context):
+            if context.state == 'start':
+                count[0] += 1
+            return count[0] >= num_matches
+        return should_stop
+
+
+def at_round(round):
+    '''
+    Return a ``run_until()`` stop condition that is met when a match of the
+    given round (or a later one) is about to start.
+
+    '''
+    return lambda context: context.state == 'start' and context.round >= round
+
+
+def precompute_reactions(context):
+    '''
+    At 'discarding' state, compute what happens after each tile the current
+    player could discard: if the player is ready, and the viable decisions
+    of the other players. The table is stored in
+    ``context.extra['reactions']``, and the 'discarded' state then looks it
+    up instead of computing it.
+
+    It works on clones of the context, so it can be run in another thread
+    while waiting for the player to discard, e.g.::
+
+        thread = threading.Thread(target=flow.precompute_reactions, args=(context,))
+        thread.start()
+        # ... wait for player's decision ...
+        thread.join()
+        flow.next(context)
+
+    Make sure it's done before calling ``flow.next()``. A table which
+    doesn't match the context is ignored.
+
+    '''
+    if context.state != 'discarding':
+        return
+
+    player = context.player()
+    hand = player.hand
+    tiles = set(hand.free_tiles)
+    if hand.last_tile:
+        tiles.add(hand.last_tile)
+
+    discarding = _STATE_ROUTES['discarding']
+    discarded = _STATE_ROUTES['discarded']
+    reactions = {}
+    for tile in tiles:
+        # a clone has no observers, so they see what the player discards,
+        # not what the player might
+        sandbox = context.clone()
+        sandbox.extra.pop('reactions', None)
+        sandbox.player().decision = tile
+        discarding.next(sandbox)
+
+        sandbox_player = sandbox.player()
+        ready = None
+        if sandbox.settings.declarable and not sandbox_player.extra.get('asked'):
+            ready = algo.ready(sandbox)
+        reactions[tile] = (_reaction_key(sandbox), ready,
+                           discarded._get_viable_decisions(sandbox))
+    context.extra['reactions'] = reactions
+
+
+def _reaction_key(context):
+    # identifies the turn after a discard
+    return (context.match, context.cur_player_idx, len(context.discarded_pool),
+            context.wall.num_tiles() if context.wall else None,
+            len(context.player().hand.free_tiles))
+
+
+def _get_reaction(context):
+    '''Return (ready, viable decisions) of the last discard if precomputed.'''
+    reactions = context.extra.get('reactions')
+    if reactions:
+        reaction = reactions.get(context.last_discarded())
+        if reaction and reaction[0] == _reaction_key(context):
+            return reaction[1:]
+    return None
+
+
+def _select_melders(context, viable_decisions, player_decisions):
+    '''
+    Select melders from players' decisions. Return a tuple of (melders,
+    FlowResult). The FlowResult is None unless decisions are needed.
+
+    With ``GameSettings.parallel_decisions`` off, all viable decisions are
+    returned until the top-priority undecided player decides. With it on,
+    the FlowResult only has the viable decisions of players who can still
+    decide, and the melders are selected as soon as the outcome is
+    determined.
+
+    '''
+    if context.settings.parallel_decisions:
+        melders, pending = algo.resolve_melders(viable_decisions, player_decisions,
+                                                multi_winners=context.settings.multi_winners)
+        if pending:
+            result = FlowResult(False, 'decisions-needed')
+            for player_idx in pending:
+                result.set_viable_decisions(player_idx, viable_decisions[player_idx])
+            return None, result
+        return melders, None
+
+    melders = algo.select_melders(viable_decisions, player_decisions)
+    if melders and not melders[0][1]:
+        return None, FlowResult(False, 'decisions-needed', viable_decisions)
+    return melders, None
+
+
+# Events
+#--------
+# yielded by stream() and passed to Observer.on_event(), player fields are indices
+Started = namedtuple('Started', 'round match dealer dealer_defended')
+Dealt = namedtuple('Dealt', 'num_tiles_left')
+Drawn = namedtuple('Drawn', 'player tile')
+Flowered = namedtuple('Flowered', 'player tile')
+Discarded = namedtuple('Discarded', 'player tile')
+Declared = namedtuple('Declared', 'player waiting_tiles')
+Melded = namedtuple('Melded', 'player group')
+Won = namedtuple('Won', 'players type')
+Tied = namedtuple('Tied', 'type')
+Scored = namedtuple('Scored', 'points')
+Blocked = namedtuple('Blocked', 'reason viable_decisions')
+
+
+def _emit(context, event_type, *args):
+    # events are only built if someone is listening
+    if context._observers:
+        event = event_type(*args)
+        for observer in tuple(context._observers):
+            observer.on_event(context, event)
 
 
 class FlowResult(object):
@@ -54,17 +352,58 @@ class Handler(object):
     Abstract superclass for all the handlers in this module.
 
     '''
-    def handle(self, context):
-        result = self.validate(context)
+    def handle(self, context, trusted=False):
+        if context._observers:
+            return self._handle_observed(context, trusted)
+        if not trusted:
+            result = self.check(context)
+            if not result:
+                return result
+        result = self.validate(context, trusted)
         if not result:
             return result
         self.next(context)
         return result
 
-    def validate(self, context):
+    def _handle_observed(self, context, trusted):
+        observers = tuple(context._observers)
+        state = context.state
+        for observer in observers:
+            observer.before_validate(state, context)
+        result = FlowResult(True)
+        if not trusted:
+            result = self.check(context)
+        if result:
+            result = self.validate(context, trusted)
+        for observer in observers:
+            observer.after_validate(state, context, result)
+        if result:
+            for observer in observers:
+                observer.before_next(state, context)
+            self.next(context)
+            for observer in observers:
+                observer.after_next(state, context)
+        for observer in observers:
+            observer.on_result(state, context, result)
+        return result
+
+    def check(self, context):
+        '''
+        Return a FlowResult indicating if a GameContext is consistent with the
+        current state. It's skipped in trusted mode, so it shouldn't do
+        anything but checking.
+
+        Override this method if necessary.
+
+        '''
+        return FlowResult(True)
+
+    def validate(self, context, trusted=False):
         '''
         Return a FlowResult indicating if a GameContext can be taken to the
-        next state.
+        next state, e.g., if players have made their decisions. If trusted,
+        it may reuse what earlier transitions found out instead of computing
+        it again.
 
         Override this method if necessary. The input GameContext should remain
         intact if this method returns a failed FlowResult.
@@ -90,10 +429,11 @@ class StartHandler(Handler):
     Outgoing state: 'wall-built'.
 
     StartHandler takes a game context from 'start' to 'wall-built'. All it
-    does is reset and shuffle the wall.
+    does is reset and shuffle the wall, and pick the match for full validation
+    in trusted mode.
 
     '''
-    def validate(self, context):
+    def check(self, context):
         if not context.wall:
             return FlowResult(False, 'bad-context')
         return FlowResult(True)
@@ -103,6 +443,12 @@ class StartHandler(Handler):
         context.wall.reset()
         context.wall.shuffle()
         context.state = 'wall-built'
+        _emit(context, Started, context.round, context.match, context.dealer,
+              context.dealer_defended)
+
+        sample_rate = context.settings.validate_sample_rate
+        if sample_rate and random.random() < sample_rate:
+            context.extra['full_validation'] = True
 
 
 class WallBuiltHandler(Handler):
@@ -115,7 +461,7 @@ class WallBuiltHandler(Handler):
     Once the wall is built, WallBuiltHandler deals the tiles to each player.
 
     '''
-    def validate(self, context):
+    def check(self, context):
         if context.wall.num_tiles() == context.settings.total_tiles():
             return FlowResult(True)
         return FlowResult(False, 'bad-context')
@@ -132,6 +478,7 @@ class WallBuiltHandler(Handler):
                 hand.add_free_tile(tile)
 
         context.state = 'dealt'
+        _emit(context, Dealt, context.wall.num_tiles())
 
 
 class DealtHandler(Handler):
@@ -145,9 +492,8 @@ class DealtHandler(Handler):
     drawing more tiles from the wall.
 
     '''
-    def validate(self, context):
-        num_tiles_left = context.settings.total_tiles() - context.settings.num_hand_tiles * 4
-        if context.wall.num_tiles() == num_tiles_left:
+    def check(self, context):
+        if context.wall.num_tiles() == context.settings.tiles_after_dealing():
             return FlowResult(True)
         return FlowResult(False, 'bad-context')
 
@@ -158,9 +504,12 @@ class DealtHandler(Handler):
             counter = 1
             while counter:
                 counter = 0
-                for player in context.players:
+                for player_idx, player in enumerate(context.players):
                     hand = player.hand
+                    num_flowers = len(hand.flowers)
                     hand.move_flowers()
+                    for flower in hand.flowers[num_flowers:]:
+                        _emit(context, Flowered, player_idx, flower)
                     # draw until each has num_hand_tiles tiles
                     while len(hand.free_tiles) < num_hand_tiles:
                         tile = context.wall.draw()
@@ -180,17 +529,20 @@ class DrawingHandler(Handler):
     2. 'drawn' otherwise.
 
     '''
-    def validate(self, context):
+    def check(self, context):
         player = context.player()
         hand = player.hand
         if hand.last_tile:
             return FlowResult(False, 'bad-context')
+        if player.extra.get('flowered') and not hand.flowers:
+            return FlowResult(False, 'bad-context')
+        return FlowResult(True)
+
+    def validate(self, context, trusted=False):
+        player = context.player()
 
         # if the player just drew a flower
         if player.extra.get('flowered'):
-            if not hand.flowers:
-                return FlowResult(False, 'bad-context')
-
             # if there's someone who can win with the flower,
             # wait until he makes the decision
             robber_idx, chucker_idx = self._player_who_can_flower_win(context)
@@ -240,14 +592,16 @@ class DrawingHandler(Handler):
                 context.set_turn(robber_idx)
 
         # draw a tile from the wall
-        context.player().hand.last_tile = context.wall.draw()
+        tile = context.wall.draw()
+        context.player().hand.last_tile = tile
         context.state = 'drawn'
+        _emit(context, Drawn, context.cur_player_idx, tile)
 
         self._cleanup(context)
 
     def _player_who_can_flower_win(self, context):
         '''Return a tuple of (robber index, index of player who got robbed).'''
-        if 'seven-flowers' in context.settings.patterns_win:
+        if 'seven-flowers' in context.settings.patterns_win_set:
             # check if someone ELSE can rob this player's flower
             player = context.player()
             num_flowers = len(player.hand.flowers)
@@ -301,12 +655,15 @@ class DrawnHandler(Handler):
     4. 'discarding' otherwise.
 
     '''
-    def validate(self, context):
-        player = context.player()
-        hand = player.hand
+    def check(self, context):
+        hand = context.player().hand
         if not (hand and hand.last_tile):
             return FlowResult(False, 'bad-context')
+        return FlowResult(True)
 
+    def validate(self, context, trusted=False):
+        player = context.player()
+        hand = player.hand
         if hand.last_tile.is_general_flower():
             return FlowResult(True)
 
@@ -330,7 +687,7 @@ class DrawnHandler(Handler):
 
         # can win but doesn't want to win -> water penalty
         if context.settings.water and decision != 'win' and 'win' in viable_decisions:
-            player.extra['water'] = algo.waiting_tiles(context)
+            player.extra['water'] = algo.waiting_tiles(context, trusted=trusted)
 
         # player decision is valid
         player.extra['viable_decisions'] = viable_decisions
@@ -341,8 +698,10 @@ class DrawnHandler(Handler):
         hand = player.hand
         if hand.last_tile.is_general_flower():
             # if player drew a flower, go back to 'drawing'
+            flower = hand.last_tile
             hand.move_flowers()
             context.state = 'drawing'
+            _emit(context, Flowered, context.cur_player_idx, flower)
 
             # for DrawingHandler to check for seven-flowers
             player.extra['flowered'] = True
@@ -444,12 +803,13 @@ class SelfKongingHandler(Handler):
     2. 'drawing' otherwise.
 
     '''
-    def validate(self, context):
-        player = context.player()
-        hand = player.hand
-        if not hand.last_tile:
+    def check(self, context):
+        if not context.player().hand.last_tile:
             return FlowResult(False, 'bad-context')
+        return FlowResult(True)
 
+    def validate(self, context, trusted=False):
+        hand = context.player().hand
         kong_type = None
         if hand.can_concealed_kong():
             kong_type = 'concealed'
@@ -463,13 +823,12 @@ class SelfKongingHandler(Handler):
         if kong_type == 'appended':
             viable_decisions = self._get_viable_decisions(context)
             player_decisions = self._get_player_decisions(context, viable_decisions)
-            winners = algo.select_melders(viable_decisions, player_decisions)
+            winners, result = _select_melders(context, viable_decisions, player_decisions)
+            if result is not None:
+                # block until players give valid decisions
+                return result
 
             if winners:
-                invalid_decision = not winners[0][1]
-                if invalid_decision:
-                    # block until player gives a valid decision
-                    return FlowResult(False, 'decisions-needed', viable_decisions)
                 context.extra['winners'] = [x[0] for x in winners]
 
             # check if anyone can win but doesn't want to win -> water penalty
@@ -477,8 +836,8 @@ class SelfKongingHandler(Handler):
                 for i in xrange(0, 4):
                     viable = viable_decisions[i]
                     decision = player_decisions[i]
-                    if viable and 'win' in viable and decision != 'win':
-                        context.players[i].extra['water'] = algo.waiting_tiles(context, i)
+                    if viable and 'win' in viable and decision in viable and decision != 'win':
+                        context.players[i].extra['water'] = algo.waiting_tiles(context, i, trusted)
 
         return FlowResult(True)
 
@@ -509,7 +868,8 @@ class SelfKongingHandler(Handler):
         player = context.player()
         hand = player.hand
         tile_to_kong = hand.last_tile
-        hand.kong_from_self()
+        group = hand.kong_from_self()
+        _emit(context, Melded, context.cur_player_idx, group)
 
         if algo.can_win(context, incoming_tile=tile_to_kong):
             # 4-kong win
@@ -566,7 +926,7 @@ class DiscardingHandler(Handler):
     DiscardingHandler waits for the player to discard a tile in his hand.
 
     '''
-    def validate(self, context):
+    def validate(self, context, trusted=False):
         player = context.player()
         hand = player.hand
 
@@ -586,6 +946,7 @@ class DiscardingHandler(Handler):
         tile = player.decision
         context.discard(tile)
         context.state = 'discarded'
+        _emit(context, Discarded, context.cur_player_idx, tile)
 
         # check if it can remove water penalty
         if context.settings.water:
@@ -611,10 +972,13 @@ class DiscardedHandler(Handler):
     4. 'drawing' if no one can meld the discarded tile.
 
     '''
-    def validate(self, context):
-        player = context.player()
-        if player is None or not context.last_discarded():
+    def check(self, context):
+        if context.player() is None or not context.last_discarded():
             return FlowResult(False, 'bad-context')
+        return FlowResult(True)
+
+    def validate(self, context, trusted=False):
+        player = context.player()
 
         # 4-wind or 4-waiting tie
         if context.is_tie(four_kongs=False, wall_tie=False):
@@ -624,7 +988,8 @@ class DiscardedHandler(Handler):
         # if player has a ready hand, ask player if he wants to declare
         # player.extra['asked'] is a flag indicating 'declare/skip' options have been asked,
         # and player won't be asked again if he answers 'skip'
-        if context.settings.declarable and not player.extra.get('asked') and algo.ready(context):
+        if (context.settings.declarable and not player.extra.get('asked') and
+                self._ready(context, trusted)):
             player.extra['ready'] = True
             viable_decisions = ['declare', 'skip']
             decision = algo.get_decision(context, viable_decisions=viable_decisions)
@@ -653,7 +1018,11 @@ class DiscardedHandler(Handler):
             player.extra['asked'] = True
             return
 
-        viable_decisions = self._get_viable_decisions(context)
+        reaction = _get_reaction(context)
+        if reaction:
+            viable_decisions = reaction[1]
+        else:
+            viable_decisions = self._get_viable_decisions(context)
         someone_can_meld = len(filter(lambda x: bool(x), viable_decisions)) > 0
         if someone_can_meld:
             context.state = 'melding'
@@ -678,20 +1047,30 @@ class DiscardedHandler(Handler):
 
     def _declare_ready(self, context):
         player = context.player()
-        player.extra.update({
-            'declared_ready': True,
-            'waiting_tiles': algo.waiting_tiles(context)
-        })
+        context.declare_ready()
+        player.extra['waiting_tiles'] = algo.waiting_tiles(context)
+        _emit(context, Declared, context.cur_player_idx, player.extra['waiting_tiles'])
 
         # for heaven-ready or earth-ready patterns
         if len(player.discarded) == 1:
             player.extra['immediate_ready'] = True
 
+    def _ready(self, context, trusted):
+        if trusted and context.player().extra.get('ready'):
+            # found out when the player was asked to declare
+            return True
+        reaction = _get_reaction(context)
+        if reaction and reaction[0] is not None:
+            return reaction[0]
+        return algo.ready(context, trusted=trusted)
+
     def _cleanup(self, context):
         player = context.player()
         player.extra.pop('ready', None)
         player.extra.pop('asked', None)
         context.extra.pop('tie', None)
+        if context.state != 'discarded':
+            context.extra.pop('reactions', None)
         for player in context.players:
             player.decision = None
 
@@ -743,7 +1122,7 @@ class MeldingHandler(Handler):
     in ``context.players[i].extra['viable_decisions']``.
 
     '''
-    def validate(self, context):
+    def check(self, context):
         player = context.player()
         if not (player and context.last_discarded()):
             return FlowResult(False, 'bad-context')
@@ -759,14 +1138,19 @@ class MeldingHandler(Handler):
         if no_one_can_meld:
             return FlowResult(False, 'bad-context')
 
+        return FlowResult(True)
+
+    def validate(self, context, trusted=False):
+        viable_decisions = [p.extra.get('viable_decisions') for p in context.players]
+
         # check if players' decisions are valid
         player_decisions = self._get_player_decisions(context)
-        melders = algo.select_melders(viable_decisions, player_decisions)
+        melders, result = _select_melders(context, viable_decisions, player_decisions)
+        if result is not None:
+            # block until players give valid decisions
+            return result
+
         if melders:
-            invalid_decision = not melders[0][1]
-            if invalid_decision:
-                # block until player gives a valid decision
-                return FlowResult(False, 'decisions-needed', viable_decisions)
             context.extra['melders'] = melders
 
         # check if anyone can win and doesn't want to win -> water penalty
@@ -774,8 +1158,8 @@ class MeldingHandler(Handler):
             for i in xrange(0, 4):
                 viable = viable_decisions[i]
                 decision = player_decisions[i]
-                if decision != 'win' and viable and 'win' in viable:
-                    context.players[i].extra['water'] = algo.waiting_tiles(context, i)
+                if decision != 'win' and viable and 'win' in viable and decision in viable:
+                    context.players[i].extra['water'] = algo.waiting_tiles(context, i, trusted)
 
         return FlowResult(True)
 
@@ -853,7 +1237,8 @@ class MeldingHandler(Handler):
         context.state = 'drawing'
         context.set_turn(melder_idx)
         player = context.player()
-        player.hand.kong_from_other(tile)
+        group = player.hand.kong_from_other(tile)
+        _emit(context, Melded, melder_idx, group)
 
         # to identify 'konged-or-flowered' pattern
         player.extra['konged'] = True
@@ -866,7 +1251,8 @@ class MeldingHandler(Handler):
         tile = context.remove_last_discarded()
         context.state = 'discarding'
         context.set_turn(melder_idx)
-        context.player().hand.pong(tile)
+        group = context.player().hand.pong(tile)
+        _emit(context, Melded, melder_idx, group)
 
     def _multi_chow(self, context, chower_idx, chow_combs):
         chower = context.players[chower_idx]
@@ -878,7 +1264,8 @@ class MeldingHandler(Handler):
         tile = context.remove_last_discarded()
         context.state = 'discarding'
         context.set_turn(chower_idx)
-        context.player().hand.chow(chow_comb, tile)
+        group = context.player().hand.chow(chow_comb, tile)
+        _emit(context, Melded, chower_idx, group)
 
     def _cleanup(self, context):
         context.extra.pop('melders', None)
@@ -900,7 +1287,7 @@ class ChowingHandler(Handler):
     ``context.players[i].extra['chow_combs']``.
 
     '''
-    def validate(self, context):
+    def check(self, context):
         if not context.last_discarded():
             return FlowResult(False, 'bad-context')
 
@@ -912,6 +1299,10 @@ class ChowingHandler(Handler):
         if not (last_player and context.last_discarded() == last_player.discarded[-1]):
             return FlowResult(False, 'bad-context')
 
+        return FlowResult(True)
+
+    def validate(self, context, trusted=False):
+        cur_player = context.player()
         chow_combs = cur_player.extra.get('chow_combs')
         if cur_player.decision not in chow_combs:
             result = FlowResult(False, 'decisions-needed')
@@ -924,8 +1315,9 @@ class ChowingHandler(Handler):
         player = context.player()
         chow_comb = player.decision
         tile = context.remove_last_discarded(-1)
-        player.hand.chow(chow_comb, tile)
+        group = player.hand.chow(chow_comb, tile)
         context.state = 'discarding'
+        _emit(context, Melded, context.cur_player_idx, group)
         self._cleanup(context)
 
     def _cleanup(self, context):
@@ -945,7 +1337,7 @@ class EndHandler(Handler):
     # TODO: bloodmatch
 
     '''
-    def validate(self, context):
+    def check(self, context):
         # it's either win or tie
         if context.winners:
             for i in context.winners:
@@ -959,9 +1351,28 @@ class EndHandler(Handler):
 
     def next(self, context):
         if context.winners:
+            win_type = context.players[context.winners[0]].extra.get('win_type')
+            _emit(context, Won, tuple(context.winners), win_type)
+        else:
+            _emit(context, Tied, context.extra.get('tie_type'))
+
+        if context.winners:
+            snapshot = None
             for winner_idx in context.winners:
                 winner = context.players[winner_idx]
-                winner.extra['patterns_matched'] = patterns.match_all(context, winner_idx)
+                # reuse the score table if someone has asked for it (see algo.score_table())
+                cached = algo.cached_score(context, winner_idx)
+                if cached:
+                    match_results = cached[0]
+                elif context.settings.eager_scoring or context.settings.ledger:
+                    # the ledger reads them at 'scored' anyway
+                    match_results = patterns.match_all(context, winner_idx)
+                else:
+                    # match on first access, against the context as it is now
+                    if snapshot is None:
+                        snapshot = context.clone()
+                    match_results = patterns.LazyMatchResults(snapshot, winner_idx)
+                winner.extra['patterns_matched'] = match_results
         context.state = 'scored'
 
 
@@ -972,12 +1383,18 @@ class ScoredHandler(Handler):
     Incoming state: 'end'.
     Outgoing state: 'start'.
 
-    ScoredHandler clears all intermediate data in the game context (mostly in
-    ``context.extra`` and ``context.players[i].extra``), decides the next
-    dealer, and initializes for the next match.
+    ScoredHandler records the net points of the match in ``context.ledger``
+    (if ``GameSettings.ledger`` is on), clears all intermediate data in the
+    game context (mostly in ``context.extra`` and
+    ``context.players[i].extra``), decides the next dealer, and initializes
+    for the next match.
 
     '''
     def next(self, context):
+        points = None
+        if context.settings.ledger:
+            points = self._record_scores(context)
+        _emit(context, Scored, points)
         self._clear_hands(context)
         self._update_round_and_match(context)
         self._set_next_dealer(context)
@@ -987,8 +1404,24 @@ class ScoredHandler(Handler):
         context.state = 'start'
         context.extra.clear()
 
+    def _record_scores(self, context):
+        points = [0, 0, 0, 0]
+        for winner_idx in context.winners or []:
+            match_results = context.players[winner_idx].extra.get('patterns_matched', {})
+            scores = algo.score(context, match_results)
+            for i in xrange(0, 4):
+                points[i] -= scores[i]
+                points[winner_idx] += scores[i]
+        context.ledger.append(points, context.round, context.dealer)
+        return points
+
     def _clear_hands(self, context):
+        # bot mode lasts across matches
+        bots = [player.extra.get('bot') for player in context.players]
         context.reset_players()
+        for player, bot in zip(context.players, bots):
+            if bot:
+                player.extra['bot'] = bot
         del context.discarded_pool[:]
         context.cur_player_idx = 0
         context.last_player_idx = None
@@ -1035,3 +1468,178 @@ _STATE_ROUTES = {
     'end': EndHandler(),
     'scored': ScoredHandler()
 }
+
+
+# Observers
+#-----------
+def add_observer(context, observer):
+    '''
+    Register an Observer to be notified of every transition that
+    ``flow.next()`` makes on a context. Return the observer.
+
+    Observers belong to the context object. Clones of it, e.g., the
+    sandboxes of ``precompute_reactions()``, start without observers, and so
+    do contexts loaded from snapshots.
+
+    '''
+    if observer not in context._observers:
+        context._observers.append(observer)
+    return observer
+
+
+def remove_observer(context, observer):
+    if observer in context._observers:
+        context._observers.remove(observer)
+
+
+class Observer(object):
+    '''
+    Base class of flow observers. Override the callbacks you need. ``state``
+    is the state that the transition starts from. Validation includes the
+    integrity checks unless in trusted mode, and next() is only called if
+    validation succeeds.
+
+    '''
+    def before_validate(self, state, context):
+        pass
+
+    def after_validate(self, state, context, result):
+        pass
+
+    def before_next(self, state, context):
+        pass
+
+    def after_next(self, state, context):
+        pass
+
+    def on_result(self, state, context, result):
+        pass
+
+    def on_event(self, context, event):
+        '''Called with each event (e.g., ``Drawn``) during next().'''
+        pass
+
+
+class _EventSink(Observer):
+    # buffers the events of a context for stream()
+
+    def __init__(self):
+        self.events = []
+
+    def on_event(self, context, event):
+        self.events.append(event)
+
+    def drain(self):
+        events = self.events
+        self.events = []
+        return events
+
+
+class TimingCollector(Observer):
+    '''
+    Latency histograms of transitions per state and FlowResult reason ('ok'
+    for successful transitions).
+
+    Latencies fall into fixed buckets growing by powers of 2 from
+    ``min_latency`` seconds, so recording is a bisect and an increment.
+    Percentiles are the upper bounds of the buckets they fall in.
+
+    A collector can observe many contexts, even if their transitions nest or
+    run in different threads.
+
+    Example::
+
+        collector = flow.add_observer(context, flow.TimingCollector())
+        flow.run_until(context, flow.after_matches(100))
+        print collector.format_table()
+
+    '''
+    COLUMNS = ('state', 'reason', 'count', 'total', 'mean', 'p50', 'p90', 'p99', 'max')
+
+    def __init__(self, min_latency=1e-5, num_buckets=20):
+        # upper bounds of the buckets, the last bucket has no upper bound
+        self.bounds = [min_latency * 2 ** i for i in xrange(0, num_buckets - 1)]
+        self._histograms = {}
+        # id(context) -> start time of its transition
+        self._starts = {}
+        self._timer = timeit.default_timer
+
+    def before_validate(self, state, context):
+        self._starts[id(context)] = self._timer()
+
+    def on_result(self, state, context, result):
+        elapsed = self._timer() - self._starts.pop(id(context))
+        key = (state, result.reason or 'ok')
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = _Histogram(len(self.bounds) + 1)
+        histogram.count += 1
+        histogram.total += elapsed
+        if elapsed > histogram.max:
+            histogram.max = elapsed
+        histogram.buckets[bisect.bisect_left(self.bounds, elapsed)] += 1
+
+    def histogram(self, state, reason='ok'):
+        '''Return a list of bucket counts, see ``bounds``.'''
+        histogram = self._histograms.get((state, reason))
+        return list(histogram.buckets) if histogram else [0] * (len(self.bounds) + 1)
+
+    def clear(self):
+        self._histograms.clear()
+
+    def as_dict(self):
+        '''
+        Return a dictionary of state -> reason -> stats. Times are in
+        seconds.
+
+        '''
+        result = {}
+        for (state, reason), histogram in self._histograms.iteritems():
+            result.setdefault(state, {})[reason] = {
+                'count': histogram.count,
+                'total': histogram.total,
+                'mean': histogram.total / histogram.count,
+                'p50': self._percentile(histogram, 50),
+                'p90': self._percentile(histogram, 90),
+                'p99': self._percentile(histogram, 99),
+                'max': histogram.max,
+                'buckets': list(histogram.buckets)
+            }
+        return result
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), sort_keys=True)
+
+    def format_table(self):
+        '''Return a text table sorted by total time, slowest first.'''
+        rows = []
+        for state, reasons in self.as_dict().iteritems():
+            for reason, stats in reasons.iteritems():
+                rows.append((state, reason, stats))
+        rows.sort(key=lambda row: (-row[2]['total'], row[0], row[1]))
+        lines = ['%-14s %-18s %8s %10s %10s %10s %10s %10s %10s' % self.COLUMNS]
+        for state, reason, stats in rows:
+            lines.append('%-14s %-18s %8d %10.6f %10.6f %10.6f %10.6f %10.6f %10.6f' % (
+                state, reason, stats['count'], stats['total'], stats['mean'],
+                stats['p50'], stats['p90'], stats['p99'], stats['max']))
+        return '\n'.join(lines)
+
+    def _percentile(self, histogram, percent):
+        rank = percent / 100.0 * histogram.count
+        count = 0
+        for i, bucket_count in enumerate(histogram.buckets):
+            count += bucket_count
+            if bucket_count and count >= rank:
+                return min(self.bounds[i], histogram.max) if i < len(self.bounds) else histogram.max
+        return histogram.max
+
+
+class _Histogram(object):
+
+    __slots__ = ('count', 'total', 'max', 'buckets')
+
+    def __init__(self, num_buckets):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * num_buckets
@@ -1,7 +1,11 @@
 import collections
 import copy
+import json
+import random
+import threading
+import timeit
 
-from mahjong import utils
+from mahjong import tables
 from mahjong.types import Tile, TileGroup
 
 
@@ -45,6 +49,8 @@ def match_all(context, player_idx):
         # if the pattern has been excluded, it means the pattern won't match anyway
         # so no need to check it
         if name in excluded_pattern_names:
+            if _stats:
+                _stats.entry(name).skipped += 1
             continue
 
         match_result = match(name, context, player_idx)
@@ -76,6 +82,71 @@ def match_all(context, player_idx):
     return results
 
 
+class LazyMatchResults(collections.MutableMapping):
+    '''
+    A mapping of match results that calls ``match_all()`` on first access,
+    so nothing is matched if nobody reads it. Give it a context that won't
+    change, e.g., a clone.
+
+    It compares equal to a dictionary of the same results, and ``dict()``
+    of it is a plain dictionary.
+
+    '''
+    def __init__(self, context, player_idx):
+        self._args = (context, player_idx)
+        self._results = None
+
+    @property
+    def resolved(self):
+        return self._args is None
+
+    def resolve(self):
+        '''Match the patterns if not yet. Return the results as a dictionary.'''
+        if self._args is not None:
+            context, player_idx = self._args
+            self._results = match_all(context, player_idx)
+            self._args = None
+        return self._results
+
+    def __getitem__(self, key):
+        return self.resolve()[key]
+
+    def __setitem__(self, key, value):
+        self.resolve()[key] = value
+
+    def __delitem__(self, key):
+        del self.resolve()[key]
+
+    def __iter__(self):
+        return iter(self.resolve())
+
+    def __len__(self):
+        return len(self.resolve())
+
+    def __contains__(self, key):
+        return key in self.resolve()
+
+    def __repr__(self):
+        return repr(self.resolve())
+
+    def __eq__(self, other):
+        if isinstance(other, LazyMatchResults):
+            other = other.resolve()
+        return self.resolve() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def keys(self):
+        return self.resolve().keys()
+
+    def iteritems(self):
+        return self.resolve().iteritems()
+
+    def copy(self):
+        return dict(self.resolve())
+
+
 class MatchResult(object):
     '''
     A MatchResult is essentially an array which has four elements:
@@ -404,55 +475,36 @@ class ConcealedTriplets(Pattern):
 
     @check_flower_win
     def match(self, context, player_idx, incoming_tile):
-        # copy hand, incoming_tile discarded by others is not considered concealed,
-        # so it's not included here
-        hand = context.player(player_idx).hand.clone()
-        if hand.last_tile:
-            incoming_tile = None
-        hand.move_last_tile()
-
-        num_concealed_kongs = hand.num_kongs(exposed=False)
-        if num_concealed_kongs >= self.num_triplets:
-            return self.default_result(context, player_idx)
+        hand = context.players[player_idx].hand
+        self_picked = bool(hand.last_tile)
+        if self_picked:
+            incoming_tile = hand.last_tile
+
+        num_concealed = hand.num_kongs(exposed=False)
+        if num_concealed < self.num_triplets:
+            num_concealed += self._max_concealed_triplets(hand, incoming_tile, self_picked)
 
-        num_triplets_needed = self.num_triplets - num_concealed_kongs
-        if self._has_triplets(hand, num_triplets_needed, incoming_tile):
+        if num_concealed >= self.num_triplets:
             return self.default_result(context, player_idx)
 
         return MatchResult()
 
-    def _has_triplets(self, hand, num_triplets, incoming_tile):
-        candidates = self._triplet_candidates(hand)
-        orig_tiles = hand.free_tiles
-        triplet_count = 0
-
-        for tile in candidates:
-            idx = utils.index(hand.free_tiles, tile)
-            prev_tiles = hand.free_tiles
-            hand.free_tiles = hand.free_tiles[0:idx] + hand.free_tiles[idx + 3:]
-
-            print '%d - %s' % (triplet_count, hand)
-
-            if hand.can_win(incoming_tile):
-                triplet_count += 1
-                if triplet_count == num_triplets:
-                    break
-            else:
-                hand.free_tiles = prev_tiles
-
-        hand.free_tiles = orig_tiles
-        return triplet_count == num_triplets
-
-    def _triplet_candidates(self, hand):
-        result = []
-        num_tiles = len(hand.free_tiles)
-        i = 0
-        while i < num_tiles - 2:
-            if hand.free_tiles[i] == hand.free_tiles[i + 2]:
-                result.append(hand.free_tiles[i])
-                i += 3
-            else:
-                i += 1
+    def _max_concealed_triplets(self, hand, incoming_tile, self_picked):
+        # incoming_tile discarded by others is not considered concealed, so a
+        # triplet of it doesn't count unless the hand holds three of it already
+        exposed_tile = None
+        if not self_picked and hand.count(incoming_tile, last_tile=False) < 3:
+            exposed_tile = incoming_tile
+
+        result = 0
+        for decomposition in hand.decompositions(incoming_tile):
+            count = 0
+            for kind, __ in decomposition:
+                if kind == tables.TRIPLET:
+                    count += 1
+            if exposed_tile and (tables.TRIPLET, exposed_tile) in decomposition:
+                count -= 1
+            result = max(result, count)
         return result
 
 
@@ -926,15 +978,12 @@ class AllSequences(Pattern):
             if group.group_type != TileGroup.CHOW:
                 return MatchResult()
 
-        hand = player.hand.clone()
-        hand.add_free_tile(incoming_tile)
-
         # check if the hand can be grouped into sequences and a pair
-        if not self._can_be_grouped_into_seqs_and_pair(hand.free_tiles):
+        if incoming_tile not in player.hand.sequence_waits():
             return MatchResult()
 
         # check if there're more than one waiting tile
-        if len(player.hand.waiting_tiles()) < 2:
+        if len(player.hand.waits()) < 2:
             return MatchResult()
 
         chucker = player.extra.get('chucker')
@@ -951,58 +1000,6 @@ class AllSequences(Pattern):
                 return True
         return False
 
-    def _can_be_grouped_into_seqs_and_pair(self, tiles):
-        pairs = self._find_pairs(tiles)
-        if not pairs:
-            return False
-
-        # remove pair and see if rest of tiles can be grouped into sequences
-        for pair_idx in pairs:
-            tiles_no_pair = self._remove_pair(tiles, pair_idx)
-            if self._all_sequences(tiles_no_pair):
-                return True
-
-        return False
-
-    def _all_sequences(self, tiles):
-        if not tiles:
-            return True
-
-        tile_queue = collections.deque(tiles)
-        while True:
-            try:
-                tile0 = tile_queue.popleft()
-            except IndexError:
-                break
-            tile1 = Tile.ALL.get(tile0.tile_id + 1)
-            tile2 = Tile.ALL.get(tile0.tile_id + 2)
-            if not (tile1 and tile2):
-                return False
-
-            try:
-                tile_queue.remove(tile1)
-                tile_queue.remove(tile2)
-            except ValueError:
-                return False
-
-        return True
-
-    def _remove_pair(self, tiles, pair_idx):
-        result = []
-        num_tiles = len(tiles)
-        for i in xrange(0, num_tiles):
-            if (i - pair_idx) not in (0, 1):
-                result.append(tiles[i])
-        return result
-
-    def _find_pairs(self, tiles):
-        pairs = []
-        num_tiles = len(tiles)
-        for i in xrange(0, num_tiles - 1):
-            if tiles[i] == tiles[i + 1]:
-                pairs.append(i)
-        return pairs
-
 
 class WaitingForOne(Pattern):
     '''
@@ -1015,57 +1012,24 @@ class WaitingForOne(Pattern):
     @check_flower_win
     def match(self, context, player_idx, incoming_tile):
         hand = context.players[player_idx].hand
-        waiting_tiles = hand.waiting_tiles()
-        if len(waiting_tiles) != 1:
+        waits = hand.waits()
+        if len(waits) != 1:
             return MatchResult()
 
-        tile = waiting_tiles[0]
+        tile, shapes = waits.items()[0]
         if tile != incoming_tile:
             return MatchResult()
 
-        if tile.is_honor():
-            extra = 'eye'
-        elif self._is_edge(hand, tile):
+        # edge and hole are chosen over eye
+        if tables.EDGE in shapes:
             extra = 'edge'
-        elif self._is_hole(hand, tile):
+        elif tables.HOLE in shapes:
             extra = 'hole'
         else:
             extra = 'eye'
 
         return self.default_result(context, player_idx, extra=extra)
 
-    def _is_edge(self, hand, tile):
-        if tile.rank == 7:
-            tile1 = Tile.ALL.get(tile.tile_id + 1)
-            tile2 = Tile.ALL.get(tile.tile_id + 2)
-        elif tile.rank == 3:
-            tile1 = Tile.ALL.get(tile.tile_id - 2)
-            tile2 = Tile.ALL.get(tile.tile_id - 1)
-        else:
-            return False
-
-        return self._remove_and_can_win(hand, (tile1, tile2))
-
-    def _is_hole(self, hand, tile):
-        if tile.rank in (1, 9):
-            return False
-
-        tile1 = Tile.ALL.get(tile.tile_id - 1)
-        tile2 = Tile.ALL.get(tile.tile_id + 1)
-
-        return self._remove_and_can_win(hand, (tile1, tile2))
-
-    def _remove_and_can_win(self, hand, tiles_to_be_removed):
-        hand = hand.clone()
-
-        for tile in tiles_to_be_removed:
-            idx = utils.index(hand.free_tiles, tile)
-            if idx < 0:
-                return False
-            del hand.free_tiles[idx]
-
-        return hand.can_win()
-
 
 class RobbedKong(Pattern):
 
@@ -1200,6 +1164,342 @@ class LackASuit(Pattern):
         return table.get(tile.suit)
 
 
+class Fu(Pattern):
+    '''
+    Minipoints of a Japanese-style winning hand, used by JPScorer together
+    with the han of the other patterns. The fu is stored in
+    ``MatchResult.extra``.
+
+    Fu is maximized over the decompositions of the hand and the groups that the
+    winning tile may have completed, so the winning tile can make a triplet
+    exposed (won on a discard) or the wait an edge, a hole or an eye.
+
+    '''
+    @check_flower_win
+    def match(self, context, player_idx, incoming_tile):
+        hand = context.players[player_idx].hand
+        self_picked = bool(hand.last_tile)
+        if self_picked:
+            incoming_tile = hand.last_tile
+
+        concealed = True
+        fixed_fu = 0
+        for group in hand.fixed_groups:
+            if group.group_type != TileGroup.KONG_CONCEALED:
+                concealed = False
+            fixed_fu += _GROUP_FU[group.group_type] * self._terminal_factor(group.tiles[0])
+
+        pair_tiles = list(Tile.DRAGONS) + [Tile.WINDS[player_idx], Tile.WINDS[context.round % 4]]
+
+        best = None
+        for decomposition in hand.decompositions(incoming_tile):
+            for completed_idx, (kind, tile) in enumerate(decomposition):
+                shape = self._wait_shape(kind, tile, incoming_tile)
+                if shape is None:
+                    continue
+
+                fu = fixed_fu
+                if shape in _SINGLE_WAITS:
+                    fu += 2
+                for i, (kind, tile) in enumerate(decomposition):
+                    if kind == tables.TRIPLET:
+                        # a triplet completed by a discarded tile is exposed
+                        exposed = not self_picked and i == completed_idx
+                        fu += (2 if exposed else 4) * self._terminal_factor(tile)
+                    elif kind == tables.PAIR:
+                        fu += 2 * pair_tiles.count(tile)
+                best = max(best, fu)
+
+        if best is None:
+            return MatchResult()
+
+        # self-picked scores 2 fu unless it's a concealed all-sequences hand
+        if self_picked and (best > 0 or not concealed):
+            best += 2
+
+        fu = 20 + best
+        if concealed and not self_picked:
+            fu += 10
+        elif fu == 20 and not concealed:
+            fu = 30
+
+        # round up to tens
+        fu = (fu + 9) // 10 * 10
+        return self.default_result(context, player_idx, extra=fu)
+
+    def _terminal_factor(self, tile):
+        return 2 if tile.is_honor() or tile.rank in (1, 9) else 1
+
+    def _wait_shape(self, kind, tile, incoming_tile):
+        if kind == tables.SEQUENCE:
+            if tile.suit != incoming_tile.suit:
+                return None
+            return tables.wait_shape(kind, tile.rank, incoming_tile.rank)
+        if tile == incoming_tile:
+            return tables.wait_shape(kind, 1, 1)
+        return None
+
+
+# Fixed group type -> fu of a simple (2 to 8) group
+_GROUP_FU = {
+    TileGroup.CHOW: 0,
+    TileGroup.PONG: 2,
+    TileGroup.KONG_EXPOSED: 8,
+    TileGroup.KONG_CONCEALED: 16
+}
+
+_SINGLE_WAITS = (tables.EDGE, tables.HOLE, tables.EYE)
+
+
+class HandFeatures(object):
+    '''
+    A precomputed feature vector of a winner's hand, shared by all the
+    DeclarativePatterns matched against the same hand.
+
+    * counts: Tile counts indexed by ``_TILE_INDICES``, including free tiles,
+              fixed groups and the incoming tile.
+    * tile_mask: A bit mask of the tiles in ``counts``.
+    * num_chows, num_pongs, num_exposed_kongs, num_concealed_kongs: Fixed
+      group counts.
+    * num_numeric_suits: Number of numeric suits (chars, circles, bamboos) in
+      the hand.
+    * has_honors: Does the hand contain honors?
+    * num_flowers: Number of flowers.
+    * self_picked, chucker, win_type: How the player won.
+    * is_dealer: Is the player the dealer?
+    * incoming_tile: The winning tile.
+
+    '''
+    __slots__ = ('counts', 'tile_mask', 'num_chows', 'num_pongs', 'num_exposed_kongs',
+                 'num_concealed_kongs', 'num_numeric_suits', 'has_honors', 'num_flowers',
+                 'self_picked', 'chucker', 'win_type', 'is_dealer', 'incoming_tile')
+
+    @classmethod
+    def get(cls, context, player_idx, incoming_tile):
+        '''
+        Get the features of a player's hand, reusing the last ones of the
+        thread if they're from the same inputs.
+
+        '''
+        player = context.players[player_idx]
+        hand = player.hand
+        # everything __init__() reads
+        key = (player_idx, incoming_tile, hand.last_tile, tuple(hand.free_tiles),
+               tuple([(g.group_type, tuple(g.tiles)) for g in hand.fixed_groups]),
+               len(hand.flowers), player.extra.get('win_type'),
+               player.extra.get('chucker'), context.dealer)
+        last = getattr(_last_features, 'entry', None)
+        if last is not None and last[0] == key:
+            return last[1]
+        features = cls(context, player_idx, incoming_tile)
+        _last_features.entry = (key, features)
+        return features
+
+    def __init__(self, context, player_idx, incoming_tile):
+        player = context.players[player_idx]
+        hand = player.hand
+
+        counts = [0] * len(_TILE_INDICES)
+        for tile in hand.free_tiles:
+            idx = _TILE_INDICES.get(tile)
+            if idx is not None:
+                counts[idx] += 1
+        if incoming_tile:
+            idx = _TILE_INDICES.get(incoming_tile)
+            if idx is not None:
+                counts[idx] += 1
+
+        self.num_chows = 0
+        self.num_pongs = 0
+        self.num_exposed_kongs = 0
+        self.num_concealed_kongs = 0
+        for group in hand.fixed_groups:
+            for tile in group.tiles:
+                counts[_TILE_INDICES[tile]] += 1
+            if group.group_type == TileGroup.CHOW:
+                self.num_chows += 1
+            elif group.group_type == TileGroup.PONG:
+                self.num_pongs += 1
+            elif group.group_type == TileGroup.KONG_EXPOSED:
+                self.num_exposed_kongs += 1
+            else:
+                self.num_concealed_kongs += 1
+
+        tile_mask = 0
+        for idx, count in enumerate(counts):
+            if count:
+                tile_mask |= 1 << idx
+
+        self.counts = counts
+        self.tile_mask = tile_mask
+        self.num_numeric_suits = sum([1 for mask in _SUIT_MASKS if tile_mask & mask])
+        self.has_honors = bool(tile_mask & _HONOR_MASK)
+        self.num_flowers = len(hand.flowers)
+        self.self_picked = bool(hand.last_tile)
+        self.chucker = player.extra.get('chucker')
+        self.win_type = player.extra.get('win_type')
+        self.is_dealer = context.dealer == player_idx
+        self.incoming_tile = incoming_tile
+
+
+# (key, HandFeatures) of the last hand per thread, match_all() matches many
+# patterns against the same hand in a row
+_last_features = threading.local()
+
+
+class DeclarativePattern(Pattern):
+    '''
+    A pattern defined by conditions instead of code. The conditions are
+    compiled into a list of predicates over HandFeatures when the pattern is
+    created, so matching is just a few integer comparisons.
+
+    Keyword arguments (all optional, unspecified ones always hold):
+
+    * only_tiles: Every tile in the hand must be one of these tiles.
+    * min_counts: A dictionary of tile -> minimum number of that tile in the
+      hand, e.g., ``{Tile.RED: 3}`` for a triplet or kong of reds.
+    * melds: A dictionary of fixed group type -> count, where the type is
+      'chow', 'pong', 'exposed-kong', 'concealed-kong' or 'kong', and the count
+      is an integer or a (min, max) tuple. Use None as max for no limit.
+    * numeric_suits: Number of numeric suits, an integer or a (min, max) tuple.
+    * honors: True if the hand must have honors, False if it mustn't.
+    * flowers: Number of flowers, an integer or a (min, max) tuple.
+    * self_picked: True if the hand must be self-picked, False if it mustn't.
+    * win_types: Allowed values of ``Player.extra['win_type']``.
+    * dealer: True if the winner must be the dealer, False if he mustn't.
+    * predicate: A function that takes a HandFeatures and returns a bool, for
+      conditions the keywords above can't describe.
+    * payer: Who pays. 'default' means the chucker if there's one or the
+      other three players otherwise, 'others' means the other three players,
+      and 'chucker' means the chucker only (no match if self-picked).
+    * multiplier, extra: Used to create the MatchResult.
+    * implies, excludes: Same as ``Pattern.implies`` and ``Pattern.excludes``.
+
+    Like other patterns, the flower win is never matched.
+
+    '''
+    _MELD_ATTRS = {
+        'chow': ('num_chows',),
+        'pong': ('num_pongs',),
+        'exposed-kong': ('num_exposed_kongs',),
+        'concealed-kong': ('num_concealed_kongs',),
+        'kong': ('num_exposed_kongs', 'num_concealed_kongs')
+    }
+
+    def __init__(self, only_tiles=None, min_counts=None, melds=None, numeric_suits=None,
+                 honors=None, flowers=None, self_picked=None, win_types=None, dealer=None,
+                 predicate=None, payer='default', multiplier=1, extra=None, implies=None,
+                 excludes=None):
+        super(DeclarativePattern, self).__init__()
+        if payer not in ('default', 'others', 'chucker'):
+            raise ValueError('Illegal payer: %s' % payer)
+
+        self.payer = payer
+        self.multiplier = multiplier
+        self.extra = extra
+        if implies:
+            self.implies = tuple(implies)
+        if excludes:
+            self.excludes = tuple(excludes)
+
+        predicates = []
+
+        if only_tiles is not None:
+            allowed_mask = 0
+            for tile in only_tiles:
+                allowed_mask |= 1 << _TILE_INDICES[tile]
+            predicates.append(lambda f: not (f.tile_mask & ~allowed_mask))
+
+        if min_counts:
+            required = tuple([(_TILE_INDICES[tile], count)
+                              for tile, count in min_counts.iteritems()])
+
+            def has_min_counts(f):
+                counts = f.counts
+                for idx, count in required:
+                    if counts[idx] < count:
+                        return False
+                return True
+            predicates.append(has_min_counts)
+
+        if melds:
+            for meld_type, count in melds.iteritems():
+                attrs = self._MELD_ATTRS.get(meld_type)
+                if not attrs:
+                    raise ValueError('Illegal meld type: %s' % meld_type)
+                predicates.append(_compile_range(count, attrs))
+
+        if numeric_suits is not None:
+            predicates.append(_compile_range(numeric_suits, ('num_numeric_suits',)))
+
+        if honors is not None:
+            predicates.append(lambda f: f.has_honors == honors)
+
+        if flowers is not None:
+            predicates.append(_compile_range(flowers, ('num_flowers',)))
+
+        if self_picked is not None:
+            predicates.append(lambda f: f.self_picked == self_picked)
+
+        if win_types is not None:
+            win_types = frozenset(win_types)
+            predicates.append(lambda f: f.win_type in win_types)
+
+        if dealer is not None:
+            predicates.append(lambda f: f.is_dealer == dealer)
+
+        if predicate is not None:
+            predicates.append(predicate)
+
+        self._predicates = tuple(predicates)
+
+    @check_flower_win
+    def match(self, context, player_idx, incoming_tile):
+        features = HandFeatures.get(context, player_idx, incoming_tile)
+        for predicate in self._predicates:
+            if not predicate(features):
+                return MatchResult()
+
+        if self.payer == 'others':
+            return self.result_other_players(context, player_idx, self.multiplier, self.extra)
+        if self.payer == 'chucker':
+            if features.chucker is None:
+                return MatchResult()
+            return MatchResult(features.chucker, self.multiplier, self.extra)
+        return self.default_result(context, player_idx, self.multiplier, self.extra)
+
+
+def _compile_range(value, attrs):
+    '''
+    Compile an integer or a (min, max) tuple into a predicate that checks the
+    sum of some HandFeatures attributes.
+
+    '''
+    try:
+        low, high = value
+    except TypeError:
+        low, high = value, value
+
+    if len(attrs) == 1:
+        attr = attrs[0]
+        if high is None:
+            return lambda f: getattr(f, attr) >= low
+        return lambda f: low <= getattr(f, attr) <= high
+
+    def in_range(f):
+        total = sum([getattr(f, attr) for attr in attrs])
+        return total >= low and (high is None or total <= high)
+    return in_range
+
+
+# Dense tile indices used by HandFeatures
+_TILE_INDICES = dict([(tile, i) for i, tile in
+                      enumerate(Tile.CHARS + Tile.CIRCLES + Tile.BAMBOOS + Tile.HONORS)])
+_SUIT_MASKS = tuple([sum([1 << _TILE_INDICES[tile] for tile in tiles])
+                     for tiles in (Tile.CHARS, Tile.CIRCLES, Tile.BAMBOOS)])
+_HONOR_MASK = sum([1 << _TILE_INDICES[tile] for tile in Tile.HONORS])
+
+
 # Pattern table
 _PATTERNS = {
     # Taiwanese 16
@@ -1241,14 +1541,18 @@ _PATTERNS = {
     'purely-concealed-self-picked': PurelyConcealedSelfPicked(),
 
     'four-kongs': FourKongs(),
-    'lack-a-suit': LackASuit()
+    'lack-a-suit': LackASuit(),
+
+    # Japanese
+    'fu': Fu()
 }
 
 
 # Add more exclusion such that:
 # If pattern A excludes B, B excludes A as well
-def _add_auto_excludes():
-    for name, pattern in _PATTERNS.items():
+def _add_auto_excludes(names=None):
+    for name in names or _PATTERNS.keys():
+        pattern = get(name)
         if pattern.excludes:
             for other_name in pattern.excludes:
                 other_pattern = get(other_name)
@@ -1260,6 +1564,35 @@ def _add_auto_excludes():
 _add_auto_excludes()
 
 
+def register(name, pattern):
+    '''
+    Add a pattern to the pattern table, so it can be used in
+    ``GameSettings.patterns_score`` and matched by ``match_all()``.
+
+    '''
+    if name in _PATTERNS:
+        raise KeyError('Pattern `%s` already exists' % name)
+    _PATTERNS[name] = pattern
+    _add_auto_excludes([name])
+    if _stats:
+        _instrument(name, pattern)
+    return pattern
+
+
+def define(name, **conditions):
+    '''
+    Create a DeclarativePattern from keyword conditions and register it. See
+    DeclarativePattern for the available conditions. Example::
+
+        patterns.define('all-greens',
+                        only_tiles=(Tile.BAMBOO2, Tile.BAMBOO3, Tile.BAMBOO4,
+                                    Tile.BAMBOO6, Tile.BAMBOO8, Tile.GREEN),
+                        excludes=('mix-a-suit',))
+
+    '''
+    return register(name, DeclarativePattern(**conditions))
+
+
 def _copy_match_results(match_results):
     result = {}
     for name, match_result in match_results.iteritems():
@@ -1282,3 +1615,163 @@ def _filter_match_results(match_results, attr_name, subtract_func):
                         results.pop(other_name, None)
 
     return results
+
+
+
+# Instrumentation
+#-----------------
+# PatternStats being collected, None if disabled
+_stats = None
+
+
+class PatternStats(object):
+    '''
+    Per-pattern call counts, match rates, latencies and how often a pattern
+    was skipped by ``Pattern.excludes`` in ``match_all()``. Use
+    ``enable_stats()`` to start collecting.
+
+    Only a ``sample_rate`` fraction of calls is timed, and at most
+    ``max_samples`` latencies are kept per pattern (reservoir sampling) for
+    percentiles, so it's cheap enough to leave on with a low sample rate.
+
+    '''
+    COLUMNS = ('name', 'calls', 'matches', 'match_rate', 'skipped', 'sampled',
+               'total', 'mean', 'p50', 'p90', 'p99')
+
+    def __init__(self, sample_rate=1.0, max_samples=1000):
+        self.sample_rate = sample_rate
+        self.max_samples = max_samples
+        self._entries = {}
+
+    def entry(self, name):
+        entry = self._entries.get(name)
+        if entry is None:
+            entry = self._entries[name] = _StatsEntry()
+        return entry
+
+    def record(self, name, elapsed):
+        entry = self.entry(name)
+        entry.sampled += 1
+        entry.total_time += elapsed
+        if len(entry.samples) < self.max_samples:
+            entry.samples.append(elapsed)
+        else:
+            i = random.randint(0, entry.sampled - 1)
+            if i < self.max_samples:
+                entry.samples[i] = elapsed
+
+    def as_dict(self):
+        '''
+        Return a dictionary of pattern name -> stats. Times are in seconds.
+        'total' is estimated from the sampled calls if sample_rate < 1.
+
+        '''
+        result = {}
+        for name, entry in self._entries.iteritems():
+            samples = sorted(entry.samples)
+            mean = entry.total_time / entry.sampled if entry.sampled else 0.0
+            result[name] = {
+                'calls': entry.calls,
+                'matches': entry.matches,
+                'match_rate': float(entry.matches) / entry.calls if entry.calls else 0.0,
+                'skipped': entry.skipped,
+                'sampled': entry.sampled,
+                'total': mean * entry.calls,
+                'mean': mean,
+                'p50': _percentile(samples, 50),
+                'p90': _percentile(samples, 90),
+                'p99': _percentile(samples, 99)
+            }
+        return result
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), sort_keys=True)
+
+    def format_table(self):
+        '''Return a text table sorted by total time, slowest first.'''
+        stats = self.as_dict()
+        names = sorted(stats, key=lambda name: (-stats[name]['total'], name))
+        lines = ['%-30s %8s %8s %6s %8s %8s %10s %10s %10s %10s %10s' % self.COLUMNS]
+        for name in names:
+            row = stats[name]
+            lines.append('%-30s %8d %8d %6.2f %8d %8d %10.6f %10.6f %10.6f %10.6f %10.6f' % (
+                name, row['calls'], row['matches'], row['match_rate'], row['skipped'],
+                row['sampled'], row['total'], row['mean'], row['p50'], row['p90'],
+                row['p99']))
+        return '\n'.join(lines)
+
+
+class _StatsEntry(object):
+
+    __slots__ = ('calls', 'matches', 'skipped', 'sampled', 'total_time', 'samples')
+
+    def __init__(self):
+        self.calls = 0
+        self.matches = 0
+        self.skipped = 0
+        self.sampled = 0
+        self.total_time = 0.0
+        self.samples = []
+
+
+def enable_stats(sample_rate=1.0, max_samples=1000):
+    '''
+    Start collecting PatternStats for every pattern in the pattern table.
+    Return the PatternStats. Calling it again starts over.
+
+    '''
+    global _stats
+    disable_stats()
+    _stats = PatternStats(sample_rate, max_samples)
+    for name, pattern in _PATTERNS.iteritems():
+        _instrument(name, pattern)
+    return _stats
+
+
+def disable_stats():
+    '''
+    Stop collecting and restore the patterns, so there's no overhead left.
+    Return the collected PatternStats, or None if it wasn't enabled.
+
+    '''
+    global _stats
+    stats = _stats
+    _stats = None
+    for pattern in _PATTERNS.itervalues():
+        # remove the instance attribute that shadows the match() method
+        pattern.__dict__.pop('match', None)
+    return stats
+
+
+def get_stats():
+    return _stats
+
+
+def _instrument(name, pattern):
+    # shadow the match() method on the instance only, so disable_stats() can
+    # restore it by deleting the attribute
+    match_method = pattern.match
+    stats = _stats
+    timer = timeit.default_timer
+
+    def match(context, player_idx, incoming_tile):
+        entry = stats.entry(name)
+        entry.calls += 1
+        if stats.sample_rate >= 1 or random.random() < stats.sample_rate:
+            start = timer()
+            result = match_method(context, player_idx, incoming_tile)
+            stats.record(name, timer() - start)
+        else:
+            result = match_method(context, player_idx, incoming_tile)
+        if result:
+            entry.matches += 1
+        return result
+
+    pattern.match = match
+
+
+def _percentile(sorted_samples, percent):
+    if not sorted_samples:
+        return 0.0
+    idx = int(round(percent / 100.0 * (len(sorted_samples) - 1)))
+    return sorted_samples[idx]
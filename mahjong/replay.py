@@ -0,0 +1,238 @@
+'''
+Record games as replays: the players' decisions fed to every
+``flow.next()``, the shuffled walls, and a keyframe snapshot every N
+transitions, so any point of a game can be rebuilt by replaying at most N
+transitions::
+
+    recorder = flow.add_observer(context, replay.Recorder())
+    flow.run_until(context, flow.after_matches(4))
+    flow.remove_observer(context, recorder)
+
+    data = recorder.replay.dumps()
+    log = replay.loads(data)
+    context = log.seek(123, settings)  # before the 124th transition
+    log.verify(settings)               # None if the log replays as recorded
+
+Only what flow.next() does is recorded. Changing a context between
+transitions in other ways (except setting players' decisions) breaks the
+replay, and so does ``flow.precompute_reactions()``, which leaves a table in
+``context.extra``.
+
+Keyframes are snapshots (see ``mahjong.snapshot``), so settings aren't
+recorded either; pass the ones of the game to ``seek()`` and ``verify()``.
+
+'''
+import struct
+
+from mahjong import flow, snapshot
+from mahjong.snapshot import _dump_value, _encode, _load_value, _Reader
+
+
+MAGIC = 'MR'
+VERSION = 1
+
+_HEADER = struct.Struct('<2sBII')
+_UINT = struct.Struct('<I')
+_SHORT = struct.Struct('<H')
+
+# bits of a step's flags, bits 0-3 tell which players have decisions
+_OK = 0x10
+_WALL = 0x20
+_FULL_VALIDATION = 0x40
+
+
+class Step(object):
+    '''
+    A recorded transition:
+    * decisions: The decisions of the four players before the transition.
+    * ok: Whether the transition succeeded.
+    * wall: The shuffled wall if the transition started a match, else None.
+    * full_validation: Whether the started match was picked for full
+                       validation (see ``GameSettings.validate_sample_rate``).
+
+    '''
+    __slots__ = ('decisions', 'ok', 'wall', 'full_validation')
+
+    def __init__(self, decisions, ok=True, wall=None, full_validation=False):
+        self.decisions = decisions
+        self.ok = ok
+        self.wall = wall
+        self.full_validation = full_validation
+
+    def __eq__(self, other):
+        return (self.decisions == other.decisions and
+                self.ok == other.ok and
+                self.wall == other.wall and
+                self.full_validation == other.full_validation)
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class Replay(object):
+    '''
+    A replay has a list of Steps and keyframes, where keyframe i is a
+    snapshot of the context before step i * keyframe_interval. ``len()`` of
+    a replay is the number of steps.
+
+    '''
+    def __init__(self, keyframe_interval=100):
+        if keyframe_interval < 1:
+            raise ValueError('keyframe_interval must be positive')
+        self.keyframe_interval = keyframe_interval
+        self.keyframes = []
+        self.steps = []
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __eq__(self, other):
+        return (self.keyframe_interval == other.keyframe_interval and
+                self.keyframes == other.keyframes and
+                self.steps == other.steps)
+
+    def seek(self, step, settings=None):
+        '''
+        Return the context right before the step-th transition, with the
+        players' decisions of that transition in place. ``seek(len(replay))``
+        is the context after the last transition.
+
+        '''
+        if step < 0 or step > len(self.steps):
+            raise IndexError('step out of range')
+        idx = min(step // self.keyframe_interval, len(self.keyframes) - 1)
+        context = snapshot.loads(self.keyframes[idx], settings)
+        # steps that succeeded when recorded are trusted
+        for recorded in self.steps[idx * self.keyframe_interval:step]:
+            _replay_step(context, recorded, recorded.ok)
+        if step < len(self.steps):
+            _set_decisions(context, self.steps[step].decisions)
+        return context
+
+    def verify(self, settings=None, context=None):
+        '''
+        Replay the whole log from the first keyframe with all the integrity
+        checks, and check every result and every keyframe on the way. If
+        context is given, the final state must equal it too. Return the
+        number of the first step where the replay goes another way than
+        recorded, or None if it doesn't.
+
+        '''
+        if not self.keyframes:
+            return None
+        replayed = snapshot.loads(self.keyframes[0], settings)
+        interval = self.keyframe_interval
+        for i, step in enumerate(self.steps):
+            if i and i % interval == 0:
+                _set_decisions(replayed, step.decisions)
+                if not replayed == snapshot.loads(self.keyframes[i // interval], settings):
+                    return i
+            if _replay_step(replayed, step, False) != step.ok:
+                return i
+        if context is not None and not replayed == context:
+            return len(self.steps)
+        return None
+
+    def dumps(self):
+        '''Return the replay as a string.'''
+        out = [_HEADER.pack(MAGIC, VERSION, self.keyframe_interval, len(self.keyframes))]
+        for keyframe in self.keyframes:
+            out.append(_UINT.pack(len(keyframe)))
+            out.append(keyframe)
+        out.append(_UINT.pack(len(self.steps)))
+        for step in self.steps:
+            flags = 0
+            for i, decision in enumerate(step.decisions):
+                if decision is not None:
+                    flags |= 1 << i
+            if step.ok:
+                flags |= _OK
+            if step.wall is not None:
+                flags |= _WALL
+            if step.full_validation:
+                flags |= _FULL_VALIDATION
+            out.append(chr(flags))
+            for decision in step.decisions:
+                if decision is not None:
+                    _dump_value(out, decision)
+            if step.wall is not None:
+                out.append(_SHORT.pack(len(step.wall)))
+                out.append(_encode(step.wall))
+        return ''.join(out)
+
+
+def loads(data):
+    '''
+    Rebuild a Replay from ``Replay.dumps()``. Raise ValueError if the data
+    isn't a replay of this version.
+
+    '''
+    reader = _Reader(data)
+    try:
+        magic, version, keyframe_interval, num_keyframes = reader.unpack(_HEADER)
+        if magic != MAGIC:
+            raise ValueError('Not a replay')
+        if version != VERSION:
+            raise ValueError('Unsupported replay version: %d' % version)
+
+        replay = Replay(keyframe_interval)
+        for __ in xrange(num_keyframes):
+            replay.keyframes.append(reader.read(reader.unpack(_UINT)[0]))
+        for __ in xrange(reader.unpack(_UINT)[0]):
+            flags = reader.byte()
+            decisions = [_load_value(reader) if flags & (1 << i) else None
+                         for i in xrange(4)]
+            wall = None
+            if flags & _WALL:
+                wall = reader.tiles(reader.unpack(_SHORT)[0])
+            replay.steps.append(Step(decisions, bool(flags & _OK), wall,
+                                     bool(flags & _FULL_VALIDATION)))
+    except (struct.error, IndexError, KeyError) as e:
+        raise ValueError('Corrupt replay: %s' % e)
+    if reader.pos != len(data):
+        raise ValueError('Trailing data after replay')
+    return replay
+
+
+class Recorder(flow.Observer):
+    '''
+    A flow observer that records every transition of the context it's added
+    to into ``Recorder.replay``. The first keyframe is taken at the first
+    transition.
+
+    '''
+    def __init__(self, keyframe_interval=100):
+        self.replay = Replay(keyframe_interval)
+
+    def before_validate(self, state, context):
+        replay = self.replay
+        if len(replay.steps) % replay.keyframe_interval == 0:
+            replay.keyframes.append(snapshot.dumps(context))
+        replay.steps.append(Step([player.decision for player in context.players]))
+
+    def on_result(self, state, context, result):
+        step = self.replay.steps[-1]
+        step.ok = bool(result)
+        if result and state == 'start':
+            # the wall is shuffled at random
+            step.wall = list(context.wall)
+            step.full_validation = bool(context.extra.get('full_validation'))
+
+
+def _set_decisions(context, decisions):
+    for player, decision in zip(context.players, decisions):
+        player.decision = decision
+
+
+def _replay_step(context, step, trusted):
+    # return whether the transition succeeds
+    _set_decisions(context, step.decisions)
+    state = context.state
+    result = bool(flow.next(context, trusted))
+    if result and state == 'start':
+        context.wall.tiles = list(step.wall)
+        if step.full_validation:
+            context.extra['full_validation'] = True
+        else:
+            context.extra.pop('full_validation', None)
+    return result
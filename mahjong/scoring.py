@@ -1,8 +1,65 @@
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from mahjong.patterns import MatchResult
+
+
 def score(scorer_name, match_results, patterns_score):
+    return _get_scorer(scorer_name).score(match_results, patterns_score)
+
+
+def score_batch(scorer_name, multipliers, pattern_names, patterns_score):
+    '''
+    Score many wins at once, e.g., for offline analysis of archived games.
+    See ``Scorer.score_batch()`` and ``to_multipliers()``.
+
+    '''
+    return _get_scorer(scorer_name).score_batch(multipliers, pattern_names, patterns_score)
+
+
+def to_multipliers(match_results_list, pattern_names, pattern_indices=None):
+    '''
+    Pack the match results of many wins into a dense (wins x patterns x 4)
+    multiplier array, where the patterns are ordered by ``pattern_names``.
+    Patterns that a win doesn't match are all zeros. Return a NumPy array if
+    NumPy is installed, or nested lists otherwise.
+
+    ``pattern_indices`` maps names to their indices in ``pattern_names``. It's
+    built from ``pattern_names`` if not given, so pass
+    ``FrozenSettings.pattern_names`` and ``pattern_indices`` to reuse them.
+
+    '''
+    indices = pattern_indices
+    if indices is None:
+        indices = dict((name, i) for i, name in enumerate(pattern_names))
+    result = []
+    for match_results in match_results_list:
+        win = [[0, 0, 0, 0] for __ in pattern_names]
+        for pattern_name, match_result in match_results.iteritems():
+            win[indices[pattern_name]] = list(match_result)
+        result.append(win)
+    if numpy:
+        return numpy.array(result, dtype=numpy.int64).reshape((len(result), len(pattern_names), 4))
+    return result
+
+
+def pattern_vector(pattern_names, patterns_score):
+    '''
+    Return the scores of ``pattern_names`` in order, looked up from
+    ``patterns_score`` (the same as ``GameSettings.patterns_score``), e.g.,
+    ``pattern_vector(settings.pattern_names, settings.patterns_score)``.
+
+    '''
+    return [patterns_score[pattern_name][0] for pattern_name in pattern_names]
+
+
+def _get_scorer(scorer_name):
     scorer = _SCORERS.get(scorer_name)
     if not scorer:
         raise KeyError('Scorer `%s` not found' % scorer_name)
-    return scorer.score(match_results, patterns_score)
+    return scorer
 
 
 class Scorer(object):
@@ -21,6 +78,35 @@ class Scorer(object):
         '''
         raise NotImplementedError
 
+    def score_batch(self, multipliers, pattern_names, patterns_score):
+        '''
+        Score many wins at once. Return a (wins x 4) matrix whose rows are
+        the same as what ``score()`` returns for each win.
+
+        :param multipliers: A (wins x patterns x 4) array from
+                            ``to_multipliers()``.
+        :param pattern_names: Pattern names in the same order as the second
+                              axis of ``multipliers``.
+        :param patterns_score: Same as ``score()``.
+
+        The default implementation converts each win back to match results and
+        calls ``score()``. Subclasses may do better.
+
+        '''
+        result = []
+        for win in multipliers:
+            match_results = {}
+            for pattern_name, row in zip(pattern_names, win):
+                if any(row):
+                    match_result = MatchResult()
+                    for i in xrange(0, 4):
+                        match_result.set(i, int(row[i]))
+                    match_results[pattern_name] = match_result
+            result.append(self.score(match_results, patterns_score))
+        if numpy:
+            return numpy.array(result, dtype=numpy.int64).reshape((len(result), 4))
+        return result
+
 
 class TWScorer(Scorer):
 
@@ -32,12 +118,105 @@ class TWScorer(Scorer):
                 result[i] += match_result.get(i) * pattern_score
         return result
 
+    def score_batch(self, multipliers, pattern_names, patterns_score):
+        vector = pattern_vector(pattern_names, patterns_score)
+        if numpy:
+            # sum of multiplier x pattern score over the pattern axis
+            return numpy.einsum('wpk,p->wk', numpy.asarray(multipliers), numpy.asarray(vector))
+
+        result = []
+        for win in multipliers:
+            row = [0, 0, 0, 0]
+            for pattern_score, pattern_multipliers in zip(vector, win):
+                for i in xrange(0, 4):
+                    row[i] += pattern_multipliers[i] * pattern_score
+            result.append(row)
+        return result
+
 
 class JPScorer(Scorer):
+    '''
+    Japanese-style scorer. Si is the basic points that player i pays, before
+    the dealer and self-picked payment factors are applied: a payment is
+    basic points x 6 (dealer on discard), x 4 (non-dealer on discard), x 2
+    (dealer on self-picked) or x 1 (non-dealer on self-picked), rounded up
+    to 100. The factors are left to the caller, scores of all the scorers
+    are added and compared the same way.
+
+    Scores in ``patterns_score`` are in units of 'han' or 'yakuman'. The fu of
+    the hand comes from the 'fu' pattern (unit 'fu', the score is ignored),
+    which should be listed in ``patterns_score`` as well. _DEFAULT_FU is used
+    if it's missing or doesn't match, e.g., a flower win.
 
+    '''
     def score(self, match_results, patterns_score):
-        # TODO
-        raise NotImplementedError
+        han = [0, 0, 0, 0]
+        yakuman = [0, 0, 0, 0]
+        fu = _DEFAULT_FU
+        for pattern_name, match_result in match_results.iteritems():
+            pattern_score, unit = patterns_score.get(pattern_name)
+            if unit == 'fu':
+                fu = match_result.extra
+                continue
+            counter = yakuman if unit == 'yakuman' else han
+            for i in xrange(0, 4):
+                counter[i] += match_result.get(i) * pattern_score
+
+        result = [0, 0, 0, 0]
+        for i in xrange(0, 4):
+            if yakuman[i]:
+                result[i] = yakuman[i] * _YAKUMAN_POINTS
+            elif han[i] >= _MIN_LIMIT_HAN:
+                result[i] = _LIMIT_POINTS[min(han[i], _MAX_HAN)]
+            elif han[i] > 0:
+                result[i] = _basic_points(fu)[han[i]]
+        return result
+
+
+# Limit hands: han -> basic points, None if the hand is scored by fu
+_LIMIT_POINTS = (None, None, None, None, None,
+                 2000,                # mangan
+                 3000, 3000,          # haneman
+                 4000, 4000, 4000,    # baiman
+                 6000, 6000,          # sanbaiman
+                 8000)                # kazoe yakuman
+_MIN_LIMIT_HAN = _LIMIT_POINTS.index(2000)
+_MAX_HAN = len(_LIMIT_POINTS) - 1
+_YAKUMAN_POINTS = 8000
+_MANGAN_POINTS = 2000
+_DEFAULT_FU = 30
+
+
+def _fu_points(fu):
+    '''
+    Return the basic points of 0, 1, ..., _MIN_LIMIT_HAN - 1 han with the
+    given fu, capped at mangan.
+
+    '''
+    return tuple([0] + [min(fu * 2 ** (han + 2), _MANGAN_POINTS)
+                        for han in xrange(1, _MIN_LIMIT_HAN)])
+
+
+def _build_basic_points():
+    '''
+    Build the table fu -> basic points of the non-limit hands of the usual
+    fu, so JPScorer doesn't compute them per win.
+
+    '''
+    result = {}
+    for fu in [20, 25] + range(30, 120, 10):
+        result[fu] = _fu_points(fu)
+    return result
+
+_BASIC_POINTS = _build_basic_points()
+
+
+def _basic_points(fu):
+    points = _BASIC_POINTS.get(fu)
+    if points is None:
+        # rare fu like 120 or 130, or fu that isn't rounded up
+        points = _fu_points(fu)
+    return points
 
 
 _SCORERS = {
@@ -0,0 +1,625 @@
+'''
+Save a GameContext as a compact, versioned binary snapshot and load it back,
+e.g., to persist a game, migrate it or send it over the network::
+
+    data = snapshot.dumps(context)
+    context2 = snapshot.loads(data, context.settings)
+    context2 == context  # True
+
+A snapshot has everything GameContext.__eq__() compares except the
+settings, which belong to the game rather than the context, so pass them to
+``loads()``. The journal isn't saved, just like ``GameContext.clone()``.
+
+Layout (little-endian)::
+
+    header    'MJ', version, cur_player_idx, last_player_idx, round, match,
+              dealer, dealer_defended
+    state     length + ASCII
+    winners   count (255 if None) + one byte per index
+    wall      flags (0 if None) + count + one byte per tile
+    players   4 x (counts, last tile, free tiles, flowers, discarded,
+              groups, decision, extra)
+    pool      count + one byte per tile
+    ledger    entries, running sums, rounds, dealers and the per-round and
+              per-dealer totals
+    extra     encoded value
+
+Every tile takes one byte (0 is None), and a fixed group is its type byte
+followed by its 3 or 4 tiles. Decisions and ``extra`` dictionaries are
+encoded as tagged values: None, bools, ints, floats, strings, tiles, tile
+groups, MatchResults, and lists, tuples, sets and dictionaries of them.
+Anything else raises TypeError.
+
+To keep a copy of a context up to date, e.g., on a live client, send a
+full snapshot once and then deltas from ``diff()``, which ``patch()``
+applies. A delta has the versions (sequence numbers) it goes from and to,
+so a client that finds a gap with ``delta_seqs()`` can ask for a full
+snapshot again.
+
+'''
+import array
+import struct
+
+from collections import Mapping
+
+from mahjong.patterns import MatchResult
+from mahjong.types import GameContext, Tile, TileGroup, Wall
+
+
+MAGIC = 'MJ'
+DELTA_MAGIC = 'MD'
+VERSION = 1
+
+# tile <-> one-byte code, 0 is None. Codes are looked up by tile_id, which
+# is much faster than hashing tiles.
+_TILES = [None] + sorted(Tile.ALL.itervalues())
+_CODES = dict((tile.tile_id, chr(code)) for code, tile in enumerate(_TILES) if tile)
+
+_HEADER = struct.Struct('<2sB')
+# cur_player_idx, last_player_idx, round, match, dealer, dealer_defended
+_FIELDS = struct.Struct('<bbiibH')
+# numbers of free tiles, flowers, discarded tiles and fixed groups
+_PLAYER = struct.Struct('<4B')
+_BYTE = struct.Struct('<B')
+_SHORT = struct.Struct('<H')
+_UINT = struct.Struct('<I')
+_LONG = struct.Struct('<q')
+_FLOAT = struct.Struct('<d')
+_TOTALS = struct.Struct('<i4i')
+_MULTIPLIERS = struct.Struct('<4i')
+
+# wall flags, bit 0 means there's a wall
+_WALL_ATTRS = ('chars', 'circles', 'bamboos', 'honors', 'flowers')
+
+# delta: base version, version
+_SEQS = struct.Struct('<II')
+
+# what a delta has, bits 8-11 are players 0-3
+_D_FIELDS = 0x01
+_D_STATE = 0x02
+_D_WINNERS = 0x04
+_D_WALL = 0x08
+_D_POOL = 0x10
+_D_LEDGER = 0x20
+_D_EXTRA = 0x40
+_D_PLAYER = 0x100
+_D_PLAYERS = 0xf00
+
+# what a player's delta has
+_P_FREE_TILES = 0x01
+_P_LAST_TILE = 0x02
+_P_FLOWERS = 0x04
+_P_GROUPS = 0x08
+_P_DISCARDED = 0x10
+_P_DECISION = 0x20
+_P_EXTRA = 0x40
+
+
+def dumps(context):
+    '''Return a snapshot of a GameContext as a string.'''
+    out = [_HEADER.pack(MAGIC, VERSION)]
+    _dump_fields(out, context)
+    _dump_str(out, context.state)
+    _dump_winners(out, context.winners)
+    _dump_wall(out, context.wall)
+
+    for player in context.players:
+        hand = player.hand
+        out.append(_PLAYER.pack(len(hand.free_tiles), len(hand.flowers),
+                                len(player.discarded), len(hand.fixed_groups)))
+        out.append(_CODES[hand.last_tile.tile_id] if hand.last_tile else '\x00')
+        out.append(_encode(hand.free_tiles))
+        out.append(_encode(hand.flowers))
+        out.append(_encode(player.discarded))
+        for group in hand.fixed_groups:
+            out.append(chr(group.group_type) + _encode(group.tiles))
+        _dump_value(out, player.decision)
+        _dump_value(out, player.extra)
+
+    _dump_tiles(out, context.discarded_pool, _SHORT)
+    _dump_ledger(out, context.ledger)
+    _dump_value(out, context.extra)
+    return ''.join(out)
+
+
+def loads(data, settings=None):
+    '''
+    Rebuild a GameContext from a snapshot made by ``dumps()``. Raise
+    ValueError if the data isn't a snapshot of this version.
+
+    '''
+    try:
+        return _load(_Reader(data), settings)
+    except (struct.error, IndexError, KeyError) as e:
+        raise ValueError('Corrupt snapshot: %s' % e)
+
+
+def _load(reader, settings):
+    _check_header(reader, MAGIC, 'snapshot')
+    context = GameContext(settings)
+    _load_fields(reader, context)
+    context.state = reader.read(reader.byte())
+    context.winners = _load_winners(reader)
+    context.wall = _load_wall(reader)
+
+    for player in context.players:
+        hand = player.hand
+        num_free, num_flowers, num_discarded, num_groups = reader.unpack(_PLAYER)
+        tiles = reader.tiles(1 + num_free + num_flowers + num_discarded)
+        hand.last_tile = tiles[0]
+        end = 1 + num_free
+        hand.free_tiles = tiles[1:end]
+        hand.flowers = tiles[end:end + num_flowers]
+        player.discarded = tiles[end + num_flowers:]
+        for __ in xrange(num_groups):
+            hand.fixed_groups.append(_load_group(reader))
+        player.decision = _load_value(reader)
+        player.extra = _load_value(reader)
+
+    context.discarded_pool = reader.tiles(reader.unpack(_SHORT)[0])
+    _load_ledger(reader, context.ledger)
+    context.extra = _load_value(reader)
+    reader.check_end()
+    return context
+
+
+def diff(old, new, base_seq, seq):
+    '''
+    Return a delta that turns context old (version base_seq) into context
+    new (version seq), e.g., to send a live client the changes of a
+    transition instead of a full snapshot::
+
+        last = context.clone()
+        flow.next(context)
+        send(snapshot.diff(last, context, seq, seq + 1))
+
+    Only what has changed is in a delta: the fields of the context, the
+    state, winners, extra, the wall, the discarded pool and the ledger, and
+    per player the free tiles, last tile, flowers, groups, discarded tiles,
+    decision and extra. Tile lists are sent as the length of the prefix they
+    keep plus the tiles after it, a wall that has only been drawn from is
+    sent as its length, and new ledger entries are sent on their own.
+
+    '''
+    out = [_HEADER.pack(DELTA_MAGIC, VERSION), _SEQS.pack(base_seq, seq)]
+    flags_idx = len(out)
+    out.append(None)
+    flags = 0
+
+    if (old.cur_player_idx != new.cur_player_idx or
+            old.last_player_idx != new.last_player_idx or
+            old.round != new.round or old.match != new.match or
+            old.dealer != new.dealer or old.dealer_defended != new.dealer_defended):
+        flags |= _D_FIELDS
+        _dump_fields(out, new)
+    if old.state != new.state:
+        flags |= _D_STATE
+        _dump_str(out, new.state)
+    if old.winners != new.winners:
+        flags |= _D_WINNERS
+        _dump_winners(out, new.winners)
+    if not _same_wall(old.wall, new.wall):
+        flags |= _D_WALL
+        _dump_wall_delta(out, old.wall, new.wall)
+    if old.discarded_pool != new.discarded_pool:
+        flags |= _D_POOL
+        _dump_tiles_delta(out, old.discarded_pool, new.discarded_pool, _SHORT)
+    if not old.ledger == new.ledger:
+        flags |= _D_LEDGER
+        _dump_ledger_delta(out, old.ledger, new.ledger)
+    if old.extra != new.extra:
+        flags |= _D_EXTRA
+        _dump_value(out, new.extra)
+
+    for i, (old_player, new_player) in enumerate(zip(old.players, new.players)):
+        player_idx = len(out)
+        out.append(None)
+        player_flags = _dump_player_delta(out, old_player, new_player)
+        if player_flags:
+            flags |= _D_PLAYER << i
+            out[player_idx] = chr(player_flags)
+        else:
+            del out[player_idx:]
+
+    out[flags_idx] = _SHORT.pack(flags)
+    return ''.join(out)
+
+
+def delta_seqs(delta):
+    '''
+    Return a tuple of (base_seq, seq) of a delta, e.g., for a client to
+    detect a gap and ask for a full snapshot instead.
+
+    '''
+    reader = _Reader(delta)
+    try:
+        _check_header(reader, DELTA_MAGIC, 'delta')
+        return reader.unpack(_SEQS)
+    except struct.error as e:
+        raise ValueError('Corrupt delta: %s' % e)
+
+
+def patch(context, delta, seq):
+    '''
+    Apply a delta made by ``diff()`` to a context of version seq in place.
+    Return the version of the context after the delta. Raise ValueError if
+    the delta isn't based on version seq (the context is left as it is) or
+    is corrupt.
+
+    '''
+    base_seq, new_seq = delta_seqs(delta)
+    if base_seq != seq:
+        raise ValueError('Delta is based on version %d, not %d' % (base_seq, seq))
+    reader = _Reader(delta)
+    reader.pos = _HEADER.size + _SEQS.size
+    try:
+        _patch(reader, context)
+    except (struct.error, IndexError, KeyError) as e:
+        raise ValueError('Corrupt delta: %s' % e)
+    return new_seq
+
+
+def _patch(reader, context):
+    flags = reader.unpack(_SHORT)[0]
+    if flags & _D_FIELDS:
+        _load_fields(reader, context)
+    if flags & _D_STATE:
+        context.state = reader.read(reader.byte())
+    if flags & _D_WINNERS:
+        context.winners = _load_winners(reader)
+    if flags & _D_WALL:
+        context.wall = _load_wall_delta(reader, context.wall)
+    if flags & _D_POOL:
+        context.discarded_pool = _load_tiles_delta(reader, context.discarded_pool, _SHORT)
+    if flags & _D_LEDGER:
+        _load_ledger_delta(reader, context.ledger)
+    if flags & _D_EXTRA:
+        context.extra = _load_value(reader)
+
+    for i, player in enumerate(context.players):
+        if flags & (_D_PLAYER << i):
+            _load_player_delta(reader, player)
+    reader.check_end()
+
+
+class _Reader(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def read(self, size):
+        pos = self.pos
+        end = pos + size
+        if end > len(self.data):
+            raise IndexError('snapshot is truncated')
+        self.pos = end
+        return self.data[pos:end]
+
+    def byte(self):
+        return ord(self.read(1))
+
+    def unpack(self, fmt):
+        values = fmt.unpack_from(self.data, self.pos)
+        self.pos += fmt.size
+        return values
+
+    def tiles(self, num_tiles):
+        return [_TILES[code] for code in bytearray(self.read(num_tiles))]
+
+    def check_end(self):
+        if self.pos != len(self.data):
+            raise ValueError('Trailing data')
+
+
+def _check_header(reader, magic, name):
+    header_magic, version = reader.unpack(_HEADER)
+    if header_magic != magic:
+        raise ValueError('Not a %s' % name)
+    if version != VERSION:
+        raise ValueError('Unsupported %s version: %d' % (name, version))
+
+
+def _dump_fields(out, context):
+    out.append(_FIELDS.pack(_index(context.cur_player_idx), _index(context.last_player_idx),
+                            context.round, context.match, context.dealer,
+                            context.dealer_defended))
+
+
+def _load_fields(reader, context):
+    (cur_player_idx, last_player_idx, context.round, context.match, context.dealer,
+     context.dealer_defended) = reader.unpack(_FIELDS)
+    context.cur_player_idx = cur_player_idx if cur_player_idx >= 0 else None
+    context.last_player_idx = last_player_idx if last_player_idx >= 0 else None
+
+
+def _index(idx):
+    return -1 if idx is None else idx
+
+
+def _dump_winners(out, winners):
+    if winners is None:
+        out.append('\xff')
+    else:
+        out.append(chr(len(winners)) + str(bytearray(winners)))
+
+
+def _load_winners(reader):
+    num_winners = reader.byte()
+    if num_winners == 0xff:
+        return None
+    return list(bytearray(reader.read(num_winners)))
+
+
+def _dump_wall(out, wall):
+    if wall is None:
+        out.append('\x00')
+        return
+    flags = 1
+    for i, attr in enumerate(_WALL_ATTRS):
+        if getattr(wall, attr):
+            flags |= 2 << i
+    out.append(chr(flags))
+    _dump_tiles(out, list(wall), _SHORT)
+
+
+def _load_wall(reader):
+    flags = reader.byte()
+    if not flags:
+        return None
+    wall = Wall(chars=False, circles=False, bamboos=False, honors=False, flowers=False)
+    for i, attr in enumerate(_WALL_ATTRS):
+        setattr(wall, attr, bool(flags & (2 << i)))
+    wall.tiles = reader.tiles(reader.unpack(_SHORT)[0])
+    return wall
+
+
+def _encode(tiles):
+    codes = _CODES
+    return ''.join([codes[tile.tile_id] for tile in tiles])
+
+
+def _dump_tiles(out, tiles, count_fmt):
+    out.append(count_fmt.pack(len(tiles)))
+    out.append(_encode(tiles))
+
+
+def _load_group(reader):
+    group_type = reader.byte()
+    num_tiles = 4 if group_type >= TileGroup.KONG_EXPOSED else 3
+    return TileGroup(reader.tiles(num_tiles), group_type)
+
+
+def _common_prefix(old, new):
+    n = min(len(old), len(new))
+    if old[:n] == new[:n]:
+        return n
+    i = 0
+    # tiles are singletons
+    while old[i] is new[i]:
+        i += 1
+    return i
+
+
+def _dump_tiles_delta(out, old, new, count_fmt):
+    n = _common_prefix(old, new)
+    out.append(count_fmt.pack(n))
+    _dump_tiles(out, new[n:], count_fmt)
+
+
+def _load_tiles_delta(reader, tiles, count_fmt):
+    n = reader.unpack(count_fmt)[0]
+    return tiles[:n] + reader.tiles(reader.unpack(count_fmt)[0])
+
+
+def _same_wall(old, new):
+    if old is None or new is None:
+        return old is new
+    if old.num_tiles() != new.num_tiles():
+        return False
+    # a clone shares the list with its original
+    return old._tiles is new._tiles or old == new
+
+
+def _dump_wall_delta(out, old, new):
+    if old is not None and new is not None:
+        n = new.num_tiles()
+        if n < old.num_tiles() and (old._tiles is new._tiles or
+                                    list(new) == list(old)[:n]):
+            # drawn from
+            out.append('d' + _SHORT.pack(n))
+            return
+    out.append('w')
+    _dump_wall(out, new)
+
+
+def _load_wall_delta(reader, wall):
+    if reader.read(1) == 'd':
+        del wall.tiles[reader.unpack(_SHORT)[0]:]
+        return wall
+    return _load_wall(reader)
+
+
+def _dump_ledger_delta(out, old, new):
+    n = len(old)
+    if (n <= len(new) and new._sums[:n * 4 + 4] == old._sums and
+            new._rounds[:n] == old._rounds and new._dealers[:n] == old._dealers):
+        # appended to
+        out.append('a' + _UINT.pack(len(new) - n))
+        for idx in xrange(n, len(new)):
+            points, round, dealer = new.entry(idx)
+            out.append(_TOTALS.pack(round, *points) + chr(dealer))
+        return
+    out.append('l')
+    _dump_ledger(out, new)
+
+
+def _load_ledger_delta(reader, ledger):
+    if reader.read(1) == 'a':
+        for __ in xrange(reader.unpack(_UINT)[0]):
+            values = reader.unpack(_TOTALS)
+            ledger.append(values[1:], values[0], reader.byte())
+        return
+    ledger.clear()
+    _load_ledger(reader, ledger)
+
+
+def _dump_player_delta(out, old, new):
+    # return the flags of what has changed
+    flags = 0
+    old_hand = old.hand
+    new_hand = new.hand
+    if old_hand.free_tiles != new_hand.free_tiles:
+        flags |= _P_FREE_TILES
+        _dump_tiles_delta(out, old_hand.free_tiles, new_hand.free_tiles, _BYTE)
+    if old_hand.last_tile is not new_hand.last_tile:
+        flags |= _P_LAST_TILE
+        out.append(_CODES[new_hand.last_tile.tile_id] if new_hand.last_tile else '\x00')
+    if old_hand.flowers != new_hand.flowers:
+        flags |= _P_FLOWERS
+        _dump_tiles_delta(out, old_hand.flowers, new_hand.flowers, _BYTE)
+    if old_hand.fixed_groups != new_hand.fixed_groups:
+        flags |= _P_GROUPS
+        out.append(chr(len(new_hand.fixed_groups)))
+        for group in new_hand.fixed_groups:
+            out.append(chr(group.group_type) + _encode(group.tiles))
+    if old.discarded != new.discarded:
+        flags |= _P_DISCARDED
+        _dump_tiles_delta(out, old.discarded, new.discarded, _BYTE)
+    if not old.decision == new.decision:
+        flags |= _P_DECISION
+        _dump_value(out, new.decision)
+    if old.extra != new.extra:
+        flags |= _P_EXTRA
+        _dump_value(out, new.extra)
+    return flags
+
+
+def _load_player_delta(reader, player):
+    flags = reader.byte()
+    hand = player.hand
+    if flags & _P_FREE_TILES:
+        hand.free_tiles = _load_tiles_delta(reader, hand.free_tiles, _BYTE)
+    if flags & _P_LAST_TILE:
+        hand.last_tile = _TILES[reader.byte()]
+    if flags & _P_FLOWERS:
+        hand.flowers = _load_tiles_delta(reader, hand.flowers, _BYTE)
+    if flags & _P_GROUPS:
+        hand.fixed_groups = [_load_group(reader) for __ in xrange(reader.byte())]
+    if flags & _P_DISCARDED:
+        player.discarded = _load_tiles_delta(reader, player.discarded, _BYTE)
+    if flags & _P_DECISION:
+        player.decision = _load_value(reader)
+    if flags & _P_EXTRA:
+        player.extra = _load_value(reader)
+
+
+def _dump_str(out, value):
+    out.append(chr(len(value)) + value)
+
+
+def _dump_ledger(out, ledger):
+    # ScoreLedger is stored as is, so nothing has to be summed up again
+    n = len(ledger)
+    out.append(_UINT.pack(n))
+    out.append(struct.pack('<%di' % (n * 4 + 4), *ledger._sums))
+    out.append(struct.pack('<%di' % n, *ledger._rounds))
+    out.append(struct.pack('<%db' % n, *ledger._dealers))
+    for totals in (ledger._round_totals, ledger._dealer_totals):
+        out.append(_UINT.pack(len(totals)))
+        for key, seat_totals in totals.iteritems():
+            out.append(_TOTALS.pack(key, *seat_totals))
+
+
+def _load_ledger(reader, ledger):
+    n = reader.unpack(_UINT)[0]
+    ledger._sums = array.array('l', reader.unpack(struct.Struct('<%di' % (n * 4 + 4))))
+    ledger._rounds = array.array('l', reader.unpack(struct.Struct('<%di' % n)))
+    ledger._dealers = array.array('b', reader.unpack(struct.Struct('<%db' % n)))
+    for totals in (ledger._round_totals, ledger._dealer_totals):
+        for __ in xrange(reader.unpack(_UINT)[0]):
+            values = reader.unpack(_TOTALS)
+            totals[values[0]] = list(values[1:])
+
+
+def _dump_value(out, value):
+    if value is None:
+        out.append('N')
+    elif value is True:
+        out.append('T')
+    elif value is False:
+        out.append('F')
+    elif isinstance(value, Tile):
+        out.append('t' + _CODES[value.tile_id])
+    elif isinstance(value, (int, long)):
+        if -128 <= value < 128:
+            out.append('b' + chr(value & 0xff))
+        else:
+            out.append('q' + _LONG.pack(value))
+    elif isinstance(value, float):
+        out.append('d' + _FLOAT.pack(value))
+    elif isinstance(value, str):
+        out.append('s' + _UINT.pack(len(value)) + value)
+    elif isinstance(value, unicode):
+        value = value.encode('utf-8')
+        out.append('u' + _UINT.pack(len(value)) + value)
+    elif isinstance(value, TileGroup):
+        out.append('g' + chr(value.group_type) + _encode(value.tiles))
+    elif isinstance(value, MatchResult):
+        out.append('m' + _MULTIPLIERS.pack(*value))
+        _dump_value(out, value.extra)
+    elif isinstance(value, (dict, Mapping)):
+        out.append('D' + _UINT.pack(len(value)))
+        for key, item in value.iteritems():
+            _dump_value(out, key)
+            _dump_value(out, item)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        out.append(_CONTAINER_TAGS[type(value)] + _UINT.pack(len(value)))
+        for item in value:
+            _dump_value(out, item)
+    else:
+        raise TypeError('Cannot snapshot %r' % (value,))
+
+
+_CONTAINER_TAGS = {list: 'L', tuple: 'P', set: 'S', frozenset: 'Z'}
+_CONTAINER_TYPES = dict((tag, t) for t, tag in _CONTAINER_TAGS.iteritems())
+
+
+def _load_value(reader):
+    tag = reader.read(1)
+    if tag == 'N':
+        return None
+    elif tag == 'T':
+        return True
+    elif tag == 'F':
+        return False
+    elif tag == 't':
+        return _TILES[reader.byte()]
+    elif tag == 'b':
+        value = reader.byte()
+        return value - 256 if value >= 128 else value
+    elif tag == 'q':
+        return reader.unpack(_LONG)[0]
+    elif tag == 'd':
+        return reader.unpack(_FLOAT)[0]
+    elif tag == 's':
+        return reader.read(reader.unpack(_UINT)[0])
+    elif tag == 'u':
+        return reader.read(reader.unpack(_UINT)[0]).decode('utf-8')
+    elif tag == 'g':
+        return _load_group(reader)
+    elif tag == 'm':
+        result = MatchResult()
+        result._multipliers = list(reader.unpack(_MULTIPLIERS))
+        result.extra = _load_value(reader)
+        return result
+    elif tag == 'D':
+        value = {}
+        for __ in xrange(reader.unpack(_UINT)[0]):
+            key = _load_value(reader)
+            value[key] = _load_value(reader)
+        return value
+    elif tag in _CONTAINER_TYPES:
+        items = [_load_value(reader) for __ in xrange(reader.unpack(_UINT)[0])]
+        return items if tag == 'L' else _CONTAINER_TYPES[tag](items)
+    raise ValueError('Unknown value tag: %r' % tag)
@@ -0,0 +1,194 @@
+'''
+Per-suit-row lookup tables for hand analysis.
+
+A hand of free tiles is split into four "rows" (chars, circles, bamboos, and
+honors, the same layout as ``Hand._construct_hand_table()``). A row is a
+tuple of nine tile counts, where the ith element is the number of tiles whose
+face value is i + 1. Honors use the first seven slots (east, south, west,
+north, red, green, white) and can't form sequences.
+
+Rows are independent of each other, so everything here is computed once per
+distinct row and cached. Hand-level answers are then assembled from a few
+table probes instead of repeated win checks on copied hands.
+
+'''
+# Group kinds used in decompositions
+PAIR = 'pair'
+TRIPLET = 'triplet'
+SEQUENCE = 'sequence'
+
+# Wait shapes, i.e., how a waiting tile completes a hand
+EDGE = 'edge'                    # 12 waits for 3, 89 waits for 7
+HOLE = 'hole'                    # 13 waits for 2
+EYE = 'eye'                      # 5 waits for 5
+PAIR_OF_PAIRS = 'pair-of-pairs'  # 11 55 waits for 1 or 5
+OPEN_SIDES = 'open-sides'        # 23 waits for 1 or 4
+
+# Cache: (row, is_honor) -> tuple of decompositions
+_DECOMPOSITIONS = {}
+
+# Cache: (row, is_honor) -> {rank: frozenset of wait shapes}
+_WAITS = {}
+
+# Cache: (row, is_honor) -> can be grouped into sequences (and a pair)?
+_SEQUENCE_DECOMPOSABLE = {}
+
+# Cache: (row, is_honor) -> frozenset of ranks
+_SEQUENCE_WAITS = {}
+
+
+def decompose(row, is_honor=False):
+    '''
+    Return all the ways to group a row into triplets and sequences, plus
+    exactly one pair if the row has 3n + 2 tiles.
+
+    Each decomposition is a sorted tuple of groups, and a group is a tuple of
+    (kind, rank), where kind is PAIR, TRIPLET or SEQUENCE and rank is the
+    1-based face value of the lowest tile in the group. An empty tuple means
+    the row can't be grouped at all. An empty row has exactly one (empty)
+    decomposition.
+
+    '''
+    key = (row, is_honor)
+    result = _DECOMPOSITIONS.get(key)
+    if result is None:
+        remainder = sum(row) % 3
+        if remainder == 1:
+            result = ()
+        else:
+            found = set()
+            _decompose(list(row), 0, remainder == 2, is_honor, [], found)
+            result = tuple(sorted(found))
+        _DECOMPOSITIONS[key] = result
+    return result
+
+
+def _decompose(row, idx, need_pair, is_honor, groups, found):
+    # skip to the first tile
+    while idx < 9 and row[idx] == 0:
+        idx += 1
+
+    if idx == 9:
+        if not need_pair:
+            found.add(tuple(sorted(groups)))
+        return
+
+    rank = idx + 1
+
+    # group a pair
+    if need_pair and row[idx] >= 2:
+        row[idx] -= 2
+        groups.append((PAIR, rank))
+        _decompose(row, idx, False, is_honor, groups, found)
+        groups.pop()
+        row[idx] += 2
+
+    # group a triplet
+    if row[idx] >= 3:
+        row[idx] -= 3
+        groups.append((TRIPLET, rank))
+        _decompose(row, idx, need_pair, is_honor, groups, found)
+        groups.pop()
+        row[idx] += 3
+
+    # group a sequence
+    if not is_honor and idx < 7 and row[idx + 1] > 0 and row[idx + 2] > 0:
+        row[idx] -= 1
+        row[idx + 1] -= 1
+        row[idx + 2] -= 1
+        groups.append((SEQUENCE, rank))
+        _decompose(row, idx, need_pair, is_honor, groups, found)
+        groups.pop()
+        row[idx] += 1
+        row[idx + 1] += 1
+        row[idx + 2] += 1
+
+
+def waits(row, is_honor=False):
+    '''
+    Return the tiles that make a row groupable, and how they do it.
+
+    The returned value is a dictionary whose keys are ranks of the waiting
+    tiles and values are frozensets of wait shapes (EDGE, HOLE, EYE,
+    PAIR_OF_PAIRS, OPEN_SIDES). A tile has more than one shape if it completes
+    the row in different decompositions. The dictionary is cached, so don't
+    modify it.
+
+    '''
+    key = (row, is_honor)
+    result = _WAITS.get(key)
+    if result is None:
+        result = {}
+        num_ranks = 7 if is_honor else 9
+        for idx in xrange(num_ranks):
+            rank = idx + 1
+            new_row = row[:idx] + (row[idx] + 1,) + row[idx + 1:]
+            shapes = set()
+            for decomp in decompose(new_row, is_honor):
+                for kind, group_rank in decomp:
+                    shape = wait_shape(kind, group_rank, rank)
+                    if shape:
+                        shapes.add(shape)
+            if shapes:
+                result[rank] = frozenset(shapes)
+        _WAITS[key] = result
+    return result
+
+
+def wait_shape(kind, group_rank, rank):
+    '''
+    Return the wait shape if a group of (kind, group_rank) can be completed by
+    a tile of rank, or None if it can't.
+
+    '''
+    if kind == PAIR:
+        if rank == group_rank:
+            return EYE
+    elif kind == TRIPLET:
+        if rank == group_rank:
+            return PAIR_OF_PAIRS
+    elif rank == group_rank + 1:
+        return HOLE
+    elif rank == group_rank:
+        return EDGE if group_rank == 7 else OPEN_SIDES
+    elif rank == group_rank + 2:
+        return EDGE if group_rank == 1 else OPEN_SIDES
+    return None
+
+
+def sequence_decomposable(row, is_honor=False):
+    '''
+    Can a row be grouped into sequences only, plus exactly one pair if the row
+    has 3n + 2 tiles?
+
+    '''
+    key = (row, is_honor)
+    result = _SEQUENCE_DECOMPOSABLE.get(key)
+    if result is None:
+        result = False
+        for decomp in decompose(row, is_honor):
+            if all(kind != TRIPLET for kind, __ in decomp):
+                result = True
+                break
+        _SEQUENCE_DECOMPOSABLE[key] = result
+    return result
+
+
+def sequence_waits(row, is_honor=False):
+    '''
+    Return a frozenset of ranks of the tiles that make a row groupable into
+    sequences (and a pair) only.
+
+    '''
+    key = (row, is_honor)
+    result = _SEQUENCE_WAITS.get(key)
+    if result is None:
+        ranks = []
+        num_ranks = 7 if is_honor else 9
+        for idx in xrange(num_ranks):
+            new_row = row[:idx] + (row[idx] + 1,) + row[idx + 1:]
+            if sequence_decomposable(new_row, is_honor):
+                ranks.append(idx + 1)
+        result = frozenset(ranks)
+        _SEQUENCE_WAITS[key] = result
+    return result
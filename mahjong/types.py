@@ -1,10 +1,14 @@
+import array
 import bisect
 import copy
+import hashlib
+import itertools
+import json
 import random
 
 from collections import Counter
 
-from mahjong import utils
+from mahjong import tables, utils
 
 
 class Tile(object):
@@ -230,6 +234,23 @@ def _init_tile_class():
 _init_tile_class()
 
 
+def _init_row_tables():
+    '''
+    Map tiles to (row index, face value) and back for the table-driven
+    methods in Hand. The row layout is the same as
+    Hand._construct_hand_table().
+
+    '''
+    global _ROW_TILES, _TILE_POSITIONS
+    _ROW_TILES = (Tile.CHARS, Tile.CIRCLES, Tile.BAMBOOS, Tile.HONORS)
+    _TILE_POSITIONS = {}
+    for row_idx, tiles in enumerate(_ROW_TILES):
+        for i, tile in enumerate(tiles):
+            _TILE_POSITIONS[tile] = (row_idx, i)
+
+_init_row_tables()
+
+
 class TileGroup(object):
     '''
     A TileGroup consists of 3 or 4 tiles. It's a "fixed" (as opposed to
@@ -281,6 +302,104 @@ class TileGroup(object):
         return TileGroup(tiles, self.group_type)
 
 
+class _TieCounts(object):
+    # the inputs of GameContext.is_tie(), shared by the players of a context
+    # and kept up to date by their hands, discarded tiles and extra
+    __slots__ = ('num_kongs', 'num_ready', 'first_winds', 'four_winds')
+
+    def __init__(self):
+        self.num_kongs = 0
+        self.num_ready = 0
+        # wind -> number of players who discarded it first
+        self.first_winds = {}
+        # the wind that all four players discarded first, or None
+        self.four_winds = None
+
+    def add_first_discarded(self, tile, delta):
+        if tile is None or not tile.is_wind():
+            return
+        count = self.first_winds.get(tile, 0) + delta
+        self.first_winds[tile] = count
+        if count > 3:
+            self.four_winds = tile
+        elif self.four_winds == tile:
+            self.four_winds = None
+
+
+def _notifying(method):
+    # wrap a method of list or dict to tell the owner after it changes
+    def wrapper(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        getattr(self._owner, self._changed)()
+        return result
+    wrapper.__name__ = method.__name__
+    return wrapper
+
+
+def _tracked(cls, items, owner):
+    # a copy of items that tells owner when it changes
+    tracked = cls(items)
+    tracked._owner = owner
+    return tracked
+
+
+class _TrackedList(list):
+    # a list that calls owner.<_changed>() after every change
+    __slots__ = ('_owner',)
+
+    def __reduce__(self):
+        # copies are plain lists, owners track what they're given
+        return (list, (list(self),))
+
+    for _name in ('append', 'extend', 'insert', 'pop', 'remove', 'reverse', 'sort',
+                  '__setitem__', '__delitem__', '__setslice__', '__delslice__',
+                  '__iadd__', '__imul__'):
+        locals()[_name] = _notifying(getattr(list, _name))
+    del _name
+
+
+class _GroupList(_TrackedList):
+    # Hand.fixed_groups, for the number of kongs
+    __slots__ = ()
+    _changed = '_groups_changed'
+
+
+class _DiscardedList(_TrackedList):
+    # Player.discarded, for the first discarded tile
+    __slots__ = ()
+    _changed = '_discarded_changed'
+
+    def append(self, tile):
+        # only the first tile matters, and discarding is frequent
+        list.append(self, tile)
+        if len(self) == 1:
+            self._owner._discarded_changed()
+
+
+class _ExtraDict(dict):
+    # a dictionary that calls owner._extra_changed() when 'declared_ready'
+    # may have changed
+    __slots__ = ('_owner',)
+    _changed = '_extra_changed'
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        if key == 'declared_ready':
+            self._owner._extra_changed()
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        if key == 'declared_ready':
+            self._owner._extra_changed()
+
+    for _name in ('clear', 'pop', 'popitem', 'setdefault', 'update'):
+        locals()[_name] = _notifying(getattr(dict, _name))
+    del _name
+
+
 class Hand(object):
     '''
     A hand of a player.
@@ -296,12 +415,33 @@ class Hand(object):
 
     '''
     def __init__(self, tiles=None):
+        # tie counts of the context (see GameContext.is_tie()) and the number
+        # of kongs added to them
+        self._ties = None
+        self._num_kongs = 0
         self.free_tiles = tiles or []
         self.free_tiles = sorted(self.free_tiles)
         self.fixed_groups = []
         self.flowers = []
         self.last_tile = None
 
+    def __setattr__(self, name, value):
+        # reading stays a plain attribute lookup
+        if name == 'fixed_groups':
+            # a copy that keeps the number of kongs up to date
+            self.__dict__[name] = _tracked(_GroupList, value, self)
+            self._groups_changed()
+        else:
+            self.__dict__[name] = value
+
+    def __setstate__(self, state):
+        # copy.deepcopy() gives plain lists
+        self.__dict__.update(state)
+        self.fixed_groups = self.fixed_groups
+
+    def __copy__(self):
+        return self.clone()
+
     def __repr__(self):
         if self.last_tile:
             last_tile_repr = repr(self.last_tile) + ' '
@@ -323,14 +463,36 @@ class Hand(object):
                 Counter(self.flowers) == Counter(other.flowers))
 
     def clone(self):
-        hand = Hand()
-        hand.last_tile = self.last_tile
-        hand.free_tiles = copy.copy(self.free_tiles)
-        hand.flowers = copy.copy(self.flowers)
-        for group in self.fixed_groups:
-            hand.fixed_groups.append(group.clone())
+        # skip __init__(), every attribute is set below
+        hand = Hand.__new__(Hand)
+        attrs = hand.__dict__
+        attrs['_ties'] = None
+        attrs['_num_kongs'] = self._num_kongs
+        attrs['last_tile'] = self.last_tile
+        attrs['free_tiles'] = self.free_tiles[:]
+        attrs['flowers'] = self.flowers[:]
+        # groups in a hand are never modified, so they can be shared
+        attrs['fixed_groups'] = _tracked(_GroupList, self.fixed_groups, hand)
         return hand
 
+    def _groups_changed(self):
+        num_kongs = 0
+        for group in self.fixed_groups:
+            if (group.group_type == TileGroup.KONG_EXPOSED or
+                    group.group_type == TileGroup.KONG_CONCEALED):
+                num_kongs += 1
+        if self._ties is not None:
+            self._ties.num_kongs += num_kongs - self._num_kongs
+        self._num_kongs = num_kongs
+
+    def _set_ties(self, ties):
+        # move the kongs of the hand to other tie counts
+        if self._ties is not None:
+            self._ties.num_kongs -= self._num_kongs
+        if ties is not None:
+            ties.num_kongs += self._num_kongs
+        self._ties = ties
+
     def clear(self):
         del self.free_tiles[:]
         del self.fixed_groups[:]
@@ -422,6 +584,8 @@ class Hand(object):
             self.move_last_tile()
 
     def num_kongs(self, exposed=True, concealed=True):
+        if exposed and concealed:
+            return self._num_kongs
         count = 0
         for group in self.fixed_groups:
             if exposed and group.group_type == TileGroup.KONG_EXPOSED:
@@ -459,11 +623,11 @@ class Hand(object):
         if self.last_tile:
             pong_group = self._find_pong_group(self.last_tile)
             if pong_group:
-                # appended kong
-                pong_group.group_type = TileGroup.KONG_EXPOSED
-                pong_group.tiles.append(self.last_tile)
+                # appended kong, groups may be shared by clones so replace it
+                group = TileGroup(pong_group.tiles + [self.last_tile], TileGroup.KONG_EXPOSED)
+                self.fixed_groups[self.fixed_groups.index(pong_group)] = group
                 self.last_tile = None
-                return pong_group
+                return group
             else:
                 # concealed kong
                 free_tiles = [self.last_tile, self.last_tile, self.last_tile]
@@ -570,18 +734,125 @@ class Hand(object):
 
     def ready(self):
         '''Is it a ready hand?'''
-        for tile in Tile.ALL.itervalues():
-            if self.can_win(tile):
-                return True
-        return False
+        return bool(self.waits())
 
     def waiting_tiles(self):
         '''Get a list of tiles that can make this hand win.'''
+        return sorted(self.waits())
+
+    def waits(self):
+        '''
+        Get the tiles that can make this hand win, and how they make it win.
+
+        Return a dictionary whose keys are the waiting tiles and values are
+        frozensets of wait shapes: 'edge', 'hole', 'eye', 'pair-of-pairs' and
+        'open-sides'. Only free tiles are considered, hand.last_tile is not.
+
+        This is derived from the per-suit-row tables in ``mahjong.tables``, so
+        it's cheap enough to call on every discard.
+
+        '''
+        result = {}
+        for row_idx, row in self._waiting_rows(tables.decompose):
+            row_tiles = _ROW_TILES[row_idx]
+            for rank, shapes in tables.waits(row, row_idx == 3).iteritems():
+                result[row_tiles[rank - 1]] = shapes
+        return result
+
+    def sequence_waits(self):
+        '''
+        Get a list of tiles that make this hand a winning hand consisting of
+        sequences and a pair only. Only free tiles are considered, and like
+        waits(), this is derived from the tables in ``mahjong.tables``.
+
+        '''
         tiles = []
-        for tile in Tile.ALL.itervalues():
-            if self.can_win(tile):
-                bisect.insort(tiles, tile)
-        return tiles
+        for row_idx, row in self._waiting_rows(tables.sequence_decomposable):
+            row_tiles = _ROW_TILES[row_idx]
+            for rank in tables.sequence_waits(row, row_idx == 3):
+                tiles.append(row_tiles[rank - 1])
+        return sorted(tiles)
+
+    def _waiting_rows(self, is_groupable):
+        '''
+        Yield (row index, row) for the rows of free tiles where a waiting tile
+        could go. ``is_groupable(row, is_honor)`` tells if a row can be
+        grouped as it is, and all the other rows must be groupable.
+
+        '''
+        rows = self._construct_rows(self.free_tiles)
+        remainders = [sum(row) % 3 for row in rows]
+        ungroupable = [i for i in xrange(4) if not is_groupable(rows[i], i == 3)]
+        if len(ungroupable) > 1:
+            return
+
+        for row_idx, row in enumerate(rows):
+            # the other rows must be groupable as they are
+            if ungroupable and ungroupable[0] != row_idx:
+                continue
+
+            # the waiting tile must leave exactly one pair in the hand
+            remainder = (remainders[row_idx] + 1) % 3
+            if remainder == 1:
+                continue
+            num_pairs = int(remainder == 2)
+            for i in xrange(4):
+                if i != row_idx and remainders[i] == 2:
+                    num_pairs += 1
+            if num_pairs == 1:
+                yield row_idx, row
+
+    def decompositions(self, incoming_tile=None):
+        '''
+        Get all the ways to group this hand + an incoming tile into a pair and
+        triplets/sequences. Fixed groups are not included.
+
+        If incoming_tile is None, hand.last_tile is used. Each decomposition is
+        a list of (kind, tile) tuples, where kind is 'pair', 'triplet' or
+        'sequence', and tile is the lowest tile of the group. An empty list is
+        returned if the hand can't win.
+
+        '''
+        incoming_tile = incoming_tile or self.last_tile
+        tiles = self.free_tiles
+        if incoming_tile:
+            tiles = tiles + [incoming_tile]
+
+        num_pairs = 0
+        row_decomps = []
+        for row_idx, row in enumerate(self._construct_rows(tiles)):
+            decomps = tables.decompose(row, row_idx == 3)
+            if not decomps:
+                return []
+            if sum(row) % 3 == 2:
+                num_pairs += 1
+            row_decomps.append(decomps)
+        if num_pairs != 1:
+            return []
+
+        result = []
+        for combination in itertools.product(*row_decomps):
+            groups = []
+            for row_idx, decomp in enumerate(combination):
+                row_tiles = _ROW_TILES[row_idx]
+                for kind, rank in decomp:
+                    groups.append((kind, row_tiles[rank - 1]))
+            result.append(groups)
+        return result
+
+    def _construct_rows(self, tiles):
+        '''
+        Similar to _construct_hand_table(), but return four tuples of tile
+        counts without the leading sum, so they can be used as keys of the
+        lookup tables in ``mahjong.tables``. Flowers are ignored.
+
+        '''
+        rows = [[0] * 9 for __ in xrange(4)]
+        for tile in tiles:
+            position = _TILE_POSITIONS.get(tile)
+            if position:
+                rows[position[0]][position[1]] += 1
+        return [tuple(row) for row in rows]
 
     def _can_group_as_pair_and_3(self, row, is_honor):
         '''Can group tiles into (a pair) + (sequences and triplets)?'''
@@ -689,11 +960,14 @@ class Hand(object):
         return table
 
     def _meld(self, free_tiles, incoming_tile, group_type):
+        # the hand is left intact if a tile is missing
+        remaining = list(self.free_tiles)
         for tile in free_tiles:
-            idx = utils.index(self.free_tiles, tile)
+            idx = utils.index(remaining, tile)
             if idx < 0:
                 raise ValueError('%s is not in the hand' % tile)
-            del self.free_tiles[idx]
+            del remaining[idx]
+        self.free_tiles[:] = remaining
 
         grouped_tiles = sorted(list(free_tiles) + [incoming_tile])
         group = TileGroup(grouped_tiles, group_type)
@@ -716,10 +990,17 @@ class Wall(object):
     to do that here. The wall is essentially a full list of tiles, and players
     draw tiles from the end of the list.
 
+    A clone shares the list with the original wall. While shared, the list is
+    never modified: a wall only keeps count of the tiles left, and draws by
+    moving the count. Accessing ``Wall.tiles`` gives the wall its own copy
+    of the list.
+
     '''
     def __init__(self, chars=True, circles=True, bamboos=True, honors=True,
                  flowers=True, rng=None):
-        self.tiles = []
+        self._tiles = []
+        # number of tiles left in a shared list, None if the list isn't shared
+        self._count = None
         self.chars = chars
         self.circles = circles
         self.bamboos = bamboos
@@ -729,15 +1010,38 @@ class Wall(object):
         self.reset()
 
     def __eq__(self, other):
-        return self.tiles == other.tiles
+        num_tiles = self.num_tiles()
+        if num_tiles != other.num_tiles():
+            return False
+        if self._tiles is other._tiles:
+            return True
+        return self._tiles[:num_tiles] == other._tiles[:num_tiles]
 
     def __iter__(self):
-        for tile in self.tiles:
-            yield tile
+        tiles = self._tiles
+        for i in xrange(0, self.num_tiles()):
+            yield tiles[i]
+
+    @property
+    def tiles(self):
+        '''The list of tiles left in the wall. Modify it as you like.'''
+        if self._count is not None:
+            # stop sharing since the caller may modify the list
+            self._tiles = self._tiles[:self._count]
+            self._count = None
+        return self._tiles
+
+    @tiles.setter
+    def tiles(self, tiles):
+        self._tiles = tiles
+        self._count = None
 
     def clone(self):
+        if self._count is None:
+            self._count = len(self._tiles)
         wall = Wall(chars=False, circles=False, bamboos=False, honors=False, flowers=False)
-        wall.tiles = copy.copy(self.tiles)
+        wall._tiles = self._tiles
+        wall._count = self._count
         wall.rng = self.rng
         return wall
 
@@ -745,16 +1049,34 @@ class Wall(object):
         self.rng.shuffle(self.tiles)
 
     def num_tiles(self):
-        return len(self.tiles)
+        if self._count is None:
+            return len(self._tiles)
+        return self._count
 
     def draw(self):
-        try:
-            return self.tiles.pop()
-        except IndexError:
+        count = self._count
+        if count is None:
+            try:
+                return self._tiles.pop()
+            except IndexError:
+                return None
+        if not count:
             return None
+        self._count = count - 1
+        return self._tiles[count - 1]
+
+    def put_back(self, tile):
+        '''Put a drawn tile back to the end of the wall.'''
+        count = self._count
+        if count is not None and count < len(self._tiles) and self._tiles[count] is tile:
+            # it's still there in the shared list
+            self._count = count + 1
+        else:
+            self.tiles.append(tile)
 
     def reset(self):
-        del self.tiles[:]
+        self._tiles = []
+        self._count = None
         if self.chars:
             self._add_tiles(Tile.CHARS, 4)
         if self.circles:
@@ -769,7 +1091,7 @@ class Wall(object):
     def _add_tiles(self, tiles, num_duplicates):
         for tile in tiles:
             for __ in xrange(num_duplicates):
-                self.tiles.append(tile)
+                self._tiles.append(tile)
 
 
 class GameSettings(object):
@@ -782,15 +1104,20 @@ class GameSettings(object):
         self._attrs = {
             'bloodmatch': False,            # fight until only one player left
             'declarable': True,             # be able to declare your hand is ready
+            'eager_scoring': False,         # match patterns at 'end' state even if ledger is off
+            'ledger': True,                 # record net points of every match in GameContext.ledger
             'max_dealer_defended': 999,     # maximum times you can defend your dealer position
             'multi_winners': False,         # multiple players can win on the same discarded tile
             'num_hand_tiles': 16,           # number of tiles of a hand
+            'parallel_decisions': False,    # ask all players who can meld at once
             'scorer': 'tw',                 # specifies how to score
             'tie_on_4_kongs': True,         # tie if there're four kongs on the table
             'tie_on_4_waiting': False,      # tie if four players declare ready
             'tie_on_winds': 'all',          # tie if four same winds are discarded at the beginning
             'tie_wall': 16,                 # number of tiles must be left in the wall
             'tie_wall_per_kong': 1,         # number of tiles that should be added
+            'trusted': False,               # skip integrity checks in flow.next()
+            'validate_sample_rate': 0.0,    # fraction of matches fully checked in trusted mode
             'wall_bamboos': True,           # include bamboos in the wall
             'wall_chars': True,             # include characters in the wall
             'wall_circles': True,           # include circles in the wall
@@ -848,6 +1175,8 @@ class GameSettings(object):
         }
 
     def __eq__(self, other):
+        if isinstance(other, FrozenSettings):
+            return other == self
         return self.__dict__.get('_attrs') == other.__dict__.get('_attrs')
 
     def __getattr__(self, name):
@@ -882,6 +1211,162 @@ class GameSettings(object):
             total += 28
         return total
 
+    def tiles_after_dealing(self):
+        '''Number of tiles left in the wall after dealing, before flowers are replaced.'''
+        return self.total_tiles() - self.num_hand_tiles * 4
+
+    # the same as the ones that FrozenSettings computes once, computed on
+    # every read here because the settings can change
+
+    @property
+    def patterns_win_set(self):
+        return frozenset(self.patterns_win)
+
+    @property
+    def patterns_win_filter_set(self):
+        return frozenset(self.patterns_win_filter)
+
+    @property
+    def pattern_names(self):
+        return tuple(sorted(self.patterns_score))
+
+    @property
+    def pattern_indices(self):
+        return dict((name, i) for i, name in enumerate(self.pattern_names))
+
+    def fingerprint(self):
+        '''
+        Return a hex digest of the settings, the same for equal settings
+        across processes and runs, e.g., to key caches on.
+
+        '''
+        # memoized against a copy of the values, so it's recomputed after any
+        # change, including ones made in place, e.g., to patterns_score
+        attrs = self.__dict__.get('_attrs')
+        values = _copy_values(attrs)
+        cached = self.__dict__.get('_fingerprint')
+        if cached is None or cached[0] != values:
+            cached = (values, _fingerprint(attrs))
+            self.__dict__['_fingerprint'] = cached
+        return cached[1]
+
+    def freeze(self):
+        '''Return a FrozenSettings of the current values.'''
+        return FrozenSettings(self.__dict__.get('_attrs'))
+
+
+class FrozenSettings(object):
+    '''
+    An immutable copy of a GameSettings, made by ``GameSettings.freeze()``,
+    that is faster to read. The settings are slots instead of dictionary
+    lookups in ``__getattr__()``, lists are tuples, patterns_score is a
+    read-only dictionary, and these are computed once:
+    * total_tiles(), tiles_after_dealing() and fingerprint().
+    * patterns_win_set and patterns_win_filter_set: Frozensets of
+      patterns_win and patterns_win_filter.
+    * pattern_names: Sorted names in patterns_score, and pattern_indices:
+      name -> index in pattern_names.
+
+    It compares and hashes by value, so it can be a dictionary key.
+
+    '''
+    __slots__ = tuple(sorted(GameSettings().__dict__['_attrs'])) + (
+        '_attrs', '_fingerprint', '_total_tiles', '_tiles_after_dealing',
+        'patterns_win_set', 'patterns_win_filter_set', 'pattern_names', 'pattern_indices')
+
+    def __init__(self, attrs):
+        attrs = copy.deepcopy(attrs)
+        init = super(FrozenSettings, self).__setattr__
+        init('_attrs', attrs)
+        for name, value in attrs.iteritems():
+            if isinstance(value, list):
+                value = tuple(value)
+            elif isinstance(value, dict):
+                # a copy, _attrs stays as it is for comparing and thawing
+                value = _ReadOnlyDict(value)
+            init(name, value)
+
+        init('patterns_win_set', frozenset(attrs['patterns_win']))
+        init('patterns_win_filter_set', frozenset(attrs['patterns_win_filter']))
+        init('pattern_names', tuple(sorted(attrs['patterns_score'])))
+        init('pattern_indices', _ReadOnlyDict((name, i) for i, name in enumerate(self.pattern_names)))
+        init('_total_tiles', GameSettings.total_tiles.__func__(self))
+        init('_tiles_after_dealing', self._total_tiles - self.num_hand_tiles * 4)
+        init('_fingerprint', _fingerprint(attrs))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('FrozenSettings is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('FrozenSettings is immutable')
+
+    def __eq__(self, other):
+        if isinstance(other, FrozenSettings):
+            return self._fingerprint == other._fingerprint and self._attrs == other._attrs
+        if isinstance(other, GameSettings):
+            return self._attrs == other.__dict__.get('_attrs')
+        return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._fingerprint)
+
+    def __reduce__(self):
+        return (FrozenSettings, (self._attrs,))
+
+    def total_tiles(self):
+        return self._total_tiles
+
+    def tiles_after_dealing(self):
+        return self._tiles_after_dealing
+
+    def fingerprint(self):
+        return self._fingerprint
+
+    def freeze(self):
+        return self
+
+    def thaw(self):
+        '''Return a GameSettings of these values.'''
+        settings = GameSettings()
+        settings._attrs = copy.deepcopy(self._attrs)
+        return settings
+
+
+class _ReadOnlyDict(dict):
+    # a dictionary that raises TypeError on changes
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('FrozenSettings is immutable')
+
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce__(self):
+        return (_ReadOnlyDict, (dict(self),))
+
+
+# settings whose values are lists or dictionaries, which can change in place
+_NESTED_SETTINGS = tuple(sorted(name for name, value in GameSettings().__dict__['_attrs'].iteritems()
+                                if isinstance(value, (list, dict))))
+
+
+def _copy_values(attrs):
+    # a copy of the settings that changes to nested lists and dictionaries
+    # don't reach
+    result = attrs.copy()
+    for name in _NESTED_SETTINGS:
+        value = result[name]
+        result[name] = value.copy() if isinstance(value, dict) else tuple(value)
+    return result
+
+
+def _fingerprint(attrs):
+    data = json.dumps(attrs, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(data).hexdigest()
+
 
 class Player(object):
     '''
@@ -893,10 +1378,47 @@ class Player(object):
 
     '''
     def __init__(self):
+        # tie counts of the context (see GameContext.is_tie()) and what the
+        # player added to them
+        self._ties = None
+        self._ready = False
+        self._first_discarded = None
         self.hand = Hand()
         self.discarded = []
         self.decision = None
         self.extra = {}
+        # results that algo computes from the context, checked against it
+        # before use, so they're not part of the state (see algo.score_table())
+        self._cache = {}
+
+    def __setattr__(self, name, value):
+        # reading stays a plain attribute lookup
+        attrs = self.__dict__
+        if name == 'hand':
+            old = attrs.get('hand')
+            if old is not None:
+                old._set_ties(None)
+            value._set_ties(self._ties)
+            attrs[name] = value
+        elif name == 'discarded':
+            # a copy that keeps the first discarded tile up to date
+            attrs[name] = _tracked(_DiscardedList, value, self)
+            self._discarded_changed()
+        elif name == 'extra':
+            # a copy that keeps the 'declared_ready' flag up to date
+            attrs[name] = _tracked(_ExtraDict, value, self)
+            self._extra_changed()
+        else:
+            attrs[name] = value
+
+    def __setstate__(self, state):
+        # copy.deepcopy() gives plain lists and dictionaries
+        self.__dict__.update(state)
+        self.discarded = self.discarded
+        self.extra = self.extra
+
+    def __copy__(self):
+        return self.clone()
 
     def __eq__(self, other):
         return (self.hand == other.hand and
@@ -909,13 +1431,20 @@ class Player(object):
         del self.discarded[:]
         self.decision = None
         self.extra.clear()
+        self._cache.clear()
 
     def clone(self):
-        p = Player()
-        p.hand = self.hand.clone()
-        p.discarded = copy.copy(self.discarded)
-        p.decision = self.decision
-        p.extra = copy.copy(self.extra)
+        # skip __init__(), every attribute is set below
+        p = Player.__new__(Player)
+        attrs = p.__dict__
+        attrs['_ties'] = None
+        attrs['_ready'] = self._ready
+        attrs['_first_discarded'] = self._first_discarded
+        attrs['hand'] = self.hand.clone()
+        attrs['discarded'] = _tracked(_DiscardedList, self.discarded, p)
+        attrs['decision'] = self.decision
+        attrs['extra'] = _tracked(_ExtraDict, self.extra, p)
+        attrs['_cache'] = copy.copy(self._cache)
         return p
 
     def discard(self, tile=None):
@@ -925,6 +1454,143 @@ class Player(object):
         self.hand.discard(tile)
         self.discarded.append(tile)
 
+    def _discarded_changed(self):
+        discarded = self.discarded
+        first = discarded[0] if discarded else None
+        if not first == self._first_discarded:
+            if self._ties is not None:
+                self._ties.add_first_discarded(self._first_discarded, -1)
+                self._ties.add_first_discarded(first, 1)
+            self._first_discarded = first
+
+    def _extra_changed(self):
+        ready = bool(self.extra.get('declared_ready'))
+        if ready != self._ready:
+            if self._ties is not None:
+                self._ties.num_ready += 1 if ready else -1
+            self._ready = ready
+
+    def _set_ties(self, ties):
+        # move what the player adds to tie counts to other ones
+        old = self._ties
+        if old is not None:
+            old.num_ready -= self._ready
+            old.add_first_discarded(self._first_discarded, -1)
+        if ties is not None:
+            ties.num_ready += self._ready
+            ties.add_first_discarded(self._first_discarded, 1)
+        self._ties = ties
+        self.hand._set_ties(ties)
+
+
+class ScoreLedger(object):
+    '''
+    A ScoreLedger records the net points of every seat match by match, e.g.,
+    [+3, -3, 0, 0] if player 1 pays 3 to player 0.
+
+    Entries are kept as running (prefix) sums in flat arrays, so the ledger
+    stays small over thousands of matches and these queries are O(1):
+    * totals: Net points of each seat so far.
+    * last_totals(n): Net points of each seat over the last n matches.
+    * round_totals(round) and dealer_totals(dealer): Net points of each seat
+      over the matches in a round, or the matches dealt by a seat.
+
+    A clone shares the storage until either of them appends.
+
+    '''
+    def __init__(self):
+        self._sums = array.array('l', [0, 0, 0, 0])
+        self._rounds = array.array('l')
+        self._dealers = array.array('b')
+        self._round_totals = {}
+        self._dealer_totals = {}
+        # storage is shared with a clone, copy it before appending
+        self._shared = False
+
+    def __len__(self):
+        return len(self._rounds)
+
+    def __eq__(self, other):
+        return (self._sums == other._sums and
+                self._rounds == other._rounds and
+                self._dealers == other._dealers)
+
+    @property
+    def totals(self):
+        return self._sums[-4:].tolist()
+
+    def clear(self):
+        self.__init__()
+
+    def clone(self):
+        ledger = ScoreLedger()
+        ledger._sums = self._sums
+        ledger._rounds = self._rounds
+        ledger._dealers = self._dealers
+        ledger._round_totals = self._round_totals
+        ledger._dealer_totals = self._dealer_totals
+        ledger._shared = self._shared = True
+        return ledger
+
+    def _own(self):
+        self._sums = array.array('l', self._sums)
+        self._rounds = array.array('l', self._rounds)
+        self._dealers = array.array('b', self._dealers)
+        self._round_totals = dict((k, list(v)) for k, v in self._round_totals.iteritems())
+        self._dealer_totals = dict((k, list(v)) for k, v in self._dealer_totals.iteritems())
+        self._shared = False
+
+    def append(self, points, round, dealer):
+        '''
+        Record a match.
+
+        :param points: Net points of each seat in this match.
+        :param round: The round of the match.
+        :param dealer: The dealer of the match.
+
+        '''
+        if self._shared:
+            self._own()
+        sums = self._sums
+        base = len(sums) - 4
+        for i in xrange(0, 4):
+            sums.append(sums[base + i] + points[i])
+        self._rounds.append(round)
+        self._dealers.append(dealer)
+        self._add(self._round_totals, round, points)
+        self._add(self._dealer_totals, dealer, points)
+
+    def entry(self, idx):
+        '''Return the idx-th match as a tuple of (points, round, dealer).'''
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError('ledger index out of range')
+        sums = self._sums
+        base = idx * 4
+        points = [sums[base + 4 + i] - sums[base + i] for i in xrange(0, 4)]
+        return points, self._rounds[idx], self._dealers[idx]
+
+    def last_totals(self, n):
+        n = min(n, len(self))
+        sums = self._sums
+        end = len(sums) - 4
+        start = end - n * 4
+        return [sums[end + i] - sums[start + i] for i in xrange(0, 4)]
+
+    def round_totals(self, round):
+        return list(self._round_totals.get(round, [0, 0, 0, 0]))
+
+    def dealer_totals(self, dealer):
+        return list(self._dealer_totals.get(dealer, [0, 0, 0, 0]))
+
+    def _add(self, totals, key, points):
+        seat_totals = totals.get(key)
+        if seat_totals is None:
+            seat_totals = totals[key] = [0, 0, 0, 0]
+        for i in xrange(0, 4):
+            seat_totals[i] += points[i]
+
 
 class GameContext(object):
     '''
@@ -947,7 +1613,9 @@ class GameContext(object):
                time it has only one element unless multi_winners is on. It is
                set to None if it's a tie.
     * settings: A GameSettings instance.
+    * ledger: A ScoreLedger of the finished matches.
     * extra: A dictionary for extra data.
+    * journal: A list of moves made by apply() that undo() can take back.
 
     '''
     def __init__(self, settings=None):
@@ -963,7 +1631,15 @@ class GameContext(object):
         self.dealer_defended = 0
         self.winners = None
         self.settings = settings or GameSettings()
+        self.ledger = ScoreLedger()
         self.extra = {}
+        self.journal = []
+        # flow observers of this context, see flow.add_observer()
+        self._observers = []
+        # kept up to date by the players, see is_tie()
+        self._ties = _TieCounts()
+        for player in self.players:
+            player._set_ties(self._ties)
 
     def __eq__(self, other):
         return (self.state == other.state and
@@ -978,6 +1654,7 @@ class GameContext(object):
                 self.dealer_defended == other.dealer_defended and
                 self.winners == other.winners and
                 self.settings == other.settings and
+                self.ledger == other.ledger and
                 self.extra == other.extra)
 
     def reset(self):
@@ -993,10 +1670,13 @@ class GameContext(object):
         self.dealer = 0
         self.dealer_defended = 0
         self.winners = None
+        self.ledger.clear()
         self.extra.clear()
+        del self.journal[:]
 
     def clone(self):
-        c = GameContext()
+        # skip __init__(), every attribute is set below
+        c = GameContext.__new__(GameContext)
         c.state = self.state
         c.wall = self.wall.clone() if self.wall else None
         c.players = [p.clone() for p in self.players] if self.players else None
@@ -1009,7 +1689,15 @@ class GameContext(object):
         c.dealer_defended = self.dealer_defended
         c.winners = self.winners
         c.settings = self.settings
+        c.ledger = self.ledger.clone()
         c.extra = copy.copy(self.extra)
+        c.journal = []
+        # observers watch the context, not its clones
+        c._observers = []
+        c._ties = _TieCounts()
+        if c.players:
+            for player in c.players:
+                player._set_ties(c._ties)
         return c
 
     def player(self, offset=0):
@@ -1043,45 +1731,38 @@ class GameContext(object):
         if cur_state and self.state == 'end' and not self.winners:
             return True
 
-        # 4-waiting tie
-        if four_waiting and self.settings.tie_on_4_waiting:
-            ready_players = filter(lambda player: player.extra.get('declared_ready'),
-                                   [player for player in self.players])
-            if len(ready_players) > 3:
-                return True
+        # the tie inputs are counted as the players' hands, discarded tiles
+        # and extra change, so each check is a comparison
+        settings = self.settings
+        ties = self._ties
 
-        # count number of kongs on the table
-        total_kongs = 0
-        for player in self.players:
-            total_kongs += player.hand.num_kongs()
+        # 4-waiting tie
+        if four_waiting and settings.tie_on_4_waiting and ties.num_ready > 3:
+            return True
 
         # 4-kong tie
-        if four_kongs and self.settings.tie_on_4_kongs and total_kongs > 3:
+        if four_kongs and settings.tie_on_4_kongs and ties.num_kongs > 3:
             return True
 
         # wall tie
         if wall_tie:
             # number of tiles that should be left in the wall
-            min_num_tiles = self.settings.tie_wall + total_kongs * self.settings.tie_wall_per_kong
+            min_num_tiles = settings.tie_wall + ties.num_kongs * settings.tie_wall_per_kong
             if self.wall.num_tiles() <= min_num_tiles:
                 return True
 
         # wind tie
-        if four_winds and self.settings.tie_on_winds:
-            # get the first discarded tiles from each player
-            discarded = [p.discarded[0] if p.discarded else None for p in self.players]
-            if self.settings.tie_on_winds == 'west':
+        tie_on_winds = four_winds and settings.tie_on_winds
+        if tie_on_winds:
+            # all players discard the same wind on initial discarding
+            wind = ties.four_winds
+            if wind is None:
+                return False
+            if tie_on_winds == 'west' and wind != Tile.WEST:
                 # all players discard west wind on initial discarding
-                if len(filter(lambda x: x == Tile.WEST, discarded)) == 4:
-                    return True
-            else:
-                # assert self.settings.tie_on_winds == 'all'
-                # all players discard the same wind on initial discarding
-                if discarded[0] and discarded[0].is_wind() and \
-                   discarded[0] == discarded[1] and \
-                   discarded[1] == discarded[2] and \
-                   discarded[2] == discarded[3]:
-                    return True
+                return False
+            # assert tie_on_winds == 'all'
+            return True
 
         return False
 
@@ -1092,6 +1773,12 @@ class GameContext(object):
         self.players[player_idx].discard(tile)
         self.discarded_pool.append(tile)
 
+    def declare_ready(self, player_idx=None):
+        if player_idx is None:
+            player_idx = self.cur_player_idx
+
+        self.players[player_idx].extra['declared_ready'] = True
+
     def last_discarded(self):
         if self.discarded_pool:
             return self.discarded_pool[-1]
@@ -1118,3 +1805,157 @@ class GameContext(object):
     def set_turn(self, player_idx):
         self.last_player_idx = self.cur_player_idx
         self.cur_player_idx = player_idx
+
+    def apply(self, move):
+        '''
+        Make a move and record its inverse in the journal, so undo() can take
+        it back without cloning the context. A move is a tuple of (kind,
+        player index, argument):
+        * ('draw', i, None): Player i draws a tile from the wall.
+        * ('discard', i, tile): Player i discards a tile.
+        * ('chow', i, (tile1, tile2)), ('pong', i, None), ('kong', i, None):
+          Player i melds the last tile discarded by the current player.
+        * ('self-kong', i, None): Player i kongs the last tile.
+        * ('flower', i, None): Player i moves the drawn flower to the
+          flowers.
+        * ('turn', i, None): It's player i's turn.
+        * ('extra', i, (key, value)): Set a key of player i's extra, or of
+          context.extra if i is None. A value of None deletes the key.
+
+        A move that raises ValueError leaves the context intact.
+
+        '''
+        kind, player_idx, arg = move
+        handler = getattr(self, '_apply_' + kind.replace('-', '_'), None)
+        if handler is None:
+            raise ValueError('Unknown move: %s' % kind)
+        self.journal.append((move, handler(player_idx, arg)))
+
+    def undo(self):
+        '''Take back the last move made by apply(). Return the move.'''
+        if not self.journal:
+            raise ValueError('Nothing to undo')
+        move, data = self.journal.pop()
+        kind, player_idx, arg = move
+        getattr(self, '_undo_' + kind.replace('-', '_'))(player_idx, arg, data)
+        return move
+
+    def _apply_draw(self, player_idx, arg):
+        hand = self.players[player_idx].hand
+        last_tile = hand.last_tile
+        hand.last_tile = self.wall.draw()
+        return last_tile, hand.last_tile
+
+    def _undo_draw(self, player_idx, arg, data):
+        last_tile, tile = data
+        if tile is not None:
+            self.wall.put_back(tile)
+        self.players[player_idx].hand.last_tile = last_tile
+
+    def _apply_discard(self, player_idx, tile):
+        last_tile = self.players[player_idx].hand.last_tile
+        self.discard(tile, player_idx)
+        return last_tile
+
+    def _undo_discard(self, player_idx, tile, last_tile):
+        player = self.players[player_idx]
+        hand = player.hand
+        if last_tile is None or not last_tile == tile:
+            # the last tile went into the free tiles
+            if last_tile:
+                hand.remove_free_tile(last_tile)
+            hand.add_free_tile(tile)
+        hand.last_tile = last_tile
+        self.discarded_pool.pop()
+        player.discarded.pop()
+
+    def _apply_chow(self, player_idx, chow_comb):
+        return self._meld(player_idx, lambda hand, tile: hand.chow(chow_comb, tile))
+
+    def _apply_pong(self, player_idx, arg):
+        return self._meld(player_idx, lambda hand, tile: hand.pong(tile))
+
+    def _apply_kong(self, player_idx, arg):
+        return self._meld(player_idx, lambda hand, tile: hand.kong_from_other(tile))
+
+    def _meld(self, player_idx, meld):
+        discarder_idx = self.cur_player_idx
+        tile = self.last_discarded()
+        discarded = self.players[discarder_idx].discarded
+        if tile is None or not discarded or discarded[-1] != tile:
+            raise ValueError('Nothing to meld')
+        # melding raises before changing the hand, so meld first
+        meld(self.players[player_idx].hand, tile)
+        self.remove_last_discarded()
+        return discarder_idx, tile
+
+    def _undo_chow(self, player_idx, arg, data):
+        hand = self.players[player_idx].hand
+        discarder_idx, tile = data
+        free_tiles = list(hand.fixed_groups.pop().tiles)
+        free_tiles.remove(tile)
+        hand.add_free_tiles(free_tiles)
+
+        self.players[discarder_idx].discarded.append(tile)
+        self.discarded_pool.append(tile)
+
+    _undo_pong = _undo_chow
+
+    _undo_kong = _undo_chow
+
+    def _apply_self_kong(self, player_idx, arg):
+        hand = self.players[player_idx].hand
+        tile = hand.last_tile
+        pong_group = hand._find_pong_group(tile) if tile else None
+        pong_idx = hand.fixed_groups.index(pong_group) if pong_group else None
+        hand.kong_from_self()
+        return tile, pong_idx, pong_group
+
+    def _undo_self_kong(self, player_idx, arg, data):
+        hand = self.players[player_idx].hand
+        tile, pong_idx, pong_group = data
+        if pong_group:
+            # appended kong replaced the pong group
+            hand.fixed_groups[pong_idx] = pong_group
+        else:
+            hand.fixed_groups.pop()
+            hand.add_free_tiles([tile, tile, tile])
+        hand.last_tile = tile
+
+    def _apply_flower(self, player_idx, arg):
+        hand = self.players[player_idx].hand
+        if not (hand.last_tile and hand.last_tile.is_general_flower()):
+            raise ValueError('Last tile is not a flower')
+        hand.add_flower(hand.last_tile)
+        hand.last_tile = None
+
+    def _undo_flower(self, player_idx, arg, data):
+        hand = self.players[player_idx].hand
+        hand.last_tile = hand.flowers.pop()
+
+    def _apply_turn(self, player_idx, arg):
+        turn = (self.cur_player_idx, self.last_player_idx)
+        self.set_turn(player_idx)
+        return turn
+
+    def _undo_turn(self, player_idx, arg, turn):
+        self.cur_player_idx, self.last_player_idx = turn
+
+    def _apply_extra(self, player_idx, item):
+        key, value = item
+        extra = self.extra if player_idx is None else self.players[player_idx].extra
+        old = (key in extra, extra.get(key))
+        if value is None:
+            extra.pop(key, None)
+        else:
+            extra[key] = value
+        return old
+
+    def _undo_extra(self, player_idx, item, old):
+        key = item[0]
+        existed, old_value = old
+        extra = self.extra if player_idx is None else self.players[player_idx].extra
+        if existed:
+            extra[key] = old_value
+        else:
+            extra.pop(key, None)
@@ -1,7 +1,7 @@
 import unittest
 
-from mahjong import algo
-from mahjong.types import GameContext, Tile
+from mahjong import algo, patterns
+from mahjong.types import GameContext, Tile, Wall
 
 
 class TestCanWin(unittest.TestCase):
@@ -171,10 +171,16 @@ class TestWaitingTiles(unittest.TestCase):
         self.assertEqual(algo.waiting_tiles(self.context, 2), [Tile.CHAR9, Tile.BAMBOO1])
         self.assertFalse(algo.waiting_tiles(self.context, 3))
 
+        for player_idx in xrange(4):
+            self.assertEqual(algo.waiting_tiles(self.context, player_idx, trusted=True),
+                             algo.waiting_tiles(self.context, player_idx))
+
     def test_special_pattern(self):
         # seven flowers
         self.context.players[2].hand.flowers = Tile.FLOWERS[0:7]
         self.assertEqual(algo.waiting_tiles(self.context, 2), [Tile.CHAR9, Tile.BAMBOO1] + Tile.FLOWERS)
+        self.assertEqual(algo.waiting_tiles(self.context, 2, trusted=True),
+                         [Tile.CHAR9, Tile.BAMBOO1] + Tile.FLOWERS)
 
 
 class TestReady(unittest.TestCase):
@@ -224,6 +230,194 @@ class TestReady(unittest.TestCase):
         self.assertTrue(algo.ready(self.context, 2))
         self.assertFalse(algo.ready(self.context, 3))
 
+        for player_idx in xrange(4):
+            self.assertEqual(algo.ready(self.context, player_idx, trusted=True), player_idx < 3)
+
+
+class TestScoreTable(unittest.TestCase):
+
+    def setUp(self):
+        self.context = GameContext()
+        self.context.wall = Wall()
+        self.context.discarded_pool.append(Tile.NORTH)
+        self.context.players[0].discarded.append(Tile.NORTH)
+
+        # wait for CHAR9 and BAMBOO1
+        self.context.players[2].hand.add_free_tiles([
+            Tile.CHAR1, Tile.CHAR1, Tile.CHAR1,
+            Tile.CHAR9, Tile.CHAR9,
+            Tile.BAMBOO1, Tile.BAMBOO1,
+            Tile.WHITE, Tile.WHITE, Tile.WHITE,
+            Tile.WEST, Tile.WEST, Tile.WEST
+        ])
+
+    def test_score_table(self):
+        table = algo.score_table(self.context, 2)
+        self.assertEqual(sorted(table.keys()), [Tile.CHAR9, Tile.BAMBOO1])
+        for scores in table.itervalues():
+            self.assertEqual(sorted(scores.keys()), [None, 0, 1, 3])
+
+        # the context is intact
+        self.assertIsNone(self.context.players[2].hand.last_tile)
+        self.assertEqual(self.context.discarded_pool, [Tile.NORTH])
+        self.assertNotIn('win_type', self.context.players[2].extra)
+
+        # self-picked CHAR9
+        context = self.context.clone()
+        context.players[2].hand.last_tile = Tile.CHAR9
+        context.players[2].extra['win_type'] = 'self-picked'
+        match_results = patterns.match_all(context, 2)
+        self.assertEqual(table[Tile.CHAR9][None], (match_results, algo.score(context, match_results)))
+
+        # BAMBOO1 discarded by the dealer
+        context = self.context.clone()
+        context.players[0].discarded.append(Tile.BAMBOO1)
+        context.discarded_pool.append(Tile.BAMBOO1)
+        context.players[2].extra.update({
+            'win_type': 'melded',
+            'chucker': 0
+        })
+        match_results = patterns.match_all(context, 2)
+        self.assertIn('dealer', match_results)
+        self.assertEqual(table[Tile.BAMBOO1][0], (match_results, algo.score(context, match_results)))
+
+        # cached until the hand changes
+        self.assertIs(algo.score_table(self.context, 2), table)
+        self.context.players[2].hand.add_flower(Tile.SPRING)
+        self.assertIsNot(algo.score_table(self.context, 2), table)
+
+    def test_cached_score(self):
+        self.assertIsNone(algo.cached_score(self.context, 2))
+        table = algo.score_table(self.context, 2)
+
+        # BAMBOO1 discarded by player 3
+        self.context.players[3].discarded.append(Tile.BAMBOO1)
+        self.context.discarded_pool.append(Tile.BAMBOO1)
+        self.context.players[2].extra.update({
+            'win_type': 'melded',
+            'chucker': 3
+        })
+        match_results, score = algo.cached_score(self.context, 2)
+        self.assertEqual((match_results, score), table[Tile.BAMBOO1][3])
+        self.assertEqual(match_results, patterns.match_all(self.context, 2))
+
+        # self-picked CHAR9 after konging is not in the table
+        self.context.players[3].discarded.pop()
+        self.context.discarded_pool.pop()
+        self.context.players[2].extra.update({
+            'win_type': 'self-picked',
+            'chucker': None,
+            'konged': True
+        })
+        self.context.players[2].hand.last_tile = Tile.CHAR9
+        self.assertIsNone(algo.cached_score(self.context, 2))
+
+        self.context.players[2].extra.pop('konged')
+        match_results, score = algo.cached_score(self.context, 2)
+        self.assertEqual((match_results, score), table[Tile.CHAR9][None])
+        self.assertEqual(match_results, patterns.match_all(self.context, 2))
+
+        # any other discard makes the table out of date
+        self.context.players[1].discarded.append(Tile.SOUTH)
+        self.assertIsNone(algo.cached_score(self.context, 2))
+
+    def test_settings_change(self):
+        table = algo.score_table(self.context, 2)
+        self.assertIs(algo.score_table(self.context, 2), table)
+
+        # a different score of a pattern makes the table out of date
+        self.context.players[2].hand.last_tile = Tile.CHAR9
+        self.context.players[2].extra['win_type'] = 'self-picked'
+        self.assertIsNotNone(algo.cached_score(self.context, 2))
+        score, unit = self.context.settings.patterns_score['dragons']
+        self.context.settings.patterns_score['dragons'] = (score + 10, unit)
+        self.assertIsNone(algo.cached_score(self.context, 2))
+
+        self.context.players[2].hand.last_tile = None
+        table2 = algo.score_table(self.context, 2)
+        self.assertIsNot(table2, table)
+        self.assertEqual(table2[Tile.CHAR9][None][1][1] - table[Tile.CHAR9][None][1][1], 10)
+
+    def test_cache_is_not_state(self):
+        context = self.context.clone()
+        algo.score_table(self.context, 2)
+        self.assertEqual(self.context, context)
+        self.assertNotIn('score_table', self.context.players[2].extra)
+
+
+class TestDiscardValues(unittest.TestCase):
+
+    def setUp(self):
+        self.context = GameContext()
+        self.context.wall = Wall()
+        self.context.state = 'discarding'
+        self.context.cur_player_idx = 0
+
+        self.context.players[0].hand.add_free_tiles([
+            Tile.CHAR1, Tile.CHAR2, Tile.CHAR3,
+            Tile.CIRCLE5, Tile.CIRCLE5,
+            Tile.BAMBOO7, Tile.BAMBOO8
+        ])
+        self.context.players[0].hand.last_tile = Tile.EAST
+
+        # one BAMBOO9 is gone
+        self.context.players[2].discarded.append(Tile.BAMBOO9)
+        self.context.discarded_pool.append(Tile.BAMBOO9)
+
+    def test_discard_values(self):
+        values = algo.discard_values(self.context)
+        self.assertEqual([tile for tile, __, __ in values][0], Tile.EAST)
+        self.assertEqual(sorted([tile for tile, __, __ in values]), [
+            Tile.CHAR1, Tile.CHAR2, Tile.CHAR3, Tile.CIRCLE5, Tile.BAMBOO7,
+            Tile.BAMBOO8, Tile.EAST
+        ])
+
+        tile, value, waits = values[0]
+        self.assertEqual(sorted(waits.keys()), [Tile.BAMBOO6, Tile.BAMBOO9])
+        self.assertEqual(waits[Tile.BAMBOO6][0], 4)
+        self.assertEqual(waits[Tile.BAMBOO9][0], 3)
+
+        # same as scoring the hand after discarding EAST
+        context = self.context.clone()
+        context.discard(Tile.EAST)
+        table = algo.score_table(context, 0)
+        for waiting_tile, (unseen, points) in waits.iteritems():
+            scores = table[waiting_tile].values()
+            self.assertEqual(points, float(sum([sum(score) for __, score in scores])) / 4)
+
+        # 136 tiles - 8 in hand - 1 discarded
+        num_unseen = 127
+        expected = (4 * waits[Tile.BAMBOO6][1] + 3 * waits[Tile.BAMBOO9][1]) / num_unseen
+        self.assertAlmostEqual(value, expected)
+        self.assertTrue(value > 0)
+
+        # other candidates don't make a ready hand
+        for tile, value, waits in values[1:]:
+            self.assertEqual((value, waits), (0.0, {}))
+
+        # the context is intact
+        self.assertEqual(self.context.discarded_pool, [Tile.BAMBOO9])
+        self.assertEqual(self.context.players[0].hand.last_tile, Tile.EAST)
+
+    def test_cache(self):
+        values = algo.discard_values(self.context, 0)
+        self.assertIs(algo.discard_values(self.context, 0), values)
+
+        self.context.players[1].discarded.append(Tile.BAMBOO6)
+        self.context.discarded_pool.append(Tile.BAMBOO6)
+        values2 = algo.discard_values(self.context, 0)
+        self.assertIsNot(values2, values)
+        self.assertEqual(values2[0][2][Tile.BAMBOO6][0], 3)
+        self.assertNotIn('discard_values', self.context.players[0].extra)
+
+        # and until the settings change
+        self.assertIs(algo.discard_values(self.context, 0), values2)
+        score, unit = self.context.settings.patterns_score['dealer']
+        self.context.settings.patterns_score['dealer'] = (score + 10, unit)
+        values3 = algo.discard_values(self.context, 0)
+        self.assertIsNot(values3, values2)
+        self.assertGreater(values3[0][1], values2[0][1])
+
 
 class TestSelectMelders(unittest.TestCase):
 
@@ -272,3 +466,56 @@ class TestSelectMelders(unittest.TestCase):
         player_decisions = [None, 'win', 'kong', 'win']
         self.assertEqual(algo.select_melders(viable_decisions, player_decisions),
                          [(1, 'win'), (3, 'win')])
+
+
+class TestResolveMelders(unittest.TestCase):
+
+    def setUp(self):
+        self.viable_decisions = [
+            None,
+            ['win', 'chow', 'skip'],
+            ['kong', 'skip'],
+            ['win', 'skip']
+        ]
+
+    def test_none_viable(self):
+        self.assertEqual(algo.resolve_melders([None] * 4, [None] * 4), (None, []))
+
+    def test_pending(self):
+        player_decisions = [None, None, 'kong', None]
+        self.assertEqual(algo.resolve_melders(self.viable_decisions, player_decisions),
+                         (None, [1, 3]))
+
+        # player 1 skips, player 3 can still win
+        player_decisions = [None, 'skip', 'kong', None]
+        self.assertEqual(algo.resolve_melders(self.viable_decisions, player_decisions),
+                         (None, [3]))
+
+        player_decisions = [None, 'skip', 'kong', 'skip']
+        self.assertEqual(algo.resolve_melders(self.viable_decisions, player_decisions),
+                         ([(2, 'kong')], []))
+
+    def test_first_win(self):
+        # the top-priority player wins without waiting for others
+        player_decisions = [None, 'win', None, None]
+        self.assertEqual(algo.resolve_melders(self.viable_decisions, player_decisions,
+                                              multi_winners=False),
+                         ([(1, 'win')], []))
+        self.assertEqual(algo.resolve_melders(self.viable_decisions, player_decisions),
+                         (None, [2, 3]))
+
+        # player 1 may still win before player 3
+        player_decisions = [None, None, None, 'win']
+        self.assertEqual(algo.resolve_melders(self.viable_decisions, player_decisions,
+                                              multi_winners=False),
+                         (None, [1, 2]))
+        self.assertEqual(algo.resolve_melders(self.viable_decisions, player_decisions,
+                                              base_offset=3, multi_winners=False),
+                         ([(3, 'win')], []))
+
+    def test_same_as_select_melders(self):
+        for decisions in [['skip', 'skip', 'skip', 'skip'], [None, 'chow', 'kong', 'win'],
+                          [None, 'chow', 'kong', 'skip'], [None, 'chow', 'skip', 'skip'],
+                          [None, 'win', 'skip', 'win']]:
+            self.assertEqual(algo.resolve_melders(self.viable_decisions, decisions)[0],
+                             algo.select_melders(self.viable_decisions, decisions))
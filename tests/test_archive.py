@@ -0,0 +1,87 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from StringIO import StringIO
+
+from mahjong import algo, archive, patterns
+from mahjong.types import GameContext, GameSettings, Tile, TileGroup, Wall
+
+
+class TestArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.context = GameContext()
+        self.context.state = 'end'
+        self.context.wall = Wall()
+        self.context.dealer = 1
+        self.context.dealer_defended = 2
+        self.context.round = 1
+
+        # player 2 wins on the RED discarded by player 0
+        hand = self.context.players[2].hand
+        hand.add_free_tiles([
+            Tile.CHAR1, Tile.CHAR2, Tile.CHAR3,
+            Tile.CIRCLE4, Tile.CIRCLE4, Tile.CIRCLE4,
+            Tile.RED, Tile.RED,
+            Tile.BAMBOO9, Tile.BAMBOO9
+        ])
+        hand.fixed_groups.append(TileGroup([Tile.WEST] * 3, TileGroup.PONG))
+        hand.add_flower(Tile.AUTUMN)
+        self.context.players[1].discarded.append(Tile.NORTH)
+        self.context.players[0].discarded.append(Tile.RED)
+        self.context.discarded_pool += [Tile.NORTH, Tile.RED]
+        self.context.players[2].extra.update({
+            'win_type': 'melded',
+            'chucker': 0
+        })
+        self.context.winners = [2]
+
+        self.settings = GameSettings()
+        self.settings.patterns_score = dict(self.settings.patterns_score)
+
+    def test_record_and_restore(self):
+        record = archive.record_win(self.context, 2)
+        context, winner_idx = archive.restore(record, self.settings)
+        self.assertEqual(winner_idx, 2)
+        self.assertEqual(context.players, self.context.players)
+        self.assertEqual(context.discarded_pool, self.context.discarded_pool)
+        self.assertEqual(context.wall.num_tiles(), self.context.wall.num_tiles())
+
+        match_results = patterns.match_all(self.context, 2)
+        self.assertIn('dragons', match_results)
+        self.assertIn('wind-seat', match_results)
+        self.assertEqual(archive.rescore(record, self.context.settings),
+                         (match_results, algo.score(self.context, match_results)))
+
+    def test_read_and_write(self):
+        records = [archive.record_win(self.context, 2)]
+        fileobj = StringIO()
+        archive.write_records(fileobj, records * 3)
+        fileobj.seek(0)
+        self.assertEqual(list(archive.read_records(fileobj)), records * 3)
+
+    def test_rescore_file(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            archive_path = os.path.join(tmp_dir, 'wins.jsonl')
+            result_path = os.path.join(tmp_dir, 'results.txt')
+            with open(archive_path, 'w') as fileobj:
+                archive.write_records(fileobj, [archive.record_win(self.context, 2)] * 5)
+
+            # dragons are worth 3 now
+            self.settings.patterns_score['dragons'] = (3, 'tai')
+            count = archive.rescore_file(archive_path, result_path, self.settings,
+                                         processes=2, chunksize=2)
+            self.assertEqual(count, 5)
+
+            match_results, score = archive.rescore(archive.record_win(self.context, 2),
+                                                   self.settings)
+            self.assertEqual(score[0], algo.score(self.context, match_results)[0] + 2)
+            with open(result_path) as fileobj:
+                results = list(archive.read_results(fileobj))
+            self.assertEqual(results, [(i, score, sorted(match_results)) for i in xrange(5)])
+            self.assertEqual(archive.score_distribution(results), {sum(score): 5})
+        finally:
+            shutil.rmtree(tmp_dir)
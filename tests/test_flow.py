@@ -1,9 +1,10 @@
 import copy
+import random
 import unittest
 
-from mahjong import flow
+from mahjong import flow, patterns
 from mahjong.patterns import MatchResult
-from mahjong.types import Hand, GameContext, GameSettings, Tile, TileGroup, Wall
+from mahjong.types import FrozenSettings, Hand, GameContext, GameSettings, Tile, TileGroup, Wall
 
 
 class TestHandler(unittest.TestCase):
@@ -17,6 +18,76 @@ class TestHandler(unittest.TestCase):
             self.handler.handle(self.context)
 
 
+class TestTrustedMode(unittest.TestCase):
+
+    def setUp(self):
+        self.context = GameContext()
+        self.context.wall = Wall()
+        self.assertTrue(flow.run_until(self.context, 'dealt'))
+
+        # the wall is one tile short
+        self.context.wall.draw()
+
+    def test_untrusted(self):
+        self.assertFalse(flow.next(self.context))
+        self.assertEqual(flow.next(self.context).reason, 'bad-context')
+
+    def test_trusted(self):
+        self.assertTrue(flow.next(self.context, trusted=True))
+        self.assertEqual(self.context.state, 'drawing')
+
+    def test_trusted_settings(self):
+        self.context.settings.trusted = True
+        self.assertTrue(flow.next(self.context))
+
+        self.context.state = 'dealt'
+        self.assertFalse(flow.next(self.context, trusted=False))
+
+    def test_decisions_still_needed(self):
+        result = flow.run_until(self.context, trusted=True)
+        self.assertEqual(result.reason, 'decisions-needed')
+        self.assertEqual(self.context.state, 'discarding')
+
+    def test_run_until(self):
+        # the first transition is checked
+        self.assertEqual(flow.run_until(self.context).reason, 'bad-context')
+
+        # the ones run_until() made are not
+        class ShortWall(flow.Observer):
+
+            def after_next(self, state, context):
+                if state == 'wall-built':
+                    context.wall.draw()
+
+        for trusted in (None, False):
+            context = GameContext()
+            context.wall = Wall()
+            flow.add_observer(context, ShortWall())
+            self.assertTrue(flow.next(context))
+            result = flow.run_until(context, trusted=trusted)
+            self.assertEqual(result.reason, 'decisions-needed' if trusted is None else 'bad-context')
+
+    def test_same_game(self):
+        contexts = [GameContext(), GameContext()]
+        for context in contexts:
+            context.wall = Wall(rng=random.Random(2))
+            for player in context.players:
+                player.extra['bot'] = True
+        while contexts[0].match < 2:
+            self.assertEqual(bool(flow.next(contexts[0], trusted=False)),
+                             bool(flow.next(contexts[1], trusted=True)))
+            self.assertEqual(contexts[0], contexts[1])
+
+    def test_sampled_validation(self):
+        self.context.settings.validate_sample_rate = 1.0
+        self.context.state = 'start'
+        self.assertTrue(flow.next(self.context, trusted=True))
+        self.assertTrue(self.context.extra.get('full_validation'))
+
+        self.context.wall.draw()
+        self.assertFalse(flow.next(self.context, trusted=True))
+
+
 class TestIllegalState(unittest.TestCase):
 
     def test_illegal_state(self):
@@ -873,6 +944,49 @@ class TestDiscardingHandler(unittest.TestCase):
         self.assertEqual(self.context.player().discarded, [Tile.WHITE])
         self.assertEqual(self.context.last_discarded(), Tile.WHITE)
 
+    def test_precompute_reactions(self):
+        # player 0 draws CHAR5
+        draw_for_player(self.context, 0, last_player_idx=3, tile=Tile.CHAR5)
+        orig_context = self.context.clone()
+
+        flow.precompute_reactions(self.context)
+        reactions = self.context.extra['reactions']
+        self.assertEqual(set(reactions), set(self.context.player().hand.free_tiles + [Tile.CHAR5]))
+        self.assertEqual(reactions[Tile.CHAR5][2],
+                         [None, [], [], ['win', 'pong', 'skip']])
+        self.assertEqual(reactions[Tile.EAST][2], [None, [], ['pong', 'skip'], []])
+        self.assertFalse(reactions[Tile.CHAR5][1])
+
+        # same transitions as without precomputing
+        for context in (self.context, orig_context):
+            context.player().decision = Tile.CHAR5
+            self.assertTrue(flow.next(context))
+            self.assertTrue(flow.next(context))
+        self.assertEqual(self.context, orig_context)
+        self.assertEqual(self.context.state, 'melding')
+        self.assertNotIn('reactions', self.context.extra)
+
+    def test_precomputed_reactions_used(self):
+        draw_for_player(self.context, 0, last_player_idx=3, tile=Tile.CHAR5)
+        flow.precompute_reactions(self.context)
+        key, ready, viable_decisions = self.context.extra['reactions'][Tile.RED]
+        fake_reaction = (key, ready, [None, ['chow', 'skip'], None, None])
+        self.context.extra['reactions'][Tile.RED] = fake_reaction
+        context = self.context.clone()
+
+        self.context.player().decision = Tile.RED
+        self.assertTrue(flow.next(self.context))
+        self.assertTrue(flow.next(self.context))
+        self.assertEqual(self.context.state, 'melding')
+        self.assertEqual(self.context.players[1].extra['viable_decisions'], ['chow', 'skip'])
+
+        # a table that doesn't match the context is ignored
+        context.extra['reactions'][Tile.RED] = (key[:-1] + (0,), ready, fake_reaction[2])
+        context.player().decision = Tile.RED
+        self.assertTrue(flow.next(context))
+        self.assertTrue(flow.next(context))
+        self.assertEqual(context.state, 'drawing')
+
     def test_discarding_hints(self):
         # player 1 draws and discards CHAR8
         draw_for_player(self.context, 1, last_player_idx=0, tile=Tile.CHAR8)
@@ -1289,6 +1403,39 @@ class TestMeldingHandler(unittest.TestCase):
         self.assertIsNone(self.context.players[2].decision)
         self.assertIsNone(self.context.players[3].decision)
 
+    def test_parallel_decisions(self):
+        self.context.settings.parallel_decisions = True
+
+        # player 1~3 all wait for CHAR8, and player 1 can also chow
+        self.context.players[1].hand.free_tiles = [Tile.CHAR8]
+        self.context.players[2].hand.free_tiles = [Tile.CHAR8]
+        self.context.players[3].hand.free_tiles = [Tile.CHAR8]
+        self.context.players[1].extra['viable_decisions'] = ['win', 'chow', 'skip']
+        self.context.players[2].extra['viable_decisions'] = ['win', 'skip']
+        self.context.players[3].extra['viable_decisions'] = ['win', 'skip']
+
+        result = flow.next(self.context)
+        self.assertFalse(result)
+        self.assertEqual(result.reason, 'decisions-needed')
+        self.assertEqual(result.viable_decisions,
+                         [None, ['win', 'chow', 'skip'], ['win', 'skip'], ['win', 'skip']])
+
+        # decisions come in any order, only undecided players are asked
+        self.context.players[3].decision = 'win'
+        result = flow.next(self.context)
+        self.assertFalse(result)
+        self.assertEqual(result.viable_decisions,
+                         [None, ['win', 'chow', 'skip'], ['win', 'skip'], None])
+
+        # top-priority player wins, no need to wait for player 2
+        self.context.players[1].decision = 'win'
+        self.assertTrue(flow.next(self.context))
+        self.assertEqual(self.context.state, 'end')
+        self.assertEqual(self.context.winners, [1])
+
+        # player 2 didn't decide, so no water penalty
+        self.assertIsNone(self.context.players[2].extra.get('water'))
+
     def test_multi_wins(self):
         self.context.settings.multi_winners = True
 
@@ -1387,6 +1534,12 @@ class TestMeldingHandler(unittest.TestCase):
         self.assertIsNone(self.context.players[2].decision)
         self.assertIsNone(self.context.players[3].decision)
 
+    def test_pong_event(self):
+        self.context.players[1].decision = 'skip'
+        self.context.players[2].decision = 'pong'
+        events = list(flow.stream(self.context, max_steps=1))
+        self.assertEqual(events, [flow.Melded(2, TileGroup([Tile.CHAR6] * 3, TileGroup.PONG))])
+
     def test_bot_skips_melding(self):
         # dumb bot doesn't kong, pong, nor chow
         self.context.players[1].extra['bot'] = True
@@ -1616,6 +1769,32 @@ class TestEndHandler(unittest.TestCase):
             'waiting-for-one': MatchResult((1, 2, 3), multiplier=1, extra='eye')
         })
 
+    def test_lazy_score(self):
+        self.context.settings.ledger = False
+        self.assertTrue(flow.next(self.context))
+        patterns_matched = self.context.players[0].extra['patterns_matched']
+        self.assertFalse(patterns_matched.resolved)
+
+        # matched against the hand at the end state
+        self.context.players[0].hand.clear()
+        self.assertIn('heaven-win', patterns_matched)
+        self.assertTrue(patterns_matched.resolved)
+        self.assertEqual(len(patterns_matched), 4)
+
+    def test_eager_score(self):
+        self.context.settings.ledger = False
+        self.context.settings.eager_scoring = True
+        self.assertTrue(flow.next(self.context))
+        patterns_matched = self.context.players[0].extra['patterns_matched']
+        self.assertIs(type(patterns_matched), dict)
+        self.assertEqual(len(patterns_matched), 4)
+
+    def test_score_for_ledger(self):
+        # the ledger needs the results at 'scored', so they're matched now
+        self.assertTrue(flow.next(self.context))
+        patterns_matched = self.context.players[0].extra['patterns_matched']
+        self.assertIs(type(patterns_matched), dict)
+
     # TODO: more tests...
 
     def test_bad_context(self):
@@ -1741,6 +1920,46 @@ class TestScoredHandler(unittest.TestCase):
         self.assertEqual(self.context.dealer, 2)
         self.assertEqual(self.context.dealer_defended, 3)
 
+    def test_ledger(self):
+        self.context.round = 1
+        self.context.dealer = 3
+        self.context.winners = [1, 2]
+        self.context.players[1].extra['patterns_matched'] = {
+            'dealer': MatchResult(3, 1),
+            'dragons': MatchResult((0, 2, 3), 2)
+        }
+        self.context.players[2].extra['patterns_matched'] = {
+            'self-picked': MatchResult((0, 1, 3), 1)
+        }
+        self.assertTrue(flow.next(self.context))
+        self.assertEqual(len(self.context.ledger), 1)
+        self.assertEqual(self.context.ledger.entry(0), ([-3, 6, 1, -4], 1, 3))
+
+        # a tie is recorded as well
+        self.context.state = 'scored'
+        self.context.winners = None
+        self.assertTrue(flow.next(self.context))
+        self.assertEqual(self.context.ledger.totals, [-3, 6, 1, -4])
+        self.assertEqual(self.context.ledger.entry(1), ([0, 0, 0, 0], 2, 0))
+
+    def test_bots_stay(self):
+        self.context.winners = None
+        self.context.players[1].extra['bot'] = True
+        self.context.players[2].extra['bot'] = False
+        self.context.players[3].extra['water'] = True
+        self.assertTrue(flow.next(self.context))
+        self.assertEqual([player.extra for player in self.context.players],
+                         [{}, {'bot': True}, {}, {}])
+
+    def test_no_ledger(self):
+        self.context.settings.ledger = False
+        self.context.winners = [1]
+        patterns_matched = patterns.LazyMatchResults(self.context.clone(), 1)
+        self.context.players[1].extra['patterns_matched'] = patterns_matched
+        self.assertTrue(flow.next(self.context))
+        self.assertEqual(len(self.context.ledger), 0)
+        self.assertFalse(patterns_matched.resolved)
+
     def assert_empty_hands(self, context):
         empty_hand = Hand()
         self.assertEqual(context.players[0].hand, empty_hand)
@@ -1767,6 +1986,305 @@ class TestScoredHandler(unittest.TestCase):
 # Utility functions
 #-----------------------------------------------------------------------------
 
+
+class TestRunUntil(unittest.TestCase):
+
+    def setUp(self):
+        self.context = GameContext()
+        self.context.wall = Wall()
+
+    def test_decisions_needed(self):
+        results = []
+        result = flow.run_until(self.context, results=results)
+        self.assertFalse(result)
+        self.assertEqual(result.reason, 'decisions-needed')
+        self.assertEqual(self.context.state, 'discarding')
+        self.assertIs(results[-1], result)
+        self.assertTrue(all(results[:-1]))
+
+    def test_stop(self):
+        self.assertTrue(flow.run_until(self.context, 'dealt'))
+        self.assertEqual(self.context.state, 'dealt')
+
+        self.assertTrue(flow.run_until(self.context, ('drawn', 'drawing')))
+        self.assertEqual(self.context.state, 'drawing')
+
+        self.assertTrue(flow.run_until(self.context, lambda context: context.state == 'drawn'))
+        self.assertEqual(self.context.state, 'drawn')
+
+    def test_max_steps(self):
+        results = []
+        self.assertTrue(flow.run_until(self.context, results=results, max_steps=2))
+        self.assertEqual(self.context.state, 'dealt')
+        self.assertEqual(len(results), 2)
+
+    def test_all_bots(self):
+        for player in self.context.players:
+            player.extra['bot'] = True
+        self.assertTrue(flow.run_until(self.context, flow.after_matches(3)))
+        self.assertEqual(self.context.state, 'start')
+        self.assertEqual(len(self.context.ledger), 3)
+        self.assertTrue(all(player.extra.get('bot') for player in self.context.players))
+
+        # the dealer passes on every match
+        self.context.settings.max_dealer_defended = 0
+        self.context.dealer = 3
+        self.context.round = 0
+        self.assertTrue(flow.run_until(self.context, flow.at_round(1)))
+        self.assertEqual(self.context.state, 'start')
+        self.assertEqual(self.context.round, 1)
+
+    def test_after_matches(self):
+        for player in self.context.players:
+            player.extra['bot'] = True
+
+        # counted from each run, from any match
+        should_stop = flow.after_matches(2)
+        self.context.match = 5
+        self.assertTrue(flow.run_until(self.context, should_stop))
+        self.assertEqual(self.context.state, 'start')
+        self.assertEqual(len(self.context.ledger), 2)
+        self.assertTrue(flow.run_until(self.context, should_stop))
+        self.assertEqual(len(self.context.ledger), 4)
+
+        # across rounds, the dealer passes on every match
+        other = GameContext()
+        other.wall = Wall()
+        other.settings.max_dealer_defended = 0
+        for player in other.players:
+            player.extra['bot'] = True
+        self.assertTrue(flow.run_until(other, should_stop))
+        self.assertTrue(flow.run_until(other, flow.after_matches(5)))
+        self.assertEqual(len(other.ledger), 7)
+        self.assertEqual(other.round, 1)
+
+    def test_all_bots_without_stop(self):
+        for player in self.context.players:
+            player.extra['bot'] = True
+        self.assertTrue(flow.run_until(self.context))
+        self.assertEqual(self.context.state, 'start')
+        self.assertEqual(len(self.context.ledger), 1)
+
+    def test_frozen_settings(self):
+        self.context.settings = GameSettings().freeze()
+        for player in self.context.players:
+            player.extra['bot'] = True
+        self.assertTrue(flow.run_until(self.context, flow.after_matches(3)))
+        self.assertEqual(len(self.context.ledger), 3)
+
+    def test_freeze(self):
+        settings = self.context.settings
+        settings.patterns_win.append('four-kongs')
+        self.assertTrue(flow.run_until(self.context, 'dealt', freeze=True))
+        self.assertIsInstance(self.context.settings, FrozenSettings)
+        self.assertEqual(self.context.settings, settings)
+
+        # frozen settings are kept as they are
+        frozen = self.context.settings
+        self.assertTrue(flow.run_until(self.context, 'drawing', freeze=True))
+        self.assertIs(self.context.settings, frozen)
+
+
+class TestObservers(unittest.TestCase):
+
+    def setUp(self):
+        self.context = GameContext()
+        self.context.wall = Wall()
+
+    def test_callbacks(self):
+        events = []
+
+        class Recorder(flow.Observer):
+
+            def before_validate(self, state, context):
+                events.append(('before_validate', state))
+
+            def after_validate(self, state, context, result):
+                events.append(('after_validate', state, result.reason))
+
+            def before_next(self, state, context):
+                events.append(('before_next', state))
+
+            def after_next(self, state, context):
+                events.append(('after_next', context.state))
+
+            def on_result(self, state, context, result):
+                events.append(('on_result', state, bool(result)))
+
+        recorder = flow.add_observer(self.context, Recorder())
+        self.assertTrue(flow.next(self.context))
+        self.assertEqual(events, [('before_validate', 'start'),
+                                  ('after_validate', 'start', None),
+                                  ('before_next', 'start'),
+                                  ('after_next', 'wall-built'),
+                                  ('on_result', 'start', True)])
+
+        # failed transitions skip next()
+        del events[:]
+        self.context.state = 'discarding'
+        self.context.cur_player_idx = 0
+        self.context.players[0].hand.add_free_tile(Tile.RED)
+        self.assertFalse(flow.next(self.context))
+        self.assertEqual(events, [('before_validate', 'discarding'),
+                                  ('after_validate', 'discarding', 'decisions-needed'),
+                                  ('on_result', 'discarding', False)])
+
+        flow.remove_observer(self.context, recorder)
+        del events[:]
+        flow.next(self.context)
+        self.assertEqual(events, [])
+
+    def test_per_context(self):
+        calls = []
+
+        class Recorder(flow.Observer):
+
+            def before_validate(self, state, context):
+                calls.append(context)
+
+        flow.add_observer(self.context, Recorder())
+        other = GameContext()
+        other.wall = Wall()
+        self.assertTrue(flow.next(other))
+        self.assertTrue(flow.next(self.context.clone()))
+        self.assertEqual(calls, [])
+        self.assertTrue(flow.next(self.context))
+        self.assertEqual(calls, [self.context])
+
+    def test_timing_collector(self):
+        # a wall on which the dealer doesn't need to decide anything at 'drawn'
+        self.context.wall = Wall(rng=random.Random(0))
+        collector = flow.add_observer(self.context, flow.TimingCollector())
+        results = []
+        flow.run_until(self.context, results=results)
+        self.assertEqual(self.context.state, 'discarding')
+
+        stats = collector.as_dict()
+        self.assertEqual(stats['start']['ok']['count'], 1)
+        self.assertEqual(stats['discarding']['decisions-needed']['count'], 1)
+        self.assertEqual(sum(row['count'] for reasons in stats.itervalues()
+                             for row in reasons.itervalues()), len(results))
+        self.assertEqual(sum(collector.histogram('start')), 1)
+        self.assertEqual(sum(collector.histogram('end')), 0)
+
+        row = stats['dealt']['ok']
+        self.assertTrue(0 < row['p50'] <= row['max'])
+        self.assertTrue(row['p50'] <= row['p99'])
+        self.assertIn('decisions-needed', collector.format_table())
+        self.assertIn('"discarding"', collector.to_json())
+
+        collector.clear()
+        self.assertEqual(collector.as_dict(), {})
+
+    def test_nested_timing(self):
+        # a transition of another context within a transition
+        collector = flow.TimingCollector(min_latency=1, num_buckets=4)
+        now = [0]
+        collector._timer = lambda: now[0]
+        other = GameContext()
+        collector.before_validate('start', self.context)
+        now[0] = 1
+        collector.before_validate('dealt', other)
+        now[0] = 3
+        collector.on_result('dealt', other, flow.FlowResult(True))
+        now[0] = 8
+        collector.on_result('start', self.context, flow.FlowResult(True))
+
+        self.assertEqual(collector.as_dict()['dealt']['ok']['total'], 2)
+        self.assertEqual(collector.as_dict()['start']['ok']['total'], 8)
+
+    def test_precompute_reactions_is_silent(self):
+        flow.run_until(self.context)
+        self.assertEqual(self.context.state, 'discarding')
+
+        calls = []
+
+        class Recorder(flow.Observer):
+
+            def before_validate(self, state, context):
+                calls.append(state)
+
+            def on_event(self, context, event):
+                calls.append(event)
+
+        flow.add_observer(self.context, Recorder())
+        flow.precompute_reactions(self.context)
+        self.assertTrue(self.context.extra['reactions'])
+        self.assertEqual(calls, [])
+
+        # the discard itself is reported
+        tile = self.context.player().hand.last_tile
+        self.context.player().decision = tile
+        self.assertTrue(flow.next(self.context))
+        self.assertEqual(calls, ['discarding', flow.Discarded(0, tile)])
+
+
+class TestStream(unittest.TestCase):
+
+    def setUp(self):
+        self.context = GameContext()
+        self.context.wall = Wall()
+
+    def test_events(self):
+        stream = flow.stream(self.context)
+        events = []
+        for event in stream:
+            events.append(event)
+            if isinstance(event, flow.Blocked):
+                break
+
+        self.assertEqual(events[0], flow.Started(0, 0, 0, 0))
+        self.assertEqual(events[1], flow.Dealt(self.context.settings.total_tiles() - 64))
+        self.assertEqual(events[-1].reason, 'decisions-needed')
+        self.assertEqual(self.context.state, 'discarding')
+
+        # every flower replaced and every tile drawn is reported
+        flowers = [event.tile for event in events if isinstance(event, flow.Flowered)]
+        self.assertEqual(sorted(flowers),
+                         sorted(sum([p.hand.flowers for p in self.context.players], [])))
+        drawn = [event for event in events if isinstance(event, flow.Drawn)]
+        self.assertEqual(drawn[-1], flow.Drawn(0, self.context.player().hand.last_tile))
+
+        # keep iterating after making the decision
+        tile = self.context.player().hand.last_tile
+        self.context.player().decision = tile
+        self.assertEqual(stream.next(), flow.Discarded(0, tile))
+        stream.close()
+        self.assertEqual(self.context._observers, [])
+
+    def test_freeze(self):
+        settings = self.context.settings
+        stream = flow.stream(self.context, freeze=True)
+        self.assertEqual(stream.next(), flow.Started(0, 0, 0, 0))
+        self.assertIsInstance(self.context.settings, FrozenSettings)
+        self.assertEqual(self.context.settings, settings)
+        stream.close()
+
+    def test_stop(self):
+        for player in self.context.players:
+            player.extra['bot'] = True
+        events = list(flow.stream(self.context, flow.after_matches(1)))
+        self.assertEqual(self.context.state, 'start')
+        self.assertIsInstance(events[-1], flow.Scored)
+        self.assertEqual(list(events[-1].points), list(self.context.ledger.totals))
+        self.assertIsInstance(events[-2], (flow.Won, flow.Tied))
+        self.assertFalse([event for event in events if isinstance(event, flow.Blocked)])
+
+    def test_bad_context(self):
+        self.context.state = 'drawn'
+        self.assertEqual(list(flow.stream(self.context)), [flow.Blocked('bad-context', None)])
+
+    def test_other_contexts(self):
+        # events of other contexts don't leak into the stream
+        other = GameContext()
+        other.wall = Wall()
+        stream = flow.stream(self.context, max_steps=2)
+        self.assertIsInstance(stream.next(), flow.Started)
+        flow.next(other)
+        self.assertIsInstance(stream.next(), flow.Dealt)
+        self.assertEqual(list(stream), [])
+
+
 def draw_for_player(context, player_idx, last_player_idx=None, tile=None):
     context.last_player_idx = last_player_idx
     context.cur_player_idx = player_idx
@@ -1,3 +1,5 @@
+import json
+import threading
 import unittest
 
 from mahjong import patterns
@@ -92,22 +94,29 @@ class TestMatchAll(unittest.TestCase):
             'three-concealed-triplets': match_result
         })
 
-        # CIRCLE5 discarded by others is not concealed
-        self.context.players[1].hand.move_last_tile()
+        # CIRCLE5 discarded by others is not concealed,
+        # so it's (345, 44, 555, 333, 5555) with two concealed triplets
+        self.context.players[1].hand.last_tile = None
         self.context.discarded_pool.append(Tile.CIRCLE5)
+        self.assertEqual(patterns.match_all(self.context, 1), {})
+
+        # CIRCLE5 drawn by player himself is concealed
+        self.context.players[1].hand.last_tile = Tile.CIRCLE5
         self.assertEqual(patterns.match_all(self.context, 1), {
             'three-concealed-triplets': match_result
         })
 
-        # CIRCLE5 drawn by player himself is concealed
-        self.context.players[1].hand.last_tile = Tile.CIRCLE5
+        # add another concealed kong, making it four concealed triplets
+        self.context.players[1].hand.fixed_groups += [
+            TileGroup([Tile.EAST] * 4, TileGroup.KONG_CONCEALED)
+        ]
         self.assertEqual(patterns.match_all(self.context, 1), {
             'four-concealed-triplets': match_result
         })
 
-        # add another concealed kong, making it five concealed triplets
+        # add a third one, making it five concealed triplets
         self.context.players[1].hand.fixed_groups += [
-            TileGroup([Tile.EAST] * 4, TileGroup.KONG_CONCEALED)
+            TileGroup([Tile.WEST] * 4, TileGroup.KONG_CONCEALED)
         ]
         self.assertEqual(patterns.match_all(self.context, 1), {
             'five-concealed-triplets': match_result
@@ -404,6 +413,51 @@ class TestMatchAll(unittest.TestCase):
         })
 
 
+class TestLazyMatchResults(unittest.TestCase):
+
+    def setUp(self):
+        self.context = GameContext()
+        self.context.settings.patterns_score = {
+            'dragons': (1, 'tai'),
+            'self-picked': (1, 'tai')
+        }
+        self.context.players[0].hand.add_free_tiles([Tile.RED, Tile.RED, Tile.RED, Tile.EAST])
+        self.context.players[0].hand.last_tile = Tile.EAST
+
+    def test_lazy_match_results(self):
+        results = patterns.LazyMatchResults(self.context, 0)
+        self.assertFalse(results.resolved)
+        self.assertEqual(results, patterns.match_all(self.context, 0))
+        self.assertTrue(results.resolved)
+
+        results = patterns.LazyMatchResults(self.context, 0)
+        self.assertEqual(sorted(results.keys()), ['dragons', 'self-picked'])
+
+        results = patterns.LazyMatchResults(self.context, 0)
+        self.assertEqual(results.get('dragons'), MatchResult((1, 2, 3), 1, [Tile.RED]))
+
+        results = patterns.LazyMatchResults(self.context, 0)
+        results['dealer'] = MatchResult(1, 1)
+        self.assertEqual(len(results), 3)
+        self.assertFalse(results != dict(results))
+
+    def test_as_dict(self):
+        expected = patterns.match_all(self.context, 0)
+        self.assertEqual(dict(patterns.LazyMatchResults(self.context, 0)), expected)
+        self.assertEqual(expected, patterns.LazyMatchResults(self.context, 0))
+        self.assertEqual(patterns.LazyMatchResults(self.context, 0),
+                         patterns.LazyMatchResults(self.context, 0))
+        self.assertEqual(patterns.LazyMatchResults(self.context, 0).copy(), expected)
+
+        copied = {}
+        copied.update(patterns.LazyMatchResults(self.context, 0))
+        self.assertEqual(copied, expected)
+
+        # in a dictionary, e.g., player.extra
+        self.assertEqual({'patterns_matched': patterns.LazyMatchResults(self.context, 0)},
+                         {'patterns_matched': expected})
+
+
 class TestMatchResult(unittest.TestCase):
 
     def test_non_zero(self):
@@ -2036,3 +2090,269 @@ class TestLackASuit(unittest.TestCase):
         # lack-a-suit doesn't allow honors
         self.context.players[3].hand.add_free_tiles([Tile.EAST] * 3)
         self.assertFalse(patterns.match('lack-a-suit', self.context, 3, Tile.BAMBOO4))
+
+
+class TestFu(unittest.TestCase):
+
+    def setUp(self):
+        self.context = GameContext()
+        self.hand = self.context.players[3].hand
+
+    def test_all_sequences(self):
+        self.hand.add_free_tiles([
+            Tile.CHAR1, Tile.CHAR2, Tile.CHAR3,
+            Tile.CHAR5, Tile.CHAR6, Tile.CHAR7,
+            Tile.BAMBOO2, Tile.BAMBOO3, Tile.BAMBOO4,
+            Tile.CIRCLE6, Tile.CIRCLE7,
+            Tile.CIRCLE5, Tile.CIRCLE5
+        ])
+
+        # concealed and self-picked with an open-sides wait
+        self.hand.last_tile = Tile.CIRCLE8
+        result = patterns.match('fu', self.context, 3)
+        self.assertEqual(result, MatchResult((0, 1, 2), 1, 20))
+
+        # concealed and won on a discard
+        self.hand.last_tile = None
+        self.context.players[3].extra['chucker'] = 1
+        result = patterns.match('fu', self.context, 3, Tile.CIRCLE8)
+        self.assertEqual(result, MatchResult(1, 1, 30))
+
+        # exposed all-sequences is raised to 30
+        self.hand.free_tiles = self.hand.free_tiles[3:]
+        self.hand.fixed_groups.append(TileGroup([Tile.CHAR1, Tile.CHAR2, Tile.CHAR3], TileGroup.CHOW))
+        result = patterns.match('fu', self.context, 3, Tile.CIRCLE8)
+        self.assertEqual(result, MatchResult(1, 1, 30))
+
+        # flower win shouldn't count
+        self.context.players[3].extra['win_type'] = 'flower-won'
+        self.assertFalse(patterns.match('fu', self.context, 3, Tile.CIRCLE8))
+
+    def test_triplets_and_waits(self):
+        self.hand.add_free_tiles([
+            Tile.CHAR1, Tile.CHAR1, Tile.CHAR1,
+            Tile.CHAR5, Tile.CHAR6, Tile.CHAR7,
+            Tile.BAMBOO2, Tile.BAMBOO3, Tile.BAMBOO4,
+            Tile.CIRCLE6, Tile.CIRCLE8,
+            Tile.RED, Tile.RED
+        ])
+
+        # 20 + terminal triplet 8 + hole 2 + dragon pair 2 + self-picked 2
+        self.hand.last_tile = Tile.CIRCLE7
+        result = patterns.match('fu', self.context, 3)
+        self.assertEqual(result.extra, 40)
+
+        # 20 + concealed 10 + terminal triplet 8 + hole 2 + dragon pair 2
+        self.hand.last_tile = None
+        self.context.players[3].extra['chucker'] = 1
+        result = patterns.match('fu', self.context, 3, Tile.CIRCLE7)
+        self.assertEqual(result.extra, 50)
+
+        # 20 + exposed honor pong 4 + terminal triplet 8 + hole 2 + dragon pair 2
+        self.hand.free_tiles = self.hand.free_tiles[:3] + self.hand.free_tiles[6:]
+        self.hand.fixed_groups.append(TileGroup([Tile.WHITE] * 3, TileGroup.PONG))
+        result = patterns.match('fu', self.context, 3, Tile.CIRCLE7)
+        self.assertEqual(result.extra, 40)
+
+    def test_triplet_completed_by_discard(self):
+        self.hand.add_free_tiles([
+            Tile.CHAR1, Tile.CHAR2, Tile.CHAR3,
+            Tile.CHAR5, Tile.CHAR6, Tile.CHAR7,
+            Tile.BAMBOO2, Tile.BAMBOO3, Tile.BAMBOO4,
+            Tile.CHAR9, Tile.CHAR9,
+            Tile.CIRCLE5, Tile.CIRCLE5
+        ])
+
+        # 20 + concealed 10 + exposed terminal triplet 4
+        self.context.players[3].extra['chucker'] = 2
+        result = patterns.match('fu', self.context, 3, Tile.CHAR9)
+        self.assertEqual(result, MatchResult(2, 1, 40))
+
+        # 20 + concealed terminal triplet 8 + self-picked 2
+        self.context.players[3].extra['chucker'] = None
+        self.hand.last_tile = Tile.CHAR9
+        result = patterns.match('fu', self.context, 3)
+        self.assertEqual(result.extra, 30)
+
+
+class TestHandFeatures(unittest.TestCase):
+
+    def setUp(self):
+        self.context = GameContext()
+        self.context.players[0].hand.add_free_tiles([Tile.CHAR1, Tile.CHAR1, Tile.RED])
+
+    def test_reused(self):
+        features = patterns.HandFeatures.get(self.context, 0, Tile.RED)
+        self.assertIs(patterns.HandFeatures.get(self.context, 0, Tile.RED), features)
+        self.assertIsNot(patterns.HandFeatures.get(self.context, 0, Tile.CHAR1), features)
+
+        # the same hand in another context
+        clone = self.context.clone()
+        self.assertTrue(patterns.HandFeatures.get(clone, 0, Tile.RED).is_dealer)
+        clone.dealer = 1
+        self.assertFalse(patterns.HandFeatures.get(clone, 0, Tile.RED).is_dealer)
+
+    def test_per_thread(self):
+        features = patterns.HandFeatures.get(self.context, 0, Tile.RED)
+        other = GameContext()
+        thread = threading.Thread(target=patterns.HandFeatures.get, args=(other, 1, None))
+        thread.start()
+        thread.join()
+        self.assertIs(patterns.HandFeatures.get(self.context, 0, Tile.RED), features)
+
+
+class TestDeclarativePattern(unittest.TestCase):
+
+    def setUp(self):
+        self.context = GameContext()
+        self.context.players[0].hand.add_free_tiles([
+            Tile.BAMBOO2, Tile.BAMBOO3, Tile.BAMBOO4,
+            Tile.BAMBOO6, Tile.BAMBOO6, Tile.BAMBOO6,
+            Tile.GREEN
+        ])
+        self.context.players[0].hand.fixed_groups += [
+            TileGroup([Tile.BAMBOO8] * 3, TileGroup.PONG)
+        ]
+        self.greens = (Tile.BAMBOO2, Tile.BAMBOO3, Tile.BAMBOO4, Tile.BAMBOO6,
+                       Tile.BAMBOO8, Tile.GREEN)
+
+    def test_only_tiles(self):
+        pattern = patterns.DeclarativePattern(only_tiles=self.greens)
+        result = pattern.match(self.context, 0, Tile.GREEN)
+        self.assertEqual(list(result), [0, 1, 1, 1])
+        self.assertFalse(pattern.match(self.context, 0, Tile.RED))
+
+    def test_min_counts_and_melds(self):
+        pattern = patterns.DeclarativePattern(min_counts={Tile.BAMBOO6: 3, Tile.BAMBOO8: 3},
+                                              melds={'pong': 1, 'chow': 0})
+        self.assertTrue(pattern.match(self.context, 0, Tile.GREEN))
+
+        pattern = patterns.DeclarativePattern(melds={'kong': (1, None)})
+        self.assertFalse(pattern.match(self.context, 0, Tile.GREEN))
+
+        with self.assertRaises(ValueError):
+            patterns.DeclarativePattern(melds={'triplet': 1})
+
+    def test_suits_and_win_type(self):
+        pattern = patterns.DeclarativePattern(numeric_suits=1, honors=True, self_picked=False,
+                                              payer='chucker', multiplier=2)
+
+        # self-picked
+        self.context.players[0].hand.last_tile = Tile.GREEN
+        self.assertFalse(pattern.match(self.context, 0, Tile.GREEN))
+
+        # won by GREEN discarded by player 3
+        self.context.players[0].hand.last_tile = None
+        self.context.players[0].extra.update({
+            'win_type': 'melded',
+            'chucker': 3
+        })
+        result = pattern.match(self.context, 0, Tile.GREEN)
+        self.assertEqual(list(result), [0, 0, 0, 2])
+
+        # no honors
+        self.context.players[0].hand.remove_free_tile(Tile.GREEN)
+        self.context.players[0].hand.add_free_tile(Tile.BAMBOO3)
+        self.assertFalse(pattern.match(self.context, 0, Tile.BAMBOO3))
+
+        # flower win never matches
+        self.context.players[0].extra['win_type'] = 'flower-won'
+        self.assertFalse(pattern.match(self.context, 0, Tile.RED))
+
+    def test_predicate(self):
+        pattern = patterns.DeclarativePattern(predicate=lambda f: f.counts[0] > 0,
+                                              payer='others')
+        self.assertFalse(pattern.match(self.context, 0, Tile.GREEN))
+        result = pattern.match(self.context, 0, Tile.CHAR1)
+        self.assertEqual(list(result), [0, 1, 1, 1])
+
+        with self.assertRaises(ValueError):
+            patterns.DeclarativePattern(payer='dealer')
+
+    def test_define(self):
+        pattern = patterns.define('test-all-greens', only_tiles=self.greens,
+                                  implies=('same-suit',))
+        try:
+            self.assertIs(patterns.get('test-all-greens'), pattern)
+            with self.assertRaises(KeyError):
+                patterns.define('test-all-greens')
+
+            self.context.settings.patterns_score = {
+                'test-all-greens': (16, 'tai'),
+                'same-suit': (8, 'tai')
+            }
+            self.context.players[0].hand.remove_free_tile(Tile.GREEN)
+            self.context.players[0].hand.last_tile = Tile.BAMBOO2
+            self.assertEqual(patterns.match_all(self.context, 0), {
+                'test-all-greens': MatchResult((1, 2, 3), 1)
+            })
+        finally:
+            patterns._PATTERNS.pop('test-all-greens')
+
+
+class TestPatternStats(unittest.TestCase):
+
+    def setUp(self):
+        self.context = GameContext()
+        self.context.settings.patterns_score = {
+            'self-picked': (1, 'tai'),
+            'all-melded': (2, 'tai'),
+            'dragons': (1, 'tai')
+        }
+        self.context.players[0].hand.add_free_tiles([
+            Tile.CHAR1, Tile.CHAR2, Tile.CHAR3, Tile.RED, Tile.RED, Tile.RED, Tile.EAST
+        ])
+        self.context.players[0].hand.last_tile = Tile.EAST
+
+    def tearDown(self):
+        patterns.disable_stats()
+
+    def test_enable_and_disable(self):
+        self.assertIsNone(patterns.get_stats())
+        stats = patterns.enable_stats()
+        self.assertIs(patterns.get_stats(), stats)
+        self.assertIn('match', patterns.get('dragons').__dict__)
+
+        patterns.match_all(self.context, 0)
+        patterns.match_all(self.context, 0)
+        result = stats.as_dict()
+
+        self.assertEqual(result['dragons']['calls'], 2)
+        self.assertEqual(result['dragons']['matches'], 2)
+        self.assertEqual(result['dragons']['match_rate'], 1.0)
+        self.assertEqual(result['dragons']['sampled'], 2)
+        self.assertTrue(result['dragons']['p99'] >= result['dragons']['p50'] >= 0)
+
+        # all-melded is either matched or skipped because self-picked excludes it
+        self.assertEqual(result['all-melded']['matches'], 0)
+        self.assertEqual(result['all-melded']['calls'] + result['all-melded']['skipped'], 2)
+
+        self.assertIs(patterns.disable_stats(), stats)
+        self.assertIsNone(patterns.get_stats())
+        self.assertNotIn('match', patterns.get('dragons').__dict__)
+        patterns.match_all(self.context, 0)
+        self.assertEqual(stats.as_dict()['dragons']['calls'], 2)
+
+    def test_sampling(self):
+        stats = patterns.enable_stats(sample_rate=0.0, max_samples=1)
+        for __ in xrange(3):
+            patterns.match('dragons', self.context, 0)
+        result = stats.as_dict()['dragons']
+        self.assertEqual(result['calls'], 3)
+        self.assertEqual(result['sampled'], 0)
+        self.assertEqual(result['total'], 0.0)
+
+        stats.sample_rate = 1.0
+        for __ in xrange(3):
+            patterns.match('dragons', self.context, 0)
+        self.assertEqual(stats.as_dict()['dragons']['sampled'], 3)
+        self.assertEqual(len(stats.entry('dragons').samples), 1)
+
+    def test_export(self):
+        stats = patterns.enable_stats()
+        patterns.match_all(self.context, 0)
+        self.assertEqual(json.loads(stats.to_json()), stats.as_dict())
+
+        lines = stats.format_table().splitlines()
+        self.assertTrue(lines[0].startswith('name'))
+        self.assertEqual(len(lines), len(stats.as_dict()) + 1)
@@ -0,0 +1,96 @@
+import random
+import unittest
+
+from mahjong import bots, flow, replay, snapshot
+from mahjong.types import GameContext, Tile, Wall
+
+
+class _Snapshots(flow.Observer):
+    # snapshots of a context before each transition
+
+    def __init__(self):
+        self.snapshots = []
+
+    def before_validate(self, state, context):
+        self.snapshots.append(snapshot.dumps(context))
+
+
+class TestReplay(unittest.TestCase):
+
+    def setUp(self):
+        self.context = GameContext()
+        self.context.wall = Wall(rng=random.Random(11))
+        for player in self.context.players[:3]:
+            player.extra['bot'] = True
+
+        self.recorder = flow.add_observer(self.context, replay.Recorder(keyframe_interval=16))
+        self.observer = flow.add_observer(self.context, _Snapshots())
+        try:
+            # player 3 plays like a bot, through decisions
+            bot = bots.get()
+            for event in flow.stream(self.context, flow.after_matches(2)):
+                if isinstance(event, flow.Blocked):
+                    self.context.players[3].decision = bot.make_decision(
+                        self.context, 3, event.viable_decisions[3])
+        finally:
+            flow.remove_observer(self.context, self.recorder)
+            flow.remove_observer(self.context, self.observer)
+        self.replay = self.recorder.replay
+
+    def test_recorded(self):
+        self.assertEqual(len(self.replay), len(self.observer.snapshots))
+        self.assertEqual(len(self.replay.keyframes), (len(self.replay) + 15) // 16)
+        self.assertEqual(self.replay.keyframes, self.observer.snapshots[::16])
+        self.assertTrue(any(not step.ok for step in self.replay.steps))
+        self.assertTrue(any(step.decisions[3] is not None for step in self.replay.steps))
+        self.assertEqual(len([step for step in self.replay.steps if step.wall]), 2)
+
+    def test_seek(self):
+        settings = self.context.settings
+        for i, data in enumerate(self.observer.snapshots):
+            self.assertEqual(self.replay.seek(i, settings), snapshot.loads(data, settings))
+        self.assertEqual(self.replay.seek(len(self.replay), settings), self.context)
+        with self.assertRaises(IndexError):
+            self.replay.seek(len(self.replay) + 1)
+
+    def test_verify(self):
+        self.assertIsNone(self.replay.verify(self.context.settings, self.context))
+
+        # a different decision
+        for i, step in enumerate(self.replay.steps):
+            if isinstance(step.decisions[3], Tile):
+                tile = step.decisions[3]
+                step.decisions[3] = 'skip'
+                self.assertEqual(self.replay.verify(self.context.settings), i)
+                step.decisions[3] = tile
+                break
+
+        # a different final state
+        self.context.players[0].extra['bot'] = False
+        self.assertEqual(self.replay.verify(self.context.settings, self.context),
+                         len(self.replay))
+
+    def test_tampered_keyframe(self):
+        keyframe = snapshot.loads(self.replay.keyframes[2])
+        keyframe.players[1].hand.free_tiles[0] = Tile.RED
+        self.replay.keyframes[2] = snapshot.dumps(keyframe)
+        self.assertEqual(self.replay.verify(self.context.settings), 32)
+
+    def test_dumps_and_loads(self):
+        data = self.replay.dumps()
+        self.assertEqual(replay.loads(data), self.replay)
+        self.assertIsNone(replay.loads(data).verify(self.context.settings, self.context))
+
+        with self.assertRaisesRegexp(ValueError, 'Not a replay'):
+            replay.loads('XX' + data[2:])
+        with self.assertRaisesRegexp(ValueError, 'Trailing'):
+            replay.loads(data + '\x00')
+        with self.assertRaises(ValueError):
+            replay.loads(data[:-1])
+
+    def test_empty(self):
+        log = replay.Replay()
+        self.assertIsNone(log.verify())
+        self.assertEqual(replay.loads(log.dumps()), log)
+        with self.assertRaises(ValueError):
+            replay.Replay(0)
@@ -2,6 +2,7 @@ import unittest
 
 from mahjong import scoring
 from mahjong.patterns import MatchResult
+from mahjong.types import GameSettings
 
 
 class TestTWScorer(unittest.TestCase):
@@ -34,3 +35,153 @@ class TestTWScorer(unittest.TestCase):
         # total:                              [0, 14, 7, 11]
         scores = scoring.score('tw', match_results, patterns_score)
         self.assertEqual(scores, [0, 14, 7, 11])
+
+
+class TestJPScorer(unittest.TestCase):
+
+    def setUp(self):
+        self.patterns_score = {
+            'fu': (0, 'fu'),
+            'self-picked': (1, 'han'),
+            'dragons': (1, 'han'),
+            'all-sequences': (1, 'han'),
+            'mix-a-suit': (3, 'han'),
+            'big-three-dragons': (1, 'yakuman')
+        }
+
+    def test_jp_scorer(self):
+        # 2 han 30 fu: 30 x 2^4 = 480
+        match_results = {
+            'fu': MatchResult(1, 1, 30),
+            'dragons': MatchResult(1, 1),
+            'all-sequences': MatchResult(1, 1)
+        }
+        self.assertEqual(scoring.score('jp', match_results, self.patterns_score), [0, 480, 0, 0])
+
+        # 4 han 30 fu: 1920, 4 han 40 fu: mangan
+        match_results = {
+            'fu': MatchResult((0, 1, 2), 1, 30),
+            'self-picked': MatchResult((0, 1, 2), 1),
+            'mix-a-suit': MatchResult((0, 1, 2), 1)
+        }
+        self.assertEqual(scoring.score('jp', match_results, self.patterns_score), [1920, 1920, 1920, 0])
+        match_results['fu'].extra = 40
+        self.assertEqual(scoring.score('jp', match_results, self.patterns_score), [2000, 2000, 2000, 0])
+
+        # 6 han: haneman, 13+ han: yakuman
+        match_results['dragons'] = MatchResult((0, 1, 2), 2)
+        self.assertEqual(scoring.score('jp', match_results, self.patterns_score), [3000, 3000, 3000, 0])
+        match_results['dragons'] = MatchResult((0, 1, 2), 20)
+        self.assertEqual(scoring.score('jp', match_results, self.patterns_score), [8000, 8000, 8000, 0])
+
+        # yakuman doesn't add han
+        match_results = {
+            'fu': MatchResult(2, 1, 50),
+            'dragons': MatchResult(2, 3),
+            'big-three-dragons': MatchResult(2, 1)
+        }
+        self.assertEqual(scoring.score('jp', match_results, self.patterns_score), [0, 0, 8000, 0])
+
+        # default fu
+        match_results = {
+            'mix-a-suit': MatchResult(3, 1)
+        }
+        self.assertEqual(scoring.score('jp', match_results, self.patterns_score), [0, 0, 0, 960])
+
+    def test_high_fu(self):
+        # fu beyond the table: 1 han 130 fu = 1040, 2 han 120 fu = 1920,
+        # 3 han 120 fu is capped at mangan
+        match_results = {
+            'fu': MatchResult(1, 1, 130),
+            'dragons': MatchResult(1, 1)
+        }
+        self.assertEqual(scoring.score('jp', match_results, self.patterns_score), [0, 1040, 0, 0])
+        match_results['fu'].extra = 120
+        match_results['all-sequences'] = MatchResult(1, 1)
+        self.assertEqual(scoring.score('jp', match_results, self.patterns_score), [0, 1920, 0, 0])
+        match_results['self-picked'] = MatchResult(1, 1)
+        self.assertEqual(scoring.score('jp', match_results, self.patterns_score), [0, 2000, 0, 0])
+
+        # limit and yakuman hands don't depend on fu
+        match_results['fu'].extra = 170
+        match_results['mix-a-suit'] = MatchResult(1, 1)
+        self.assertEqual(scoring.score('jp', match_results, self.patterns_score), [0, 3000, 0, 0])
+        match_results['big-three-dragons'] = MatchResult(1, 1)
+        self.assertEqual(scoring.score('jp', match_results, self.patterns_score), [0, 8000, 0, 0])
+
+    def test_basic_points(self):
+        # basic points, not payments: 3 han 30 fu is 960, which a non-dealer
+        # pays as 960 x 4 = 3840 -> 3900 on a discard
+        match_results = {
+            'fu': MatchResult(0, 1, 30),
+            'mix-a-suit': MatchResult(0, 1)
+        }
+        self.assertEqual(scoring.score('jp', match_results, self.patterns_score), [960, 0, 0, 0])
+
+        # no han, no points
+        match_results = {
+            'fu': MatchResult(0, 1, 130)
+        }
+        self.assertEqual(scoring.score('jp', match_results, self.patterns_score), [0, 0, 0, 0])
+
+
+class TestScoreBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.patterns_score = {
+            'dealer': (1, 'tai'),
+            'self-picked': (1, 'tai'),
+            'dragons': (1, 'tai'),
+            'four-flowers': (2, 'tai'),
+            'seven-flowers': (8, 'tai')
+        }
+        self.pattern_names = sorted(self.patterns_score)
+        self.match_results_list = [
+            {
+                'dealer': MatchResult(1, 1),
+                'dragons': MatchResult((1, 2, 3), 2),
+                'seven-flowers': MatchResult(3, 1)
+            },
+            {},
+            {
+                'self-picked': MatchResult((0, 1, 2), 1),
+                'four-flowers': MatchResult((0, 1), 2)
+            }
+        ]
+
+    def test_to_multipliers(self):
+        multipliers = scoring.to_multipliers(self.match_results_list, self.pattern_names)
+        self.assertEqual(len(multipliers), 3)
+        self.assertEqual([len(win) for win in multipliers], [5, 5, 5])
+
+        # ['dealer', 'dragons', 'four-flowers', 'self-picked', 'seven-flowers']
+        self.assertEqual(list(multipliers[0][1]), [0, 2, 2, 2])
+        self.assertEqual(list(multipliers[0][4]), [0, 0, 0, 1])
+        self.assertFalse(any(any(row) for row in multipliers[1]))
+        self.assertEqual(list(multipliers[2][3]), [1, 1, 1, 0])
+
+        # with the indices of frozen settings
+        settings = GameSettings()
+        settings.patterns_score = self.patterns_score
+        settings = settings.freeze()
+        indexed = scoring.to_multipliers(self.match_results_list, settings.pattern_names,
+                                         settings.pattern_indices)
+        self.assertEqual([[list(row) for row in win] for win in indexed],
+                         [[list(row) for row in win] for win in multipliers])
+
+    def test_pattern_vector(self):
+        self.assertEqual(scoring.pattern_vector(self.pattern_names, self.patterns_score),
+                         [1, 1, 2, 1, 8])
+
+    def test_score_batch(self):
+        multipliers = scoring.to_multipliers(self.match_results_list, self.pattern_names)
+        expected = [scoring.score('tw', match_results, self.patterns_score)
+                    for match_results in self.match_results_list]
+
+        scores = scoring.score_batch('tw', multipliers, self.pattern_names, self.patterns_score)
+        self.assertEqual([list(row) for row in scores], expected)
+
+        # the generic implementation gives the same numbers
+        scores = scoring.Scorer.score_batch(scoring._SCORERS['tw'], multipliers,
+                                            self.pattern_names, self.patterns_score)
+        self.assertEqual([list(row) for row in scores], expected)
@@ -0,0 +1,245 @@
+import random
+import unittest
+
+from mahjong import flow, patterns, snapshot
+from mahjong.patterns import MatchResult
+from mahjong.types import GameContext, GameSettings, Tile, TileGroup, Wall
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.context = GameContext()
+        self.context.wall = Wall(rng=random.Random(7))
+        for player in self.context.players:
+            player.extra['bot'] = True
+
+    def assertRoundTrip(self, context):
+        data = snapshot.dumps(context)
+        restored = snapshot.loads(data, context.settings)
+        self.assertEqual(restored, context)
+        self.assertEqual(len(snapshot.dumps(restored)), len(data))
+        return data
+
+    def test_empty_context(self):
+        data = self.assertRoundTrip(GameContext())
+        self.assertIsNone(snapshot.loads(data).wall)
+
+    def test_every_state(self):
+        # play three matches, checking the context at every step
+        max_size = 0
+        while self.context.match < 3:
+            self.assertTrue(flow.next(self.context))
+            data = self.assertRoundTrip(self.context)
+            max_size = max(max_size, len(data))
+        self.assertEqual(len(self.context.ledger), 3)
+        self.assertLess(max_size, 1024)
+
+    def test_restored_game_goes_on(self):
+        flow.run_until(self.context, 'discarding')
+        for __ in xrange(20):
+            flow.next(self.context)
+        restored = snapshot.loads(snapshot.dumps(self.context))
+        restored.wall.rng = random.Random(0)
+        self.context.wall.rng = random.Random(0)
+        for __ in xrange(50):
+            self.assertEqual(bool(flow.next(restored)), bool(flow.next(self.context)))
+            self.assertEqual(restored, self.context)
+
+    def test_shared_wall(self):
+        flow.run_until(self.context, 'discarding')
+        clone = self.context.clone()
+        clone.wall.draw()
+        self.assertRoundTrip(clone)
+        self.assertEqual(self.context.wall.num_tiles(), clone.wall.num_tiles() + 1)
+
+    def test_fields(self):
+        context = self.context
+        context.state = 'end'
+        context.cur_player_idx = None
+        context.round = 70000
+        context.match = 3
+        context.dealer = 2
+        context.dealer_defended = 999
+        context.winners = [1, 3]
+        hand = context.players[1].hand
+        hand.add_free_tiles([Tile.CHAR1, Tile.CHAR1, Tile.RED])
+        hand.last_tile = Tile.RED
+        hand.fixed_groups += [TileGroup([Tile.EAST] * 4, TileGroup.KONG_CONCEALED),
+                              TileGroup([Tile.CHAR2, Tile.CHAR3, Tile.CHAR4], TileGroup.CHOW)]
+        hand.add_flower(Tile.PLUM)
+        context.players[0].discarded += [Tile.EAST, Tile.WEST]
+        context.players[0].decision = Tile.WEST
+        context.players[2].decision = (Tile.CHAR2, Tile.CHAR3)
+        context.discarded_pool += [Tile.EAST, Tile.WEST]
+        context.ledger.append([3, -3, 0, 0], 0, 0)
+        context.ledger.append([-10000, 0, 0, 10000], 1, 3)
+        self.assertRoundTrip(context)
+
+    def test_extra(self):
+        self.context.extra.update({
+            'none': None,
+            'bools': [True, False],
+            'ints': (0, -1, 127, -128, 128, 2 ** 40, -2 ** 40),
+            'float': 0.25,
+            'strs': ['', 'abc', u'\u4e2d'],
+            'tiles': set([Tile.RED, Tile.SUMMER]),
+            'frozen': frozenset([1, 2]),
+            'group': TileGroup([Tile.RED] * 3, TileGroup.PONG),
+            'result': MatchResult(1, 2, extra={'tile': Tile.RED}),
+            Tile.EAST: {(Tile.CHAR1, 3): [[]]},
+            7: 'int key'
+        })
+        data = self.assertRoundTrip(self.context)
+        extra = snapshot.loads(data).extra
+        self.assertIs(type(extra['ints']), tuple)
+        self.assertIs(type(extra['tiles']), set)
+        self.assertIs(type(extra['frozen']), frozenset)
+        self.assertIs(type(extra['strs'][2]), unicode)
+
+    def test_lazy_match_results(self):
+        # player 2 wins on the RED discarded by player 0
+        context = self.context
+        context.state = 'end'
+        context.settings.ledger = False
+        hand = context.players[2].hand
+        hand.add_free_tiles([
+            Tile.CHAR1, Tile.CHAR2, Tile.CHAR3,
+            Tile.CIRCLE4, Tile.CIRCLE4, Tile.CIRCLE4,
+            Tile.RED, Tile.RED, Tile.RED,
+            Tile.BAMBOO9, Tile.BAMBOO9
+        ])
+        hand.fixed_groups.append(TileGroup([Tile.WEST] * 3, TileGroup.PONG))
+        context.players[0].discarded.append(Tile.RED)
+        context.discarded_pool.append(Tile.RED)
+        context.players[2].extra.update({'win_type': 'melded', 'chucker': 0})
+        context.winners = [2]
+        self.assertTrue(flow.next(context))
+        self.assertEqual(context.state, 'scored')
+
+        match_results = context.players[2].extra['patterns_matched']
+        self.assertIsInstance(match_results, patterns.LazyMatchResults)
+        self.assertRoundTrip(context)
+        self.assertIn('dragons', match_results)
+
+    def test_settings(self):
+        settings = GameSettings()
+        settings.multi_winners = True
+        restored = snapshot.loads(snapshot.dumps(self.context), settings)
+        self.assertIs(restored.settings, settings)
+
+    def test_unsupported_value(self):
+        self.context.extra['object'] = object()
+        with self.assertRaises(TypeError):
+            snapshot.dumps(self.context)
+
+    def test_corrupt(self):
+        flow.run_until(self.context, 'discarding')
+        data = snapshot.dumps(self.context)
+        with self.assertRaisesRegexp(ValueError, 'Not a snapshot'):
+            snapshot.loads('XX' + data[2:])
+        with self.assertRaisesRegexp(ValueError, 'version'):
+            snapshot.loads(data[:2] + chr(snapshot.VERSION + 1) + data[3:])
+        with self.assertRaisesRegexp(ValueError, 'Trailing'):
+            snapshot.loads(data + 'N')
+        for size in (0, 5, len(data) / 2, len(data) - 1):
+            with self.assertRaises(ValueError):
+                snapshot.loads(data[:size])
+
+
+class TestDelta(unittest.TestCase):
+
+    def setUp(self):
+        self.context = GameContext()
+        self.context.wall = Wall(rng=random.Random(3))
+        for player in self.context.players:
+            player.extra['bot'] = True
+        self.client = snapshot.loads(snapshot.dumps(self.context))
+
+    def test_every_transition(self):
+        seq = 0
+        delta_size = full_size = 0
+        while self.context.match < 3:
+            last = self.context.clone()
+            self.assertTrue(flow.next(self.context))
+            delta = snapshot.diff(last, self.context, seq, seq + 1)
+            self.assertEqual(snapshot.delta_seqs(delta), (seq, seq + 1))
+            seq = snapshot.patch(self.client, delta, seq)
+            self.assertEqual(self.client, self.context)
+            delta_size += len(delta)
+            full_size += len(snapshot.dumps(self.context))
+        self.assertLess(delta_size * 5, full_size)
+
+    def test_no_change(self):
+        delta = snapshot.diff(self.context, self.context.clone(), 7, 8)
+        self.assertEqual(snapshot.patch(self.client, delta, 7), 8)
+        self.assertEqual(self.client, self.context)
+
+    def test_changes(self):
+        flow.run_until(self.context, 'discarding')
+        self.client = snapshot.loads(snapshot.dumps(self.context))
+        context = self.context.clone()
+
+        # not the kind of changes flow makes
+        context.wall.tiles.reverse()
+        context.discarded_pool = [Tile.RED, Tile.EAST]
+        player = context.players[2]
+        player.hand.free_tiles = sorted(player.hand.free_tiles[1:] + [Tile.WHITE])
+        player.hand.fixed_groups.append(TileGroup([Tile.RED] * 3, TileGroup.PONG))
+        player.hand.flowers = [Tile.SPRING]
+        player.discarded = [Tile.CHAR9]
+        player.decision = (Tile.CHAR1, Tile.CHAR2)
+        player.extra['water'] = [Tile.CHAR3]
+        context.ledger.append([1, 2, -3, 0], 0, 0)
+        context.winners = [2]
+        context.extra['tie_type'] = 'wall'
+
+        delta = snapshot.diff(self.context, context, 0, 1)
+        snapshot.patch(self.client, delta, 0)
+        self.assertEqual(self.client, context)
+
+        # and back
+        delta = snapshot.diff(context, self.context, 1, 2)
+        snapshot.patch(self.client, delta, 1)
+        self.assertEqual(self.client, self.context)
+
+    def test_ledger(self):
+        context = self.context.clone()
+        context.ledger.append([1, -1, 0, 0], 0, 0)
+        context.ledger.append([0, 2, -2, 0], 0, 1)
+        snapshot.patch(self.client, snapshot.diff(self.context, context, 0, 1), 0)
+        self.assertEqual(self.client.ledger, context.ledger)
+        self.assertEqual(self.client.ledger.dealer_totals(1), [0, 2, -2, 0])
+
+        # cleared
+        snapshot.patch(self.client, snapshot.diff(context, self.context, 1, 2), 1)
+        self.assertEqual(self.client.ledger, self.context.ledger)
+
+    def test_wall(self):
+        context = self.context.clone()
+        context.wall = None
+        snapshot.patch(self.client, snapshot.diff(self.context, context, 0, 1), 0)
+        self.assertIsNone(self.client.wall)
+        snapshot.patch(self.client, snapshot.diff(context, self.context, 1, 2), 1)
+        self.assertEqual(self.client.wall, self.context.wall)
+
+        # drawn from a wall of its own
+        context = self.context.clone()
+        context.wall.tiles.pop()
+        context.wall.tiles.pop()
+        delta = snapshot.diff(self.context, context, 2, 3)
+        self.assertLess(len(delta), 20)
+        snapshot.patch(self.client, delta, 2)
+        self.assertEqual(self.client.wall, context.wall)
+
+    def test_gap(self):
+        context = self.context.clone()
+        context.state = 'wall-built'
+        delta = snapshot.diff(self.context, context, 5, 6)
+        with self.assertRaisesRegexp(ValueError, 'version 5, not 4'):
+            snapshot.patch(self.client, delta, 4)
+        self.assertEqual(self.client.state, 'start')
+        with self.assertRaisesRegexp(ValueError, 'Not a delta'):
+            snapshot.patch(self.client, snapshot.dumps(context), 5)
+        with self.assertRaises(ValueError):
+            snapshot.patch(self.client, delta[:-1], 5)
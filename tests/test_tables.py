@@ -0,0 +1,117 @@
+import unittest
+
+from mahjong import tables
+from mahjong.tables import PAIR, SEQUENCE, TRIPLET
+
+
+class TestDecompose(unittest.TestCase):
+
+    def test_empty_row(self):
+        self.assertEqual(tables.decompose((0,) * 9), ((),))
+
+    def test_impossible_rows(self):
+        # 3n + 1 tiles
+        self.assertEqual(tables.decompose((1, 0, 0, 0, 0, 0, 0, 0, 0)), ())
+        # 3n tiles but not groupable
+        self.assertEqual(tables.decompose((1, 0, 1, 0, 1, 0, 0, 0, 0)), ())
+        # 3n + 2 tiles without a pair
+        self.assertEqual(tables.decompose((1, 1, 1, 0, 1, 1, 0, 0, 0)), ())
+
+    def test_pair_and_groups(self):
+        # 11123
+        self.assertEqual(tables.decompose((3, 1, 1, 0, 0, 0, 0, 0, 0)), (
+            ((PAIR, 1), (SEQUENCE, 1)),
+        ))
+
+        # 111222333 can be three triplets or three sequences
+        self.assertEqual(tables.decompose((3, 3, 3, 0, 0, 0, 0, 0, 0)), (
+            ((SEQUENCE, 1), (SEQUENCE, 1), (SEQUENCE, 1)),
+            ((TRIPLET, 1), (TRIPLET, 2), (TRIPLET, 3))
+        ))
+
+        # 777888999 + 99 from the concealed-triplets counter example
+        decomps = tables.decompose((0, 0, 0, 0, 0, 0, 4, 4, 3))
+        self.assertEqual(decomps, (
+            ((PAIR, 9), (SEQUENCE, 7), (TRIPLET, 7), (TRIPLET, 8)),
+        ))
+
+    def test_honors(self):
+        # east, south, west can't form a sequence
+        self.assertEqual(tables.decompose((1, 1, 1, 0, 0, 0, 0, 0, 0), True), ())
+        self.assertEqual(tables.decompose((3, 2, 0, 0, 0, 0, 0, 0, 0), True), (
+            ((PAIR, 2), (TRIPLET, 1)),
+        ))
+
+
+class TestWaits(unittest.TestCase):
+
+    def test_no_waits(self):
+        self.assertEqual(tables.waits((1, 0, 0, 1, 0, 0, 1, 0, 0)), {})
+
+    def test_wait_shapes(self):
+        # 12 waits for 3
+        self.assertEqual(tables.waits((1, 1, 0, 0, 0, 0, 0, 0, 0)), {
+            3: frozenset([tables.EDGE])
+        })
+
+        # 13 waits for 2
+        self.assertEqual(tables.waits((1, 0, 1, 0, 0, 0, 0, 0, 0)), {
+            2: frozenset([tables.HOLE])
+        })
+
+        # 45 waits for 3 and 6
+        self.assertEqual(tables.waits((0, 0, 0, 1, 1, 0, 0, 0, 0)), {
+            3: frozenset([tables.OPEN_SIDES]),
+            6: frozenset([tables.OPEN_SIDES])
+        })
+
+        # 1234 waits for 1 and 4 as eyes
+        self.assertEqual(tables.waits((1, 1, 1, 1, 0, 0, 0, 0, 0)), {
+            1: frozenset([tables.EYE]),
+            4: frozenset([tables.EYE])
+        })
+
+        # 1133 waits for 1 and 3 as pair-of-pairs
+        self.assertEqual(tables.waits((2, 0, 2, 0, 0, 0, 0, 0, 0)), {
+            1: frozenset([tables.PAIR_OF_PAIRS]),
+            3: frozenset([tables.PAIR_OF_PAIRS])
+        })
+
+        # 1233 waits for 3 as an edge or an eye
+        self.assertEqual(tables.waits((1, 1, 2, 0, 0, 0, 0, 0, 0)), {
+            3: frozenset([tables.EDGE, tables.EYE])
+        })
+
+    def test_honors(self):
+        # east and south wait for themselves, no sequences
+        self.assertEqual(tables.waits((2, 2, 0, 0, 0, 0, 0, 0, 0), True), {
+            1: frozenset([tables.PAIR_OF_PAIRS]),
+            2: frozenset([tables.PAIR_OF_PAIRS])
+        })
+        self.assertEqual(tables.waits((1, 0, 1, 0, 0, 0, 0, 0, 0), True), {})
+
+
+class TestSequenceTables(unittest.TestCase):
+
+    def test_sequence_decomposable(self):
+        self.assertTrue(tables.sequence_decomposable((0,) * 9))
+        # 111222333 can be grouped into three sequences
+        self.assertTrue(tables.sequence_decomposable((3, 3, 3, 0, 0, 0, 0, 0, 0)))
+        # 11123 is 11 + 123
+        self.assertTrue(tables.sequence_decomposable((3, 1, 1, 0, 0, 0, 0, 0, 0)))
+        # 11155 must have a triplet
+        self.assertFalse(tables.sequence_decomposable((3, 0, 0, 0, 2, 0, 0, 0, 0)))
+        # honors can only be a pair
+        self.assertTrue(tables.sequence_decomposable((0, 2, 0, 0, 0, 0, 0, 0, 0), True))
+        self.assertFalse(tables.sequence_decomposable((0, 3, 0, 0, 0, 0, 0, 0, 0), True))
+
+    def test_sequence_waits(self):
+        # 45 waits for 3 and 6
+        self.assertEqual(tables.sequence_waits((0, 0, 0, 1, 1, 0, 0, 0, 0)),
+                         frozenset([3, 6]))
+        # 1155 waits for 1 and 5 only with triplets
+        self.assertEqual(tables.sequence_waits((2, 0, 0, 0, 2, 0, 0, 0, 0)),
+                         frozenset())
+        # 2345 waits for 2 and 5 as eyes
+        self.assertEqual(tables.sequence_waits((0, 1, 1, 1, 1, 0, 0, 0, 0)),
+                         frozenset([2, 5]))
@@ -1,7 +1,10 @@
+import copy
+import pickle
+import random
 import unittest
 
-from mahjong.types import (GameContext, GameSettings, Hand, Player, Tile,
-    TileGroup, Wall)
+from mahjong.types import (FrozenSettings, GameContext, GameSettings, Hand, Player,
+    ScoreLedger, Tile, TileGroup, Wall)
 
 
 class TestTile(unittest.TestCase):
@@ -333,6 +336,12 @@ class TestHand(unittest.TestCase):
         self.assertEqual(len(hand2.flowers), 1)
         self.assertEqual(len(hand2.fixed_groups), 2)
 
+        # appended kong on hand2 doesn't touch the shared pong group
+        hand2.last_tile = Tile.EAST
+        hand2.kong_from_self()
+        self.assertEqual(hand2.fixed_groups[0], TileGroup([Tile.EAST] * 4, TileGroup.KONG_EXPOSED))
+        self.assertEqual(self.hand.fixed_groups, [TileGroup([Tile.EAST] * 3, TileGroup.PONG)])
+
     def test_clear(self):
         empty_hand = Hand()
         self.assertEqual(empty_hand.free_tiles, [])
@@ -780,6 +789,82 @@ class TestHand(unittest.TestCase):
         self.assertFalse(hand.ready())
         self.assertFalse(hand.waiting_tiles())
 
+    def test_decompositions(self):
+        # 111 222 333 + 99 can be grouped as triplets or sequences
+        hand = Hand([Tile.CHAR1, Tile.CHAR1, Tile.CHAR1,
+                     Tile.CHAR2, Tile.CHAR2, Tile.CHAR2,
+                     Tile.CHAR3, Tile.CHAR3, Tile.CHAR3,
+                     Tile.CIRCLE9])
+        self.assertEqual(sorted(hand.decompositions(Tile.CIRCLE9)), sorted([
+            [('sequence', Tile.CHAR1), ('sequence', Tile.CHAR1),
+             ('sequence', Tile.CHAR1), ('pair', Tile.CIRCLE9)],
+            [('triplet', Tile.CHAR1), ('triplet', Tile.CHAR2),
+             ('triplet', Tile.CHAR3), ('pair', Tile.CIRCLE9)]
+        ]))
+
+        # last tile is used if there's no incoming tile
+        hand.last_tile = Tile.CIRCLE9
+        self.assertEqual(len(hand.decompositions()), 2)
+
+        # not a winning hand
+        self.assertEqual(hand.decompositions(Tile.CIRCLE8), [])
+
+        # honors and flowers
+        hand = Hand([Tile.EAST, Tile.EAST, Tile.EAST, Tile.RED, Tile.SPRING])
+        self.assertEqual(hand.decompositions(Tile.RED), [
+            [('pair', Tile.RED), ('triplet', Tile.EAST)]
+        ])
+
+        # two pairs
+        hand = Hand([Tile.CHAR1, Tile.CHAR1, Tile.CIRCLE2, Tile.CIRCLE2])
+        self.assertEqual(hand.decompositions(Tile.CIRCLE5), [])
+
+    def test_waits(self):
+        # wait for CHAR3 as an edge or an eye
+        hand = Hand([Tile.CHAR1, Tile.CHAR2, Tile.CHAR3, Tile.CHAR3,
+                     Tile.CIRCLE4, Tile.CIRCLE5, Tile.CIRCLE6,
+                     Tile.BAMBOO7, Tile.BAMBOO8, Tile.BAMBOO9,
+                     Tile.RED, Tile.RED, Tile.RED,
+                     Tile.SPRING])
+        hand.last_tile = Tile.WHITE
+        self.assertEqual(hand.waits(), {
+            Tile.CHAR3: frozenset(['edge', 'eye'])
+        })
+        self.assertEqual(hand.waiting_tiles(), [Tile.CHAR3])
+
+        # wait for CHAR3 and EAST as pair-of-pairs
+        hand = Hand([Tile.CHAR3, Tile.CHAR3, Tile.EAST, Tile.EAST,
+                     Tile.CIRCLE4, Tile.CIRCLE5, Tile.CIRCLE6])
+        self.assertEqual(hand.waits(), {
+            Tile.CHAR3: frozenset(['pair-of-pairs']),
+            Tile.EAST: frozenset(['pair-of-pairs'])
+        })
+
+        # wait for CIRCLE2 and CIRCLE5 with open sides
+        hand = Hand([Tile.CIRCLE3, Tile.CIRCLE4, Tile.GREEN, Tile.GREEN])
+        self.assertEqual(hand.waits(), {
+            Tile.CIRCLE2: frozenset(['open-sides']),
+            Tile.CIRCLE5: frozenset(['open-sides'])
+        })
+
+        # two ungroupable suits
+        hand = Hand([Tile.CHAR1, Tile.CIRCLE1, Tile.GREEN, Tile.GREEN])
+        self.assertEqual(hand.waits(), {})
+
+    def test_sequence_waits(self):
+        # BAMBOO7 triplet can't be a sequence
+        hand = Hand([Tile.CHAR4, Tile.CHAR5, Tile.CHAR6, Tile.CHAR6,
+                     Tile.CIRCLE1, Tile.CIRCLE2, Tile.CIRCLE3,
+                     Tile.BAMBOO7, Tile.BAMBOO7, Tile.BAMBOO7])
+        self.assertEqual(hand.sequence_waits(), [])
+
+        hand = Hand([Tile.CHAR4, Tile.CHAR5, Tile.CHAR6, Tile.CHAR6,
+                     Tile.CIRCLE1, Tile.CIRCLE2, Tile.CIRCLE3])
+        self.assertEqual(hand.sequence_waits(), [Tile.CHAR3, Tile.CHAR6])
+
+        hand = Hand([Tile.CHAR4, Tile.CHAR5, Tile.CIRCLE9, Tile.CIRCLE9])
+        self.assertEqual(hand.sequence_waits(), [Tile.CHAR3, Tile.CHAR6])
+
     def test_illegal_chow(self):
         with self.assertRaises(ValueError):
             self.hand.chow([Tile.BAMBOO1, Tile.BAMBOO2], Tile.BAMBOO3)
@@ -845,6 +930,39 @@ class TestWall(unittest.TestCase):
         w1.draw()
         self.assertEqual(w1, w2)
 
+    def test_clone_shares_tiles(self):
+        w1 = Wall()
+        w1.draw()
+        w2 = w1.clone()
+        self.assertIs(w1._tiles, w2._tiles)
+
+        # draws don't touch the shared list
+        tile = w2.draw()
+        self.assertEqual(w2.num_tiles(), 142)
+        self.assertEqual(w1.num_tiles(), 143)
+        self.assertIs(w1._tiles, w2._tiles)
+        self.assertNotEqual(w1, w2)
+        self.assertEqual([t for t in w2], w1.tiles[:-1])
+
+        w2.put_back(tile)
+        self.assertEqual(w1, w2)
+        self.assertIs(w2._tiles[142], tile)
+
+        # accessing tiles stops sharing
+        w2.tiles.append(tile)
+        self.assertEqual(w2.num_tiles(), 144)
+        self.assertEqual(w1.num_tiles(), 143)
+        self.assertEqual(w2.tiles[:-1], w1.tiles)
+        w1.shuffle()
+        self.assertEqual(w2.num_tiles(), 144)
+
+        w3 = w1.clone()
+        while w3.draw():
+            pass
+        self.assertIsNone(w3.draw())
+        self.assertEqual(w3.num_tiles(), 0)
+        self.assertEqual(w1.num_tiles(), 143)
+
     def test_shuffle(self):
         w1 = Wall()
         w2 = Wall()
@@ -919,6 +1037,95 @@ class TestGameSettings(unittest.TestCase):
         gs.wall_circles = False
         self.assertEqual(gs.total_tiles(), 0)
 
+    def test_tiles_after_dealing(self):
+        gs = GameSettings()
+        self.assertEqual(gs.tiles_after_dealing(), 80)
+        gs.num_hand_tiles = 13
+        self.assertEqual(gs.tiles_after_dealing(), 92)
+
+    def test_fingerprint(self):
+        gs1 = GameSettings()
+        gs2 = GameSettings()
+        self.assertEqual(gs1.fingerprint(), gs2.fingerprint())
+        gs1.patterns_score = dict(gs1.patterns_score)
+        gs1.patterns_score['dealer'] = (2, 'tai')
+        self.assertNotEqual(gs1.fingerprint(), gs2.fingerprint())
+
+        # memoized, but changes in place are still seen
+        fingerprint = gs2.fingerprint()
+        self.assertEqual(gs2.fingerprint(), fingerprint)
+        gs2.patterns_score['dealer'] = (2, 'tai')
+        self.assertEqual(gs2.fingerprint(), gs1.fingerprint())
+        gs2.patterns_win.append('four-kongs')
+        self.assertNotEqual(gs2.fingerprint(), gs1.fingerprint())
+        gs2.patterns_win.pop()
+        gs2.water = False
+        self.assertNotEqual(gs2.fingerprint(), gs1.fingerprint())
+        gs2.water = True
+        self.assertEqual(gs2.fingerprint(), gs1.fingerprint())
+        self.assertEqual(gs2.freeze().fingerprint(), gs1.fingerprint())
+
+    def test_freeze(self):
+        gs = GameSettings()
+        gs.num_hand_tiles = 13
+        gs.wall_flowers = False
+        gs.patterns_win_filter = ['all-pongs']
+        fs = gs.freeze()
+        self.assertIsInstance(fs, FrozenSettings)
+        self.assertEqual(fs.num_hand_tiles, 13)
+        self.assertEqual(fs.total_tiles(), 136)
+        self.assertEqual(fs.tiles_after_dealing(), 84)
+        self.assertEqual(fs.fingerprint(), gs.fingerprint())
+        self.assertEqual(fs.patterns_win, ('seven-flowers', 'eight-flowers'))
+        self.assertEqual(fs.patterns_score, gs.patterns_score)
+        self.assertEqual(fs.patterns_win_set, frozenset(['seven-flowers', 'eight-flowers']))
+        self.assertEqual(fs.patterns_win_filter_set, frozenset(['all-pongs']))
+        self.assertEqual(fs.pattern_names, tuple(sorted(gs.patterns_score)))
+        self.assertEqual(fs.pattern_names[fs.pattern_indices['dealer']], 'dealer')
+        self.assertIs(fs.freeze(), fs)
+
+        # mutable settings have them too
+        for name in ('patterns_win_set', 'patterns_win_filter_set', 'pattern_names', 'pattern_indices'):
+            self.assertEqual(getattr(gs, name), getattr(fs, name))
+
+        self.assertTrue(fs == gs)
+        self.assertTrue(gs == fs)
+        self.assertTrue(fs == gs.freeze())
+        self.assertFalse(fs != gs.freeze())
+        self.assertFalse(fs == GameSettings())
+        self.assertEqual(hash(fs), hash(gs.freeze()))
+        self.assertEqual(GameContext(fs), GameContext(gs))
+
+        with self.assertRaises(AttributeError):
+            fs.num_hand_tiles = 16
+        with self.assertRaises(AttributeError):
+            fs.illegal_attr_name = None
+        with self.assertRaises(AttributeError):
+            del fs.water
+        with self.assertRaises(TypeError):
+            fs.patterns_score['dealer'] = (2, 'tai')
+        with self.assertRaises(TypeError):
+            fs.patterns_score.update({'dealer': (2, 'tai')})
+        with self.assertRaises(TypeError):
+            del fs.patterns_score['dealer']
+        with self.assertRaises(TypeError):
+            fs.pattern_indices['dealer'] = 0
+        self.assertTrue(fs == gs.freeze())
+        self.assertEqual(copy.deepcopy(fs.patterns_score), gs.patterns_score)
+
+        # later changes don't leak into the frozen copy
+        gs.patterns_win.append('four-kongs')
+        self.assertNotIn('four-kongs', fs.patterns_win)
+        self.assertFalse(fs == gs)
+
+        thawed = fs.thaw()
+        self.assertIsInstance(thawed, GameSettings)
+        self.assertTrue(thawed == fs)
+        thawed.water = False
+        self.assertTrue(fs.water)
+
+        self.assertEqual(pickle.loads(pickle.dumps(fs, 2)), fs)
+
 
 class TestPlayer(unittest.TestCase):
 
@@ -1012,6 +1219,66 @@ class TestPlayer(unittest.TestCase):
             p.discard()
 
 
+class TestScoreLedger(unittest.TestCase):
+
+    def setUp(self):
+        self.ledger = ScoreLedger()
+        self.ledger.append([3, -3, 0, 0], 0, 0)
+        self.ledger.append([0, 0, 0, 0], 0, 0)
+        self.ledger.append([-2, -2, 6, -2], 0, 1)
+        self.ledger.append([-1, 0, 0, 1], 1, 2)
+
+    def test_totals(self):
+        self.assertEqual(len(self.ledger), 4)
+        self.assertEqual(self.ledger.totals, [0, -5, 6, -1])
+        self.assertEqual(ScoreLedger().totals, [0, 0, 0, 0])
+
+    def test_entry(self):
+        self.assertEqual(self.ledger.entry(0), ([3, -3, 0, 0], 0, 0))
+        self.assertEqual(self.ledger.entry(2), ([-2, -2, 6, -2], 0, 1))
+        self.assertEqual(self.ledger.entry(-1), ([-1, 0, 0, 1], 1, 2))
+        with self.assertRaises(IndexError):
+            self.ledger.entry(4)
+
+    def test_queries(self):
+        self.assertEqual(self.ledger.last_totals(1), [-1, 0, 0, 1])
+        self.assertEqual(self.ledger.last_totals(2), [-3, -2, 6, -1])
+        self.assertEqual(self.ledger.last_totals(100), [0, -5, 6, -1])
+        self.assertEqual(self.ledger.last_totals(0), [0, 0, 0, 0])
+
+        self.assertEqual(self.ledger.round_totals(0), [1, -5, 6, -2])
+        self.assertEqual(self.ledger.round_totals(1), [-1, 0, 0, 1])
+        self.assertEqual(self.ledger.round_totals(5), [0, 0, 0, 0])
+
+        self.assertEqual(self.ledger.dealer_totals(0), [3, -3, 0, 0])
+        self.assertEqual(self.ledger.dealer_totals(1), [-2, -2, 6, -2])
+        self.assertEqual(self.ledger.dealer_totals(3), [0, 0, 0, 0])
+
+    def test_clone_and_clear(self):
+        ledger = self.ledger.clone()
+        self.assertEqual(ledger, self.ledger)
+        ledger.append([1, -1, 0, 0], 1, 2)
+        self.assertEqual(self.ledger.dealer_totals(2), [-1, 0, 0, 1])
+        self.assertEqual(ledger.dealer_totals(2), [0, -1, 0, 1])
+        self.assertFalse(ledger == self.ledger)
+
+        ledger.clear()
+        self.assertEqual(len(ledger), 0)
+        self.assertEqual(ledger, ScoreLedger())
+        self.assertEqual(ledger.round_totals(0), [0, 0, 0, 0])
+
+    def test_clone_shares_storage(self):
+        ledger = self.ledger.clone()
+        totals = self.ledger.dealer_totals(1)
+        self.assertIs(ledger._sums, self.ledger._sums)
+        self.ledger.append([2, -2, 0, 0], 0, 1)
+        self.assertIsNot(ledger._sums, self.ledger._sums)
+        self.assertEqual(len(ledger), len(self.ledger) - 1)
+        self.assertEqual(ledger.dealer_totals(1), totals)
+        ledger.append([2, -2, 0, 0], 0, 1)
+        self.assertEqual(ledger, self.ledger)
+
+
 class TestGameContext(unittest.TestCase):
 
     def test_equality(self):
@@ -1198,6 +1465,78 @@ class TestGameContext(unittest.TestCase):
         self.assertTrue(c.is_tie())
         self.assertFalse(c.is_tie(four_winds=False))
 
+    def test_tie_after_moves(self):
+        gs = GameSettings()
+        gs.tie_on_4_waiting = True
+        gs.tie_on_4_kongs = True
+        gs.tie_on_winds = 'all'
+        c = GameContext(settings=gs)
+        c.wall = Wall()
+
+        # first discards: EAST from everyone
+        for player_idx in xrange(4):
+            c.players[player_idx].hand.add_free_tiles([Tile.EAST, Tile.RED, Tile.RED,
+                                                       Tile.RED, Tile.RED])
+            c.discard(Tile.EAST, player_idx)
+        self.assertTrue(c.is_tie())
+
+        # the last EAST is melded, and a later discard doesn't count
+        self.assertEqual(c.remove_last_discarded(player_offset=3), Tile.EAST)
+        self.assertFalse(c.is_tie())
+        c.discard(Tile.RED, 3)
+        self.assertFalse(c.is_tie())
+        self.assertFalse(c.clone().is_tie())
+
+        # 4 kongs
+        for player_idx in xrange(3):
+            c.players[player_idx].hand.last_tile = Tile.RED
+            c.players[player_idx].hand.kong_from_self()
+        self.assertFalse(c.is_tie(wall_tie=False))
+        c.players[3].hand.add_free_tile(Tile.RED)
+        c.players[3].hand.kong_from_other(Tile.RED)
+        self.assertTrue(c.is_tie(wall_tie=False))
+        self.assertTrue(c.clone().is_tie(wall_tie=False))
+
+        # 4-waiting, declaring twice is the same
+        c.declare_ready(0)
+        c.declare_ready(0)
+        c.declare_ready(1)
+        c.declare_ready(2)
+        self.assertFalse(c.is_tie(four_kongs=False, wall_tie=False))
+        c.declare_ready(3)
+        self.assertTrue(c.is_tie(four_kongs=False, wall_tie=False))
+        self.assertTrue(c.players[3].extra['declared_ready'])
+
+        c.reset_players()
+        self.assertFalse(c.is_tie())
+
+    def test_tie_after_copies(self):
+        gs = GameSettings()
+        gs.tie_on_4_kongs = True
+        gs.tie_on_winds = 'west'
+        c = GameContext(settings=gs)
+        c.wall = Wall(rng=random.Random(0))
+        for player in c.players:
+            player.discarded.append(Tile.WEST)
+        self.assertTrue(c.is_tie())
+
+        # copies have tiles of their own
+        copied = copy.deepcopy(c)
+        self.assertIsNot(copied.players[0].discarded[0], Tile.WEST)
+        self.assertTrue(copied.is_tie())
+        copied.players[0].discarded = [Tile.EAST]
+        self.assertFalse(copied.is_tie())
+        self.assertTrue(c.is_tie())
+
+        # replaced hands and lists
+        c.players[0].extra = {'declared_ready': True}
+        c.players[1].hand = Hand()
+        c.players[1].hand.fixed_groups = [TileGroup([Tile.RED] * 4, TileGroup.KONG_EXPOSED)] * 4
+        self.assertTrue(c.is_tie(four_winds=False, wall_tie=False))
+        self.assertTrue(c.clone().is_tie(four_winds=False, wall_tie=False))
+        c.players[1].hand = Hand()
+        self.assertFalse(c.is_tie(four_winds=False, wall_tie=False))
+
     def test_discard(self):
         c = GameContext()
         c.players[0].hand.add_free_tiles([Tile.CHAR1, Tile.CHAR2, Tile.CHAR3,
@@ -1297,3 +1636,120 @@ class TestGameContext(unittest.TestCase):
         c.set_turn(1)
         self.assertEqual(c.cur_player_idx, 1)
         self.assertEqual(c.last_player_idx, 2)
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.context = GameContext()
+        self.context.wall = Wall()
+        self.context.wall.tiles = [Tile.CHAR1, Tile.RED, Tile.SPRING, Tile.EAST]
+        hands = [p.hand for p in self.context.players]
+        hands[0].add_free_tiles([Tile.CHAR2, Tile.CHAR3, Tile.EAST, Tile.EAST, Tile.EAST,
+                                 Tile.WEST])
+        hands[1].add_free_tiles([Tile.CHAR1, Tile.CHAR3, Tile.CIRCLE5, Tile.WEST, Tile.WEST])
+        hands[2].add_free_tiles([Tile.WEST, Tile.WEST, Tile.WEST, Tile.RED, Tile.RED])
+        hands[2].fixed_groups.append(TileGroup([Tile.GREEN] * 3, TileGroup.PONG))
+
+    def assert_undo_all(self, orig_context):
+        while self.context.journal:
+            self.context.undo()
+        self.assertEqual(self.context, orig_context)
+        self.assertEqual(self.context.wall.tiles, orig_context.wall.tiles)
+
+    def test_apply_and_undo(self):
+        c = self.context
+        orig_context = c.clone()
+
+        # player 0 draws EAST and kongs it, then draws a flower and a RED
+        c.apply(('draw', 0, None))
+        self.assertEqual(c.players[0].hand.last_tile, Tile.EAST)
+        c.apply(('self-kong', 0, None))
+        self.assertEqual(c.players[0].hand.fixed_groups,
+                         [TileGroup([Tile.EAST] * 4, TileGroup.KONG_CONCEALED)])
+        c.apply(('draw', 0, None))
+        c.apply(('flower', 0, None))
+        self.assertEqual(c.players[0].hand.flowers, [Tile.SPRING])
+        c.apply(('draw', 0, None))
+
+        # player 0 discards WEST, player 2 kongs it and discards RED
+        c.apply(('discard', 0, Tile.WEST))
+        self.assertEqual(c.players[0].hand.free_tiles, [Tile.CHAR2, Tile.CHAR3, Tile.RED])
+        c.apply(('extra', 2, ('viable_decisions', ['kong', 'pong', 'skip'])))
+        c.apply(('kong', 2, None))
+        self.assertEqual(c.players[2].hand.num_kongs(), 1)
+        c.apply(('extra', 2, ('viable_decisions', None)))
+        c.apply(('turn', 2, None))
+        c.apply(('discard', 2, Tile.RED))
+        self.assertEqual(c.discarded_pool, [Tile.RED])
+
+        # nobody melds RED, player 3's turn
+        c.apply(('turn', 3, None))
+        self.assertEqual((c.cur_player_idx, c.last_player_idx), (3, 2))
+        c.apply(('extra', None, ('tie_type', 'wall')))
+        self.assertEqual(len(c.journal), 13)
+
+        self.assert_undo_all(orig_context)
+
+    def test_appended_kong_and_chow(self):
+        c = self.context
+        c.cur_player_idx = 0
+        c.players[0].discarded.append(Tile.WEST)
+        c.discarded_pool.append(Tile.WEST)
+        orig_context = c.clone()
+
+        c.apply(('discard', 0, Tile.CHAR2))
+        c.apply(('chow', 1, (Tile.CHAR1, Tile.CHAR3)))
+        self.assertEqual(c.players[1].hand.fixed_groups,
+                         [TileGroup([Tile.CHAR1, Tile.CHAR2, Tile.CHAR3], TileGroup.CHOW)])
+        self.assertEqual(c.players[1].hand.free_tiles, [Tile.CIRCLE5, Tile.WEST, Tile.WEST])
+        self.assertEqual(c.discarded_pool, [Tile.WEST])
+        self.assert_undo_all(orig_context)
+
+        # appended kong: player 2 has a pong of GREEN
+        c.players[2].hand.last_tile = Tile.GREEN
+        orig_context = c.clone()
+        c.apply(('self-kong', 2, None))
+        self.assertEqual(c.players[2].hand.fixed_groups,
+                         [TileGroup([Tile.GREEN] * 4, TileGroup.KONG_EXPOSED)])
+        self.assert_undo_all(orig_context)
+
+    def test_errors(self):
+        self.assertRaises(ValueError, self.context.undo)
+        self.assertRaises(ValueError, self.context.apply, ('fly', 0, None))
+        self.assertRaises(ValueError, self.context.apply, ('flower', 0, None))
+        self.context.cur_player_idx = 0
+        self.assertRaises(ValueError, self.context.apply, ('pong', 1, None))
+        self.assertEqual(self.context.journal, [])
+
+    def test_failed_moves_change_nothing(self):
+        c = self.context
+        c.cur_player_idx = 0
+        c.apply(('discard', 0, Tile.CHAR2))
+        orig_context = c.clone()
+
+        # player 1 has CHAR1 but not CHAR4, player 3 has nothing to pong
+        self.assertRaises(ValueError, c.apply, ('chow', 1, (Tile.CHAR1, Tile.CHAR4)))
+        self.assertRaises(ValueError, c.apply, ('pong', 3, None))
+        self.assertRaises(ValueError, c.apply, ('kong', 3, None))
+        self.assertEqual(c, orig_context)
+        self.assertEqual(c.players[1].hand.free_tiles, orig_context.players[1].hand.free_tiles)
+        self.assertEqual(c.players[3].hand.num_kongs(), 0)
+        self.assertEqual(len(c.journal), 1)
+
+        # a discard by someone else than the current player isn't meldable
+        c.cur_player_idx = 1
+        self.assertRaises(ValueError, c.apply, ('chow', 2, (Tile.CHAR1, Tile.CHAR3)))
+        self.assertEqual(c.discarded_pool, [Tile.CHAR2])
+
+    def test_declare(self):
+        c = self.context
+        c.settings.tie_on_4_waiting = True
+        orig_context = c.clone()
+        for player_idx in xrange(4):
+            c.apply(('extra', player_idx, ('declared_ready', True)))
+        self.assertTrue(c.is_tie(wall_tie=False))
+
+        self.assert_undo_all(orig_context)
+        self.assertNotIn('declared_ready', c.players[1].extra)
+        self.assertFalse(c.is_tie(wall_tie=False))